@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: registry_bench
+@date: 2018/8/6
+@usage:
+    python bench/registry_bench.py --classes 300 --modules 30 --tasks 200
+
+对比 Sampler/Monitor 初始化时加载事件类的耗时：
+    rescan: 旧的 get_lib_cls，每个任务 find_modules + import_string 扫描整个包
+    registry: lib.registry，进程内构建一次后冻结，之后每个任务只是 dict 查找
+"""
+import os
+import sys
+import shutil
+import tempfile
+from time import perf_counter
+
+import click
+from werkzeug.utils import find_modules, import_string
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lib.registry import EventRegistry  # noqa: E402
+
+PACKAGE = 'bench_events'
+
+
+def make_package(path, classes, modules):
+    package = os.path.join(path, PACKAGE)
+    os.mkdir(package)
+    with open(os.path.join(package, '__init__.py'), 'w') as f:
+        f.write('from lib.registry import EventRegistry\n'
+                f'registry = EventRegistry({PACKAGE!r}, group=None)\n')
+
+    per_module = max(classes // modules, 1)
+    for m in range(modules):
+        lines = [f'from {PACKAGE} import registry\n']
+        for c in range(per_module):
+            n = m * per_module + c
+            lines.append(f'\n\n@registry.register\n'
+                         f'class Event{n}:\n'
+                         f"    _event_key = 'event_{n}'\n")
+        with open(os.path.join(package, f'events_{m}.py'), 'w') as f:
+            f.writelines(lines)
+
+    return per_module * modules
+
+
+def rescan():
+    """旧实现：每次扫描整个包"""
+    return {field_type._event_key: field_type
+            for name in find_modules(PACKAGE)
+            for field, field_type in import_string(name).__dict__.items()
+            if hasattr(field_type, '_event_key')}
+
+
+def bench(fn, tasks, event_keys):
+    start = perf_counter()
+    for _ in range(tasks):
+        classes = fn()
+        for event_key in event_keys:
+            classes.get(event_key)
+    return (perf_counter() - start) / tasks
+
+
+@click.command()
+@click.option('--classes', default=300)
+@click.option('--modules', default=30)
+@click.option('--tasks', default=200)
+def main(classes, modules, tasks):
+    path = tempfile.mkdtemp()
+    sys.path.insert(0, path)
+    try:
+        total = make_package(path, classes, modules)
+        event_keys = [f'event_{n}' for n in range(total)]
+
+        registry = import_string(PACKAGE).registry
+        assert isinstance(registry, EventRegistry)
+
+        start = perf_counter()
+        registry.classes()
+        build = perf_counter() - start
+        assert len(registry.classes()) == total
+
+        per_rescan = bench(rescan, tasks, event_keys)
+        per_registry = bench(registry.classes, tasks, event_keys)
+
+        print(f'event classes: {total}, modules: {modules}, tasks: {tasks}')
+        print(f'registry build (once per process): {build * 1e3:10.3f} ms')
+        print(f'rescan   setup per task:           {per_rescan * 1e3:10.3f} ms')
+        print(f'registry setup per task:           {per_registry * 1e3:10.3f} ms')
+        print(f'speedup:                           {per_rescan / per_registry:10.1f} x')
+    finally:
+        sys.path.remove(path)
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: timeseries_bench
+@date: 2018/9/3
+@usage:
+    python bench/timeseries_bench.py --keys 200 --days 18 --ticks 50
+
+使用 sqlite 存储，不需要 InfluxDB 服务。写入 keys 个 event_key days 天的 5 分钟统计值，
+对比 Monitor 每个 tick 冷启动时的历史数据读取（统计值、近期数据、每天同一时刻的数据）
+与加载整个缓存窗口的耗时
+"""
+import os
+import sys
+import shutil
+import tempfile
+from time import perf_counter, time
+
+import click
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.timeseries import SQLiteBackend, TIERS  # noqa: E402
+
+DAY = 86400
+RESOLUTION = 300
+
+
+@click.command()
+@click.option('--keys', default=200)
+@click.option('--days', default=18)
+@click.option('--ticks', default=50)
+def main(keys, days, ticks):
+    path = tempfile.mkdtemp()
+    try:
+        backend = SQLiteBackend(os.path.join(path, 'timeseries.db'))
+        tier = next(tier for tier in TIERS if tier.resolution == RESOLUTION)
+        event_keys = [f'event_{n}' for n in range(keys)]
+
+        now = int(time())
+        end = now - now % RESOLUTION
+        start = end - days * DAY
+        t0 = perf_counter()
+        for event_key in event_keys:
+            backend.write([{
+                "measurement": tier.measurement,
+                "tags": {"event_key": event_key},
+                "time": t,
+                "fields": {"value": t // RESOLUTION % 100},
+            } for t in range(start, end, RESOLUTION)], retention_policy=tier.retention_policy)
+        write = perf_counter() - t0
+
+        t0 = perf_counter()
+        for i in range(ticks):
+            t = end - i * RESOLUTION
+            windows = [(t, None, tier), (t - 45 * 60, t, tier)]
+            windows.extend((t - (d + 1) * DAY, None, tier) for d in range(days - 1))
+            backend.read(event_keys, windows, RESOLUTION)
+        tick = (perf_counter() - t0) / ticks
+
+        t0 = perf_counter()
+        backend.read(event_keys, [(start, end, tier)], RESOLUTION)
+        warm = perf_counter() - t0
+
+        print(f'event keys: {keys}, days: {days}, points: {keys * days * DAY // RESOLUTION}')
+        print(f'write all points:            {write:10.3f} s')
+        print(f'history read per tick:       {tick * 1e3:10.3f} ms')
+        print(f'warm read of whole window:   {warm * 1e3:10.3f} ms')
+        backend.close()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,6 @@
 import logging
 from datetime import timedelta
 
-from models import get_session
 from lib.base import Base
 from util.transfer import s2t, t2s
 
@@ -35,18 +34,8 @@ class CountApplication25Min(Base):
     def timestamp(self):
         return self.timestamp_ns(self.start)
 
-    def sample_value(self):
-        url = self.conf.get('url')
-        session = get_session(url, self.schema, autocommit=True)
-        created_time = getattr(self.model, self.conf.get('created_time'))
-
-        value = session.query(self.model). \
-            filter(created_time >= self.start_sample,
-                   created_time < self.end,
-                   self.model.status == 'SUCCESS').count()
-
-        session.close()
-        return value
+    def sample_filters(self):
+        return [self.model.status == 'SUCCESS']
 
 
 class ApplicationConsumeLoan(Base):
@@ -68,19 +57,9 @@ class ApplicationConsumeLoan(Base):
     def timestamp(self):
         return self.timestamp_ns(self.start)
 
-    def sample_value(self):
-        url = self.conf.get('url')
-        session = get_session(url, self.schema, autocommit=True)
-        created_time = getattr(self.model, self.conf.get('created_time'))
-
-        value = session.query(self.model). \
-            filter(created_time >= self.start_sample,
-                   created_time < self.end,
-                   self.model.apply_type == 'consume_loan',
-                   self.model.status == 'SUCCESS').count()
-
-        session.close()
-        return value
+    def sample_filters(self):
+        return [self.model.apply_type == 'consume_loan',
+                self.model.status == 'SUCCESS']
 
 
 class ApplicationCashLoan(Base):
@@ -102,19 +81,9 @@ class ApplicationCashLoan(Base):
     def timestamp(self):
         return self.timestamp_ns(self.start)
 
-    def sample_value(self):
-        url = self.conf.get('url')
-        session = get_session(url, self.schema, autocommit=True)
-        created_time = getattr(self.model, self.conf.get('created_time'))
-
-        value = session.query(self.model). \
-            filter(created_time >= self.start_sample,
-                   created_time < self.end,
-                   self.model.apply_type.in_(['cash_loan', 'pay_day_loan']),
-                   self.model.status == 'SUCCESS').count()
-
-        session.close()
-        return value
+    def sample_filters(self):
+        return [self.model.apply_type.in_(['cash_loan', 'pay_day_loan']),
+                self.model.status == 'SUCCESS']
 
 
 if __name__ == '__main__':
@@ -6,33 +6,65 @@
 @module: base 
 @date: 7/23/18 
 """
+import time
+import hashlib
 import logging
+from threading import Lock
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from collections import defaultdict, deque
 
 import numpy as np
-from scipy import stats
 from abc import ABCMeta, abstractmethod
-from influxdb import InfluxDBClient
+from sqlalchemy import Integer, and_, bindparam, case, func, select, true
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 
-from config.DB import INFLUXDB_CONFIG
 from config.APP import (
     TABLE_CONFIG,
     MEAN_PERIOD,
     EXPECT_PERIOD,
-    INFLUXDB_DATABASE_NAME
+    SCHEMA_VERSION,
+    METADATA_CACHE_PATH,
+    HISTORY_WARM_LIMIT,
+    ROLLUP_LATENESS,
+    WATERMARK_SAFETY,
+    SAMPLE_STATEMENT_TIMEOUT,
 )
-from models import get_base
-from util.transfer import s2t
+from models import get_db, get_model
+from models.replica import get_replica_set
+from models.timeseries import TIERS, get_backend
+from lib.registry import registry
+from lib.history import History, RESOLUTION, DAY, LEAST_MEAN_PERIOD, store
+from lib.baseline import baseline
+from lib.watermark import watermarks
+from util.transfer import s2t, t2s
 from util.misc import frozendict, uint_array, float_array
 
 logger = logging.getLogger(__name__)
 
+# 编译后的采样语句: {(dialect, incremental, 事件类): Compiled}
+COMPILED_CACHE_SIZE = 1024
+_compiled_cache = {}
+_compiled_lock = Lock()
+
+
+class LazyModel:
+    """首次访问 model 时才反射对应的表，导入 lib 模块时不连接数据库"""
+
+    def __get__(self, instance, owner):
+        return get_model(owner.conf['url'], owner.schema, owner.table,
+                         METADATA_CACHE_PATH, SCHEMA_VERSION)
+
 
 class Meta(ABCMeta):
     """
     通过 '_event_key', 'schema', 'table' 类属性，自动添加
     conf，model 属性。
     conf: 数据库表的配置信息，包括 url, created_time 与 updated_time 字段名称
-    model: 数据库表对应的 ORM 模型
+    model: 数据库表对应的 ORM 模型，只反射这一张表，并且延迟到首次使用
+    非抽象类在定义时自动注册到 lib.registry，__register__ 为 False 的类除外；
+    类属性 conf 中的配置会覆盖 TABLE_CONFIG 中的同名配置
     """
     properties = {
         '_event_key', 'schema', 'table'
@@ -47,17 +79,18 @@ class Meta(ABCMeta):
 
         if not is_abstarct:
             name = '.'.join([attrs['schema'], attrs['table']])
-            conf = frozendict(TABLE_CONFIG.get(name))
+            conf = frozendict({**TABLE_CONFIG.get(name), **attrs.get('conf', {})})
 
-            base = get_base(conf['url'], attrs['schema'])
-            model = getattr(base.classes, attrs['table'])
+            attrs.update(conf=conf, model=LazyModel())
 
-            attrs.update(conf=conf, model=model)
-        return super().__new__(mcs, name, bases, attrs)
+        cls = super().__new__(mcs, name, bases, attrs)
+        if not is_abstarct and attrs.get('__register__', True):
+            registry.register(cls)
+        return cls
 
 
 class Base(metaclass=Meta):
-    """基本，子类必须实现：event_key，timestamp 属性以及 sample_value 方法，如
+    """基本，子类必须实现：event_key，timestamp 属性以及 sample_filters 方法，如
     @property
     def event_key(self):
         return self._event_key
@@ -66,8 +99,11 @@ class Base(metaclass=Meta):
     def timestamp(self):
         return self.timestamp_ns(self.start)
 
-    def sample_value(self):
-        return 0
+    def sample_filters(self):
+        return [self.model.status == 'SUCCESS']
+
+    sample_filters：采样时除时间范围以外的过滤条件，同一张表的事件会合并为
+    一条 SUM(CASE WHEN ...) 查询；也可以直接重写 sample_value 自定义采样
 
     real_value：采用的实际统计值
     expect_values：基于历史统计值预测当前时间的值
@@ -75,9 +111,9 @@ class Base(metaclass=Meta):
     """
     __abstract__ = True
 
-    client = InfluxDBClient(**INFLUXDB_CONFIG,
-                            database=INFLUXDB_DATABASE_NAME)
-    least_mean_period = 3
+    least_mean_period = LEAST_MEAN_PERIOD
+    # fetch_history 批量获取的历史数据，为 None 时各方法单独查询
+    history = None
 
     @property
     @abstractmethod
@@ -90,9 +126,18 @@ class Base(metaclass=Meta):
         """返回 rp_5_weeks.eventLog 中使用的时间戳"""
         pass
 
-    @abstractmethod
+    def sample_filters(self):
+        """
+        采样过滤条件，不包括 created_time 时间范围
+        返回 None 表示没有声明过滤条件，需要重写 sample_value
+        """
+        return None
+
     def sample_value(self):
-        pass
+        """采样 start_sample ~ end 时间之内的数据"""
+        if self.sample_filters() is None:
+            raise NotImplementedError('sample_filters or sample_value must be implemented !')
+        return sample_table([self])[self.event_key]
 
     @staticmethod
     def timestamp_ns(end: str):
@@ -100,14 +145,13 @@ class Base(metaclass=Meta):
 
     def real_value(self):
         """统计值"""
-        query_sql = ("SELECT value FROM rp_5_weeks.eventLog "
-                     f"WHERE event_key='{self.event_key}' "
-                     f"AND time={self.timestamp}+1m")
-        ret = self.client.query(query_sql)
-        self.client.close()
-        points = list(ret.get_points())
+        if self.history is not None:
+            return self.history.real
 
-        return points[0].get('value') if points else None
+        real, = _query_series([self.event_key], [(self.timestamp // 10 ** 9 + 60, None)])
+        points = real.get(self.event_key)
+
+        return points[0][1] if points else None
 
     def expect_values(self):
         mv = self.mean_value()
@@ -116,20 +160,27 @@ class Base(metaclass=Meta):
 
     def linear_value(self):
         """线性回归值"""
-        sql = ("SELECT value FROM rp_5_weeks.eventLog "
-               f"WHERE event_key='{self.event_key}' "
-               f"AND time<{self.timestamp} "
-               f"AND time>={self.timestamp}-{EXPECT_PERIOD}m")
-        ret = self.client.query(sql)
-        self.client.close()
+        if self.history is not None:
+            history = self.history
+            return self.linear(history.recent if history.regression is None
+                               else history.regression)
+
+        ts = self.timestamp // 10 ** 9
+        recent, = _query_series([self.event_key], [(ts - EXPECT_PERIOD * 60, ts)])
+
+        return self.linear(float_array([value for _, value in recent.get(self.event_key, [])]))
+
+    @staticmethod
+    def linear(y):
+        """
+        基于近期数据线性回归预测下一个值
+        :param y: 近期数据，或者已经包含近期数据的 SlidingRegression
+        """
+        regression = y if isinstance(y, SlidingRegression) else SlidingRegression.from_values(y)
 
         value = None
-        y = float_array([point.get('value') for point in ret.get_points()])
-        if y.size > 5:
-            next_x = len(y)
-            x = float_array(range(next_x))
-            slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
-            value = round(intercept + slope * next_x)
+        if len(regression) > 5:
+            value = round(regression.predict())
 
         return value if value is None or value > 0 else 0.0
 
@@ -139,20 +190,35 @@ class Base(metaclass=Meta):
         if MEAN_PERIOD < 2:
             return None
 
-        def build_sql(key):
-            return ("SELECT value FROM rp_5_weeks.eventLog "
-                    f"WHERE event_key='{self.event_key}' "
-                    f"AND time={self.timestamp}+1m-{key}d")
+        if self.history is not None:
+            if self.history.baseline is not None:
+                return self.baseline_value(self.history.baseline)
+            return self.mean(self.history.daily)
 
-        sqls = ';'.join([build_sql(i+1) for i in range(MEAN_PERIOD + self.least_mean_period)])
-        rets = self.client.query(sqls)
-        self.client.close()
+        t = self.timestamp // 10 ** 9 + 60
+        if baseline is not None and self.least_mean_period == LEAST_MEAN_PERIOD:
+            means = baseline.lookup([self.event_key], t)
+            if self.event_key in means:
+                return self.baseline_value(means[self.event_key])
 
+        windows = [(t - (i + 1) * DAY, None) for i in range(MEAN_PERIOD + self.least_mean_period)]
+        daily = _query_series([self.event_key], windows)
+
+        return self.mean([value for series in daily
+                          for _, value in series.get(self.event_key, [])])
+
+    @staticmethod
+    def baseline_value(value):
+        """基线表中的值与 mean 的返回值类型一致"""
+        return None if np.isnan(value) else int(value)
+
+    @classmethod
+    def mean(cls, values):
+        """去掉离群值后的算数平均值"""
         value = None
-        values = uint_array(sorted((point.get('value') for ret in rets
-                                   for point in ret.get_points())))
+        values = uint_array(sorted(int(v) for v in values))
         length = len(values)
-        if length >= MEAN_PERIOD or length >= self.least_mean_period:
+        if length >= MEAN_PERIOD or length >= cls.least_mean_period:
             pivot = (length + 1) // 2 if length % 2 else length // 2
             median = values[pivot]
             high = int(median * 2.5)
@@ -164,5 +230,522 @@ class Base(metaclass=Meta):
         return value
 
 
+class SlidingRegression:
+    """
+    滑动窗口线性回归，x 为数据点在窗口内的序号 0, 1, ..., n-1。
+    维护 sum(y) 与 sum(x*y)，sum(x) 与 sum(x*x) 由 n 直接算出，
+    数据点进入、离开窗口都是 O(1) 更新，结果与 scipy.stats.linregress 一致。
+    采样值都是整数，累加不会产生误差
+    """
+
+    def __init__(self):
+        self.points = deque()
+        self.sum_y = 0.0
+        self.sum_xy = 0.0
+        # 窗口的结束时间，由调用者维护
+        self.end = None
+
+    @classmethod
+    def from_values(cls, y):
+        regression = cls()
+        for t, value in enumerate(y):
+            regression.push(t, value)
+        return regression
+
+    def __len__(self):
+        return len(self.points)
+
+    def push(self, t, y):
+        """在窗口末尾加入数据点，x = n"""
+        y = float(y)
+        self.sum_xy += len(self.points) * y
+        self.sum_y += y
+        self.points.append((t, y))
+
+    def expire(self, start):
+        """移出时间早于 start 的数据点，其余数据点的 x 都减 1"""
+        while self.points and self.points[0][0] < start:
+            _, y = self.points.popleft()
+            self.sum_y -= y
+            self.sum_xy -= self.sum_y
+
+    def fit(self):
+        """:return: (slope, intercept)"""
+        n = len(self.points)
+        if n < 2:
+            return None
+
+        mean_x = (n - 1) / 2
+        ssxm = n * (n * n - 1) / 12
+        ssxym = self.sum_xy - mean_x * self.sum_y
+        slope = ssxym / ssxm
+        return slope, self.sum_y / n - slope * mean_x
+
+    def predict(self):
+        """预测下一个数据点，即 x = n 的值"""
+        slope, intercept = self.fit()
+        return intercept + slope * len(self.points)
+
+
+def linear_values(windows):
+    """
+    Base.linear 的向量化版本，一次计算多个窗口
+    :param windows: K x W 矩阵，每行为一个窗口的近期数据，缺失的数据为 nan
+    :return: 长度为 K 的数组，无法计算的为 nan
+    """
+    windows = np.asarray(windows, dtype=float)
+    mask = ~np.isnan(windows)
+    n = mask.sum(axis=1)
+    # x 为数据点在窗口内去掉缺失值后的序号
+    x = np.cumsum(mask, axis=1) - 1
+    y = np.where(mask, windows, 0.0)
+    sum_y = y.sum(axis=1)
+    sum_xy = (x * y).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = (n - 1) / 2
+        slope = (sum_xy - mean_x * sum_y) / (n * (n * n - 1) / 12)
+        predict = np.round(sum_y / n - slope * mean_x + slope * n)
+
+    values = np.where(predict > 0, predict, 0.0)
+    values[n <= 5] = np.nan
+    return values
+
+
+def mean_values(values):
+    """
+    Base.mean 的向量化版本
+    :param values: K x P 矩阵，每行为一个时刻的历史同一时刻数据，缺失的数据为 nan
+    :return: 长度为 K 的数组，无法计算的为 nan
+    """
+    values = np.trunc(np.asarray(values, dtype=float))
+    rows = np.arange(values.shape[0])
+    if MEAN_PERIOD < 2 or not values.shape[1]:
+        return np.full(values.shape[0], np.nan)
+
+    length = (~np.isnan(values)).sum(axis=1)
+    pivot = np.where(length % 2, (length + 1) // 2, length // 2)
+    median = np.sort(values, axis=1)[rows, np.minimum(pivot, values.shape[1] - 1)]
+
+    with np.errstate(invalid='ignore'):
+        high = np.trunc(median * 2.5)[:, None]
+        low = np.trunc(median * 0.4)[:, None]
+        valid = (values > low) & (values < high)
+        count = valid.sum(axis=1)
+        means = np.trunc(np.where(valid, values, 0.0).sum(axis=1) / count)
+
+    means[(length < LEAST_MEAN_PERIOD) | (count == 0)] = np.nan
+    return means
+
+
+def sample_url(obj, end: str=None, fallback=False):
+    """
+    采样查询使用的 url，TABLE_CONFIG 配置了 replicas 时选择已同步到 end 的从库，
+    从库延迟过大时抛出 ReplicaLagError，fallback 为 True 时使用主库
+    """
+    replicas = get_replica_set(obj.conf)
+    if replicas is None:
+        return obj.conf.get('url')
+    return replicas.choose(s2t(end).timestamp() if end else None, fallback)
+
+
+@contextmanager
+def _sample_connection(obj, end: str=None, fallback=False):
+    """采样查询使用的数据库连接，不经过 ORM Session，记录从库的查询耗时与错误"""
+    url = sample_url(obj, end, fallback)
+    replicas = get_replica_set(obj.conf)
+    conn = get_db(url, obj.schema).connect()
+    start = time.time()
+    try:
+        yield conn
+    except Exception as e:
+        if replicas:
+            replicas.record(url, error=e)
+        raise
+    else:
+        if replicas:
+            replicas.record(url, time.time() - start)
+    finally:
+        conn.close()
+
+
+def sample_table(objs, fallback=False):
+    """
+    同一张表的多个事件合并为一条查询，每个事件对应一列 SUM(CASE WHEN ...)
+    :param objs: 同一张表，相同采样时间的事件实例
+    :param fallback: 从库延迟过大时是否使用主库
+    :return: {event_key: value}
+    """
+    obj = objs[0]
+    with _sample_connection(obj, obj.end, fallback) as conn:
+        if incremental(obj):
+            values = _sample_incremental(objs, conn)
+            if values is not None:
+                return values
+        row = conn.execute(compiled_statement(objs, conn.dialect), window_params(obj)).first()
+
+    return {o.event_key: int(value) for o, value in zip(objs, row)}
+
+
+def incremental(obj):
+    """
+    主键水位只适用于 TABLE_CONFIG 中的 created_time，
+    自定义的采样时间列（如 updated_time）与主键的顺序无关
+    """
+    default = TABLE_CONFIG.get('.'.join([obj.schema, obj.table]), {})
+    return bool(obj.conf.get('primary_key')) and \
+        obj.conf.get('created_time') == default.get('created_time')
+
+
+def _sample_incremental(objs, conn):
+    """
+    TABLE_CONFIG 配置了 primary_key 的表只统计主键大于水位的行，每次扫描的行数与新增行数成正比。
+    假设主键与 created_time 的乱序不超过 WATERMARK_SAFETY 秒：
+    水位 (watermark, safe) 为 created_time < safe 的行的最大主键，
+    则 created_time >= safe + WATERMARK_SAFETY 的行主键都大于 watermark。
+    水位不适用于采样时间时（比如重试较早的分钟）返回 None，使用 created_time 范围查询
+    """
+    obj = objs[0]
+    key = group_name(obj)
+    start = s2t(obj.start_sample)
+
+    state = watermarks.get(key)
+    if state is None:
+        safe = start - timedelta(seconds=WATERMARK_SAFETY)
+        state = _bootstrap_watermark(obj, conn, safe), safe.timestamp()
+        watermarks.put(key, *state)
+    watermark, safe = state
+    if start.timestamp() < safe + WATERMARK_SAFETY:
+        return None
+
+    new_safe = s2t(obj.end) - timedelta(seconds=WATERMARK_SAFETY)
+    row = conn.execute(compiled_statement(objs, conn.dialect, incremental=True),
+                       window_params(obj, watermark=watermark, safe=new_safe)).first()
+    *values, latest = row
+    watermarks.put(key, max(watermark, latest or 0), new_safe.timestamp())
+
+    return {o.event_key: int(value) for o, value in zip(objs, values)}
+
+
+def _bootstrap_watermark(obj, conn, safe):
+    """
+    按主键二分查找 created_time < safe 的一行，只使用主键索引
+    :return: 主键，所有行都不早于 safe 时返回最小主键 - 1
+    """
+    created_time = getattr(obj.model, obj.conf.get('created_time'))
+    pk = getattr(obj.model, obj.conf.get('primary_key'))
+
+    def first(from_id):
+        return conn.execute(select([pk, created_time]).
+                            where(pk >= from_id).order_by(pk).limit(1)).first()
+
+    lo, hi = conn.execute(select([func.min(pk), func.max(pk)])).first()
+    if lo is None:
+        return 0
+    if first(lo)[1] >= safe:
+        return lo - 1
+
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        row_id, row_time = first(mid)
+        if row_time < safe:
+            lo = row_id
+        else:
+            hi = mid - 1
+
+    logger.info(f'Bootstrap watermark {obj.schema}.{obj.table}: {lo}')
+    return lo
+
+
+def window_params(obj, **params):
+    """编译后的采样语句的参数，时间为 datetime"""
+    return {'start': s2t(obj.start_sample), 'end': s2t(obj.end), **params}
+
+
+def compiled_statement(objs, dialect, incremental=False):
+    """
+    按 (dialect, 事件类) 缓存编译后的采样语句，每次只需绑定 window_params，
+    因此 sample_filters 只能依赖类的定义，不能依赖采样时间
+    """
+    key = (dialect, incremental, tuple(type(obj) for obj in objs))
+    compiled = _compiled_cache.get(key)
+    if compiled is None:
+        statement = incremental_statement(objs) if incremental else sample_statement(objs)
+        compiled = statement.compile(dialect=dialect)
+        with _compiled_lock:
+            if len(_compiled_cache) >= COMPILED_CACHE_SIZE:
+                _compiled_cache.clear()
+            _compiled_cache[key] = compiled
+    return compiled
+
+
+def sample_statement(objs):
+    """
+    采样语句，时间范围为 start、end 参数：
+    只有一个事件时为 SELECT COUNT(*) ... WHERE 时间范围 AND sample_filters，可以使用过滤列上的索引；
+    多个事件时每个事件对应一列 SUM(CASE WHEN sample_filters ...)，WHERE 中只有时间范围
+    """
+    obj = objs[0]
+    created_time = getattr(obj.model, obj.conf.get('created_time'))
+    window = [created_time >= bindparam('start'), created_time < bindparam('end')]
+    if len(objs) == 1:
+        return _with_timeout(select([func.count()]).select_from(obj.model.__table__).
+                             where(and_(*window, *obj.sample_filters())))
+    return _with_timeout(select(_sample_columns(objs)).where(and_(*window)))
+
+
+def incremental_statement(objs):
+    """
+    主键大于 watermark 参数的行中统计 start、end 范围内的值，
+    最后一列为 created_time < safe 参数的最大主键
+    """
+    obj = objs[0]
+    created_time = getattr(obj.model, obj.conf.get('created_time'))
+    pk = getattr(obj.model, obj.conf.get('primary_key'))
+
+    columns = _sample_columns(objs, created_time >= bindparam('start'),
+                              created_time < bindparam('end'))
+    columns.append(func.max(case([(created_time < bindparam('safe'), pk)])))
+    return _with_timeout(select(columns).where(pk > bindparam('watermark')))
+
+
+def _with_timeout(statement):
+    """MySQL 5.7 以上在服务端限制采样查询的执行时间，超时的查询失败而不是一直占用连接"""
+    if not SAMPLE_STATEMENT_TIMEOUT:
+        return statement
+    return statement.prefix_with(f'/*+ MAX_EXECUTION_TIME({SAMPLE_STATEMENT_TIMEOUT * 1000}) */',
+                                 dialect='mysql')
+
+
+class epoch_minute(FunctionElement):
+    """
+    时间列所在的分钟，为列中的时间距 1970-01-01 00:00:00 的分钟数，
+    按列中保存的时间直接计算，不经过数据库的时区转换
+    """
+    type = Integer()
+    name = 'epoch_minute'
+
+
+@compiles(epoch_minute)
+def _epoch_minute(element, compiler, **kw):
+    return f'FLOOR(EXTRACT(EPOCH FROM {compiler.process(element.clauses, **kw)}) / 60)'
+
+
+@compiles(epoch_minute, 'mysql')
+def _epoch_minute_mysql(element, compiler, **kw):
+    return f"TIMESTAMPDIFF(MINUTE, '1970-01-01 00:00:00', {compiler.process(element.clauses, **kw)})"
+
+
+@compiles(epoch_minute, 'sqlite')
+def _epoch_minute_sqlite(element, compiler, **kw):
+    return f"CAST(strftime('%s', {compiler.process(element.clauses, **kw)}) AS INTEGER) / 60"
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def sample_table_range(objs, start, end):
+    """
+    同一张表的多个事件在 [start, end) 时间范围内按分钟分组统计，
+    用于历史数据回溯，一次查询代替每分钟一次的 sample_table
+    :param start: 时间字符串，与 Base.end 的格式相同
+    :return: {minute: {event_key: value}}，minute 为分钟开始时间字符串，与 t2s 的格式相同，
+             没有数据的分钟不返回
+    """
+    obj = objs[0]
+    created_time = getattr(obj.model, obj.conf.get('created_time'))
+    minute = epoch_minute(created_time).label('minute')
+
+    with _sample_connection(obj, end) as conn:
+        rows = conn.execute(select([minute, *_sample_columns(objs)]).
+                            where(and_(created_time >= s2t(start),
+                                       created_time < s2t(end))).
+                            group_by(minute)).fetchall()
+
+    return {t2s(EPOCH + timedelta(minutes=int(row[0]))):
+            {o.event_key: int(value) for o, value in zip(objs, row[1:])}
+            for row in rows}
+
+
+def _sample_columns(objs, *conditions):
+    return [func.coalesce(func.sum(case([(and_(true(), *conditions, *o.sample_filters()), 1)],
+                                        else_=0)), 0)
+            for o in objs]
+
+
+def group_by_table(objs):
+    """
+    按 schema.table、采样时间列以及 url 分组，同一组的事件合并为一条查询，
+    未声明 sample_filters 的事件单独一组
+    """
+    groups = defaultdict(list)
+    for obj in objs:
+        if obj.sample_filters() is None:
+            groups[obj.event_key].append(obj)
+        else:
+            groups[group_name(obj)].append(obj)
+    return groups
+
+
+def group_name(obj):
+    """
+    分组名称，用于日志以及回溯的 checkpoint：
+    默认为 schema.table，conf 中的 created_time、url 与 TABLE_CONFIG 不同时加上后缀
+    """
+    name = '.'.join([obj.schema, obj.table])
+    default = TABLE_CONFIG.get(name, {})
+    if obj.conf.get('created_time') != default.get('created_time'):
+        name += f"[{obj.conf.get('created_time')}]"
+    if obj.conf.get('url') != default.get('url'):
+        # url 中包含密码，只使用摘要
+        name += f"[{hashlib.sha1(str(obj.conf.get('url')).encode('utf-8')).hexdigest()[:8]}]"
+    return name
+
+
+def fetch_history(objs):
+    """
+    批量获取 objs 的历史数据，结果以 History 赋值给 obj.history。
+    优先使用进程内的 lib.history.store，每个 tick 只需查询新的统计值；
+    未缓存的 event_key 每个 tick 最多加载 HISTORY_WARM_LIMIT 个，
+    其余的相同 timestamp 的事件合并为一次 HTTP 请求，请求中包含多条语句：
+    统计值、线性回归的近期数据以及 MEAN_PERIOD + 3 天同一时刻的数据，
+    每条语句都通过 GROUP BY event_key 一次返回所有事件的数据；
+    lib.baseline 基线表中有的 event_key 直接使用基线值，不再查询同一时刻的数据
+    :param objs: 事件实例
+    :return: {event_key: History}
+    """
+    store.evict()
+
+    groups = defaultdict(list)
+    for obj in objs:
+        groups[obj.timestamp].append(obj)
+
+    histories = {}
+    for timestamp, group in groups.items():
+        means = {}
+        if baseline is not None and MEAN_PERIOD >= 2:
+            # 自定义 least_mean_period 的事件与基线表的计算方式不同
+            means = baseline.lookup([obj.event_key for obj in group
+                                     if obj.least_mean_period == LEAST_MEAN_PERIOD],
+                                    timestamp // 10 ** 9 + 60)
+        histories.update(_load_history(timestamp, [obj.event_key for obj in group], means))
+        for obj in group:
+            obj.history = histories[obj.event_key]
+
+    return histories
+
+
+def _load_history(timestamp, event_keys, means=None):
+    """:param means: 基线表中的 mean_value，{event_key: mean}"""
+    means = means or {}
+    ts = timestamp // 10 ** 9
+    t = ts + 60
+
+    cold = [event_key for event_key in event_keys if not store.synced(event_key, t)]
+    if cold[:HISTORY_WARM_LIMIT]:
+        _warm_history(timestamp, cold[:HISTORY_WARM_LIMIT])
+
+    cached = [event_key for event_key in event_keys if store.synced(event_key, t)]
+    if cached:
+        # 迟到数据、不完整的时间段在 ROLLUP_LATENESS 之内仍可能被重新写入，每次重新读取
+        start = min(t, int(time.time()) - ROLLUP_LATENESS - RESOLUTION)
+        start -= start % RESOLUTION
+        series, = _query_series(cached, [(start, t + 1)])
+        for event_key in cached:
+            store.refresh(event_key, start, t, series.get(event_key, []))
+
+    for event_key in cached:
+        _slide_regression(store.series(event_key), ts)
+
+    histories = {event_key: store.history(event_key, ts) for event_key in cached}
+    rest = [event_key for event_key in event_keys if event_key not in histories]
+    if rest:
+        histories.update(_fetch_history(timestamp, rest, set(means)))
+
+    return {event_key: history._replace(baseline=means.get(event_key))
+            for event_key, history in histories.items()}
+
+
+def _slide_regression(series, ts):
+    """将 series 的回归窗口滑动到 [ts - EXPECT_PERIOD, ts)，通常只移入、移出一个点"""
+    start = ts - EXPECT_PERIOD * 60
+    regression = series.regression
+    if regression is None or regression.end is None or regression.end > ts:
+        regression = series.regression = SlidingRegression()
+        regression.end = start
+
+    regression.expire(start)
+    for t, value in zip(*series.points(max(regression.end, start), ts)):
+        regression.push(t, value)
+    regression.end = ts
+
+
+def _warm_history(timestamp, event_keys):
+    """从 InfluxDB 一次加载 event_keys 整个缓存窗口的数据"""
+    t = timestamp // 10 ** 9 + 60
+    series, = _query_series(event_keys, [(t - store.span, t + 1)])
+    for event_key in event_keys:
+        store.warm(event_key, series.get(event_key, []), t)
+
+
+def _fetch_history(timestamp, event_keys, skip_daily=()):
+    """:param skip_daily: 不需要同一时刻数据的 event_key，即已有基线值的"""
+    ts = timestamp // 10 ** 9
+    t = ts + 60
+    windows = [(t, None), (ts - EXPECT_PERIOD * 60, ts)]
+    daily_windows = []
+    if MEAN_PERIOD >= 2:
+        daily_windows = [(t - (i + 1) * DAY, None)
+                         for i in range(MEAN_PERIOD + Base.least_mean_period)]
+
+    daily_keys = [event_key for event_key in event_keys if event_key not in skip_daily]
+    if len(daily_keys) == len(event_keys):
+        real, recent, *daily = _query_series(event_keys, windows + daily_windows)
+    else:
+        real, recent = _query_series(event_keys, windows)
+        daily = _query_series(daily_keys, daily_windows) if daily_keys and daily_windows else []
+
+    def values(series, event_key):
+        return [value for _, value in series.get(event_key, [])]
+
+    return {event_key: History(real=(values(real, event_key) or [None])[0],
+                               recent=float_array(values(recent, event_key)),
+                               daily=float_array([v for d in daily for v in values(d, event_key)]),
+                               regression=None,
+                               baseline=None)
+            for event_key in event_keys}
+
+
+def choose_tier(span, resolution=RESOLUTION):
+    """
+    在保留时间覆盖 span 的层级中，选择粒度能整除 resolution 的最粗的层级，返回的数据点最少
+    :param span: 最早的数据距现在的时间，单位 s
+    :param resolution: 需要的时间粒度，单位 s
+    :return: Tier，没有这样的层级时返回 None，更粗的层级不能代替，由调用者决定如何处理
+    """
+    covering = [tier for tier in TIERS if tier.retention is None or tier.retention >= span]
+    exact = [tier for tier in covering if resolution % tier.resolution == 0]
+    return exact[-1] if exact else None
+
+
+def _query_series(event_keys, windows, resolution=RESOLUTION, tier=None):
+    """
+    每个时间窗口分别选择层级，由 models.timeseries 的存储合并为一次请求
+    :param windows: [(start, end)]，单位 s，end 为 None 时只查询 start 时刻，
+                    层级的粒度比 resolution 细时按 resolution 汇总，start 需按 resolution 对齐
+    :param tier: 指定层级，默认由 choose_tier 按 start 选择
+    :return: 每个时间窗口对应一个 {event_key: [(time, value)]}，time 单位 s，
+             没有层级能按 resolution 提供的窗口（数据已过期）返回空的结果
+    """
+    t = time.time()
+    tiers = [tier or choose_tier(t - start, resolution) for start, _ in windows]
+    served = [(start, end, tier) for (start, end), tier in zip(windows, tiers) if tier is not None]
+    if len(served) < len(windows):
+        logger.debug(f'{len(windows) - len(served)} windows are older than any {resolution}s tier')
+
+    results = iter(get_backend().read(event_keys, served, resolution) if served else [])
+    return [next(results) if tier is not None else defaultdict(list) for tier in tiers]
+
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: baseline
+@date: 2018/9/5
+
+预先计算的 mean_value 基线表，由 task.baseline 定时生成：
+每个 event_key 一行，每天 288 个 5 分钟时段一列，
+值为该时刻之前 MEAN_PERIOD + 3 天同一时刻数据的 Base.mean，无法计算的为 nan。
+基线表只覆盖 [start, start + 1d)，列按 t % 1d 排列，Monitor 查询时只需一次索引
+"""
+import os
+import logging
+from threading import Lock
+
+import numpy as np
+
+from config.APP import BASELINE_PATH
+from lib.history import RESOLUTION, DAY
+
+logger = logging.getLogger(__name__)
+
+SLOTS = DAY // RESOLUTION
+
+
+class BaselineTable:
+    """
+    基线表保存为 npz 文件（start, event_keys, means），生成时写入临时文件后替换，
+    各 worker 进程在文件变化后重新加载
+    """
+
+    def __init__(self, path=BASELINE_PATH):
+        self.path = path
+        self.start = None
+        self.index = {}
+        self.means = np.empty((0, SLOTS))
+        self._stat = None
+        self._lock = Lock()
+
+    def reload(self):
+        """文件变化时重新加载，:return: 是否有可用的基线表"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.start, self.index, self._stat = None, {}, None
+            return False
+
+        key = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            if key != self._stat:
+                try:
+                    with np.load(self.path) as data:
+                        start = int(data['start'])
+                        event_keys = data['event_keys'].tolist()
+                        means = data['means']
+                except Exception as e:
+                    logger.error(f'Load baseline {self.path} failed: {e}')
+                    return self.start is not None
+
+                self.start = start
+                self.index = {event_key: i for i, event_key in enumerate(event_keys)}
+                self.means = means
+                self._stat = key
+                logger.info(f'Load baseline of {len(event_keys)} event keys from {start}')
+        return True
+
+    def covers(self, t):
+        return self.start is not None and self.start <= t < self.start + DAY \
+            and t % RESOLUTION == 0
+
+    def lookup(self, event_keys, t):
+        """
+        :param t: 单位 s，与 Base.mean_value 使用的时刻一致
+        :return: {event_key: mean}，mean 为 nan 表示历史数据不足，不在基线表中的 event_key 不返回
+        """
+        if not self.reload() or not self.covers(t):
+            return {}
+
+        slot = t % DAY // RESOLUTION
+        index, means = self.index, self.means
+        return {event_key: means[index[event_key], slot].item()
+                for event_key in event_keys if event_key in index}
+
+    def save(self, start, event_keys, means):
+        """
+        :param start: 需按 RESOLUTION 对齐
+        :param means: len(event_keys) x SLOTS 矩阵，第 j 列为 t % 1d == j * 5m 的时刻
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp, start=np.int64(start), event_keys=np.array(event_keys, dtype=str),
+                 means=np.asarray(means, dtype=float))
+        os.replace(tmp, self.path)
+
+
+# BASELINE_PATH 为空时不使用基线表
+baseline = BaselineTable() if BASELINE_PATH else None
@@ -9,7 +9,6 @@
 import logging
 from datetime import timedelta
 
-from models import get_session
 from lib.base import Base
 from util.transfer import s2t, t2s
 
@@ -35,17 +34,8 @@ class CountCashLoanOrder5Min(Base):
     def timestamp(self):
         return self.timestamp_ns(self.start)
 
-    def sample_value(self):
-        url = self.conf.get('url')
-        session = get_session(url, self.schema, autocommit=True)
-        created_time = getattr(self.model, self.conf.get('created_time'))
-
-        value = session.query(self.model). \
-            filter(created_time >= self.start_sample,
-                   created_time < self.end).count()
-
-        session.close()
-        return value
+    def sample_filters(self):
+        return []
 
 
 if __name__ == '__main__':
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: declarative
+@date: 2018/8/30
+
+EventConfig 中声明的事件，不需要编写 Base 子类：
+    table_name: TABLE_CONFIG 中的 schema.table
+    time_column: 可选，采样时间的列，默认为 TABLE_CONFIG 中的 created_time
+    predicates: JSON 格式的过滤条件列表，条件之间为 AND，如
+        [{"column": "apply_type", "op": "in", "value": ["cash_loan", "pay_day_loan"]},
+         {"column": "status", "op": "==", "value": "SUCCESS"}]
+生成的事件类不注册到 lib.registry，与代码中定义的事件一样按表合并查询、缓存编译后的语句
+"""
+import json
+import logging
+import operator
+from datetime import timedelta
+from functools import lru_cache
+
+from config.APP import TABLE_CONFIG
+from lib.base import Base
+from util.transfer import s2t, t2s
+
+logger = logging.getLogger(__name__)
+
+# 已经提示过代码中也有定义的 event_key
+_ignored = set()
+# 已经提示过的无效声明: {event_key: 错误信息}
+_invalid = {}
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda column, value: column.in_(value),
+    'not_in': lambda column, value: column.notin_(value),
+    'like': lambda column, value: column.like(value),
+    'is_null': lambda column, value: column.is_(None),
+    'not_null': lambda column, value: column.isnot(None),
+}
+
+
+def parse_predicates(predicates):
+    """
+    :param predicates: JSON 字符串
+    :return: ((column, op, value), ...)
+    """
+    items = json.loads(predicates) if predicates else []
+    if not isinstance(items, list):
+        raise ValueError(f'predicates must be a list: {predicates}')
+
+    parsed = []
+    for item in items:
+        column, op, value = item.get('column'), item.get('op', '=='), item.get('value')
+        if not column or op not in OPERATORS:
+            raise ValueError(f'Invalid predicate: {item}')
+        if op in ('in', 'not_in') and not isinstance(value, list):
+            raise ValueError(f'Value of {op} must be a list: {item}')
+        parsed.append((column, op, tuple(value) if isinstance(value, list) else value))
+    return tuple(parsed)
+
+
+class DeclarativeEvent(Base):
+    """由 EventConfig 生成的事件类的基类，采样 end-1m ~ end，统计 end-5m ~ end"""
+    __abstract__ = True
+    predicates = ()
+
+    def __init__(self, end: str):
+        end_time = s2t(end).replace(second=0)
+        self.start_sample = t2s(end_time+timedelta(minutes=-1))
+        self.start = t2s(end_time+timedelta(minutes=-5))
+        self.end = t2s(end_time)
+
+    @property
+    def event_key(self):
+        return self._event_key
+
+    @property
+    def timestamp(self):
+        return self.timestamp_ns(self.start)
+
+    def sample_filters(self):
+        return [OPERATORS[op](getattr(self.model, column), value)
+                for column, op, value in self.predicates]
+
+
+@lru_cache(maxsize=4096)
+def make_event_class(event_key, table, time_column=None, predicates=None):
+    """
+    相同的声明返回同一个类，编译后的语句按类缓存，声明修改后生成新的类；
+    生成时反射对应的表，检查 time_column 与 predicates 中的列
+    :raise ValueError: table 不在 TABLE_CONFIG 中、predicates 格式错误或者列不存在
+    """
+    if table not in TABLE_CONFIG:
+        raise ValueError(f'Table {table} is not in TABLE_CONFIG')
+
+    schema, _, name = table.partition('.')
+    attrs = {
+        '__module__': __name__,
+        '__register__': False,
+        '_event_key': event_key,
+        'schema': schema,
+        'table': name,
+        'predicates': parse_predicates(predicates),
+    }
+    if time_column:
+        attrs['conf'] = {'created_time': time_column}
+    cls = type(DeclarativeEvent)(f'DeclarativeEvent[{event_key}]', (DeclarativeEvent,), attrs)
+
+    # sample_filters 在采样时才解析列，不存在的列会使整个分组的采样失败
+    columns = cls.model.__table__.columns
+    missing = [column for column in [cls.conf.get('created_time')] +
+               [column for column, *_ in cls.predicates] if column not in columns]
+    if missing:
+        raise ValueError(f'Columns {missing} are not in {table}')
+    return cls
+
+
+def event_classes(configs, classes=None):
+    """
+    :param configs: EventConfig 的 to_dict 结果
+    :param classes: 代码中定义的事件类，同一个 event_key 优先使用代码中的定义
+    :return: {event_key: 事件类}
+    """
+    classes = dict(classes or {})
+    for config in configs:
+        event_key, table = config['event_key'], config.get('table_name')
+        if not table:
+            continue
+        if event_key in classes:
+            if event_key not in _ignored:
+                _ignored.add(event_key)
+                logger.warning(f'event_key:[{event_key}] is defined in code, spec ignored')
+            continue
+
+        try:
+            classes[event_key] = make_event_class(event_key, table, config.get('time_column'),
+                                                  config.get('predicates'))
+        except Exception as e:
+            # 无效的声明跳过，每分钟都会重试，相同的错误只提示一次
+            if _invalid.get(event_key) != str(e):
+                _invalid[event_key] = str(e)
+                logger.error(f'event_key:[{event_key}] invalid spec: {e}')
+        else:
+            _invalid.pop(event_key, None)
+    return classes
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: history
+@date: 2018/8/8
+"""
+import logging
+from threading import RLock
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from config.APP import (
+    MEAN_PERIOD,
+    EXPECT_PERIOD,
+    HISTORY_MAX_KEYS,
+    HISTORY_IDLE_TIME,
+)
+from util.tools import now
+
+logger = logging.getLogger(__name__)
+
+# real: 统计值，recent: 线性回归使用的近期数据，daily: 历史同一时刻的数据
+# regression: 增量维护的 recent 的线性回归，没有时为 None
+# baseline: lib.baseline 中的 mean_value，nan 表示历史数据不足，不在基线表中时为 None
+History = namedtuple('History', ['real', 'recent', 'daily', 'regression', 'baseline'])
+
+# rp_5_weeks.eventLog 的时间粒度，单位 s
+RESOLUTION = 300
+DAY = 86400
+LEAST_MEAN_PERIOD = 3
+
+
+class Series:
+    """
+    单个 event_key 的环形缓冲区，每 5 分钟一个槽位，
+    覆盖线性回归窗口以及 MEAN_PERIOD + 3 天的同一时刻数据
+    """
+    capacity = (MEAN_PERIOD + LEAST_MEAN_PERIOD + 1) * DAY // RESOLUTION
+
+    def __init__(self):
+        self.times = np.full(self.capacity, -1, dtype=np.int64)
+        self.values = np.full(self.capacity, np.nan)
+        # synced_until 之前的数据与 InfluxDB 一致
+        self.synced_until = -1
+        self.touched = now()
+        # 由 lib.base 维护的 recent 窗口的滑动线性回归
+        self.regression = None
+
+    def index(self, t):
+        return (t // RESOLUTION) % self.capacity
+
+    def put(self, t, value):
+        i = self.index(t)
+        self.times[i] = t
+        self.values[i] = np.nan if value is None else value
+
+    def get(self, t):
+        i = self.index(t)
+        if self.times[i] != t or np.isnan(self.values[i]):
+            return None
+        # 与 InfluxDB 返回的类型一致，整数写入 monitoringLog 时仍为整数字段
+        value = self.values[i].item()
+        return int(value) if value.is_integer() else value
+
+    def points(self, start, end):
+        """[start, end) 时间范围内的数据，按时间排序，:return: (times, values)"""
+        slots = np.arange(start // RESOLUTION, (end - 1) // RESOLUTION + 1)
+        indices = slots % self.capacity
+        times = self.times[indices]
+        values = self.values[indices]
+        mask = (times >= start) & (times < end) & ~np.isnan(values)
+        order = np.argsort(times[mask], kind='mergesort')
+        return times[mask][order], values[mask][order]
+
+    def replace(self, start, end, points):
+        """
+        用 points 替换 [start, end] 时间范围内的数据，没有数据点的时刻记为缺失
+        :return: 是否有数据发生变化
+        """
+        old = {t: self.get(t) for t in range(start, end + 1, RESOLUTION)}
+        new = dict.fromkeys(old)
+        new.update((t, value) for t, value in points if t in new)
+        for t, value in new.items():
+            self.put(t, value)
+        return new != old
+
+    def range(self, start, end):
+        """[start, end) 时间范围内的数据，按时间排序"""
+        return self.points(start, end)[1]
+
+
+class HistoryStore:
+    """
+    worker 进程内的历史数据缓存，real 的时间戳记为 t = timestamp + 1m：
+        real:   t
+        recent: [timestamp - EXPECT_PERIOD, timestamp)
+        daily:  t - 1d, t - 2d, ..., t - (MEAN_PERIOD + 3)d
+    首次使用时从 InfluxDB 一次加载整个窗口（warm），之后 Monitor 每次重新读取
+    迟到数据仍可能修正的最近几个统计值（refresh）；
+    超过 HISTORY_IDLE_TIME 未访问或者超过 HISTORY_MAX_KEYS 的 event_key 被淘汰
+    """
+    span = (MEAN_PERIOD + LEAST_MEAN_PERIOD) * DAY
+
+    def __init__(self, max_keys=HISTORY_MAX_KEYS, idle_time=HISTORY_IDLE_TIME):
+        self.max_keys = max_keys
+        self.idle_time = idle_time
+        self._series = OrderedDict()
+        self._lock = RLock()
+
+    def __contains__(self, event_key):
+        return event_key in self._series
+
+    def series(self, event_key):
+        return self._series.get(event_key)
+
+    def synced(self, event_key, t):
+        """缓存是否覆盖到 t 之前的所有数据，中间缺失的数据需要重新加载"""
+        series = self._series.get(event_key)
+        return series is not None and series.synced_until >= t - RESOLUTION
+
+    def warm(self, event_key, points, t):
+        """
+        使用 InfluxDB 中 [t - span, t] 的数据初始化
+        :param points: [(time, value)]，time 单位 s
+        """
+        series = Series()
+        for time, value in points:
+            series.put(time, value)
+        series.synced_until = t
+
+        with self._lock:
+            self._series[event_key] = series
+            self._series.move_to_end(event_key)
+        self.evict()
+
+    def refresh(self, event_key, start, end, points):
+        """
+        使用 InfluxDB 中 [start, end] 的数据替换缓存，数据有变化时重新计算线性回归
+        :param points: [(time, value)]，time 单位 s
+        """
+        series = self._series.get(event_key)
+        if series is None:
+            return
+
+        if series.replace(start, end, points):
+            series.regression = None
+        series.synced_until = max(series.synced_until, end)
+
+    def history(self, event_key, timestamp):
+        """
+        :param timestamp: 与 Base.timestamp 一致，单位 s
+        :return: History，未缓存时返回 None
+        """
+        series = self._series.get(event_key)
+        if series is None:
+            return None
+
+        series.touched = now()
+        with self._lock:
+            self._series.move_to_end(event_key)
+
+        t = timestamp + 60
+        daily = [series.get(t - (i + 1) * DAY)
+                 for i in range(MEAN_PERIOD + LEAST_MEAN_PERIOD)]
+        return History(real=series.get(t),
+                       recent=series.range(timestamp - EXPECT_PERIOD * 60, timestamp),
+                       daily=np.array([v for v in daily if v is not None], dtype=float),
+                       regression=series.regression,
+                       baseline=None)
+
+    def evict(self):
+        """淘汰长时间未访问的 event_key，以及超出 max_keys 的最久未访问的 event_key"""
+        expired = now() - self.idle_time
+        with self._lock:
+            for event_key in [k for k, s in self._series.items() if s.touched < expired]:
+                del self._series[event_key]
+
+            while len(self._series) > self.max_keys:
+                event_key, _ = self._series.popitem(last=False)
+                logger.info(f'event_key:[{event_key}] evicted from history store')
+
+
+store = HistoryStore()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: registry
+@date: 2018/8/6
+"""
+import logging
+from threading import RLock
+
+from werkzeug.utils import find_modules, import_string
+
+from util.misc import frozendict
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = 'watchdog.events'
+
+
+class EventRegistry:
+    """
+    event_key -> 事件类 的注册表，每个 worker 进程只构建一次。
+    lib.base.Meta 在类定义时自动注册，其它带 _event_key 属性的类
+    可以通过 register 装饰器显式注册。
+    构建完成后调用 freeze 冻结，之后的查询都是普通的 dict 查找。
+    """
+
+    def __init__(self, package='lib', group=ENTRY_POINT_GROUP):
+        self.package = package
+        self.group = group
+        self._classes = {}
+        self._frozen = None
+        self._lock = RLock()
+
+    def register(self, cls):
+        event_key = cls._event_key
+        with self._lock:
+            if self._frozen is not None:
+                raise RuntimeError(f'Registry is frozen, can not register [{event_key}] !')
+
+            registered = self._classes.get(event_key)
+            if registered is not None and registered is not cls:
+                raise ValueError(f'event_key:[{event_key}] is registered by '
+                                 f'{registered.__module__}.{registered.__name__} !')
+            self._classes[event_key] = cls
+        return cls
+
+    def discover(self):
+        """导入 package 下的所有模块，以及通过 entry points 声明的事件类"""
+        for name in find_modules(self.package):
+            import_string(name)
+
+        for entry_point in self._entry_points():
+            try:
+                obj = entry_point.load()
+            except Exception as e:
+                logger.error(f'Load entry point [{entry_point}] failed: {e}')
+                continue
+
+            # entry point 可以指向模块（导入即注册）或者事件类
+            if hasattr(obj, '_event_key') and obj._event_key not in self._classes:
+                self.register(obj)
+
+    def _entry_points(self):
+        if not self.group:
+            return []
+
+        try:
+            from pkg_resources import iter_entry_points
+        except ImportError:
+            return []
+
+        return list(iter_entry_points(self.group))
+
+    def freeze(self):
+        with self._lock:
+            if self._frozen is None:
+                self._frozen = frozendict(self._classes)
+        return self._frozen
+
+    @property
+    def frozen(self):
+        return self._frozen is not None
+
+    def classes(self):
+        """构建并冻结注册表，只在进程内第一次调用时扫描"""
+        if self._frozen is None:
+            with self._lock:
+                if self._frozen is None:
+                    self.discover()
+                    self.freeze()
+                    logger.info(f'{len(self._frozen)} event classes registered')
+        return self._frozen
+
+
+registry = EventRegistry()
+register = registry.register
+get_registry = registry.classes
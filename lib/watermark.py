@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: watermark
+@date: 2018/8/28
+"""
+import os
+import json
+import logging
+from threading import Lock
+
+from config.APP import WATERMARK_PATH
+
+logger = logging.getLogger(__name__)
+
+
+class WatermarkStore:
+    """
+    每张表的主键高水位 (watermark, safe)：created_time < safe 的行的最大主键，safe 为时间戳，单位 s。
+    保存在本地 JSON 文件，多个进程同时写入时可能保留较旧的水位，只会多扫描一些行
+    """
+
+    def __init__(self, path=WATERMARK_PATH):
+        self.path = path
+        self.watermarks = None
+        self._lock = Lock()
+
+    def _load(self):
+        self.watermarks = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.watermarks = {key: tuple(value) for key, value in json.load(f).items()}
+            except Exception as e:
+                logger.error(f'Load watermarks {self.path} failed: {e}')
+
+    def get(self, key):
+        """:return: (watermark, safe) 或者 None"""
+        with self._lock:
+            if self.watermarks is None:
+                self._load()
+            return self.watermarks.get(key)
+
+    def put(self, key, watermark, safe):
+        """只保存更新的水位"""
+        with self._lock:
+            if self.watermarks is None:
+                self._load()
+            old = self.watermarks.get(key)
+            if old and old[1] >= safe:
+                return
+            self.watermarks[key] = (watermark, safe)
+
+            if not self.path:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_file = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.watermarks, f)
+            os.replace(tmp_file, self.path)
+
+
+watermarks = WatermarkStore()
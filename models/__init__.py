@@ -6,43 +6,156 @@
 @module: __init__.py 
 @date: 2018/7/9 
 """
+import os
+import time
+import pickle
+import hashlib
 import logging
+from threading import Lock
 from functools import lru_cache
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.ext.declarative import declarative_base
+
+from config.APP import DB_POOLS, DEFAULT_DB_POOL
 
 
 logger = logging.getLogger(__name__)
+_reflect_lock = Lock()
+# get_db 创建的所有 engine: {(url, name): engine}
+_engines = {}
+
+
+def db_name(url):
+    """不含用户名、密码的数据库标识，用于日志与统计"""
+    u = make_url(url)
+    return f'{u.host}:{u.port or ""}/{u.database}'
+
+
+class TimedQueuePool(QueuePool):
+    """记录取得连接的等待时间与新建连接的耗时，取得连接的时间包括新建连接"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.connects = 0
+        self.total_connect = 0.0
+        self.max_connect = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def _create_connection(self):
+        start = time.monotonic()
+        record = super()._create_connection()
+        elapsed = time.monotonic() - start
+        with self._stats_lock:
+            self.connects += 1
+            self.total_connect += elapsed
+            self.max_connect = max(self.max_connect, elapsed)
+        return record
+
+    def stats(self, reset=False):
+        with self._stats_lock:
+            stats = {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'avg_wait': round(self.total_wait / self.checkouts, 4) if self.checkouts else 0.0,
+                'max_wait': round(self.max_wait, 4),
+                'connects': self.connects,
+                'avg_connect': round(self.total_connect / self.connects, 4) if self.connects else 0.0,
+                'max_connect': round(self.max_connect, 4),
+            }
+            if reset:
+                self.reset_stats()
+        return stats
 
 
 @lru_cache(maxsize=64)
-def get_db(url, name, pool_size=20, pool_recycle=3600):
+def get_db(url, name):
+    """连接池大小按 url 在 DB_POOLS 中配置，未配置的使用 DEFAULT_DB_POOL"""
     logger.info(f'Connecting {name} ...')
-    conn = create_engine(url, pool_size=pool_size, pool_recycle=pool_recycle,
-                         pool_pre_ping=True, encoding='utf-8')
+    conn = create_engine(url, poolclass=TimedQueuePool, pool_pre_ping=True, encoding='utf-8',
+                         **{**DEFAULT_DB_POOL, **DB_POOLS.get(url, {})})
+    _engines[(url, name)] = conn
     logger.info(f'{name} connected')
     # 建立数据路连接
     return conn
 
 
-@lru_cache(maxsize=64)
-def get_base(url, name):
-    logger.info(f'Getting {name} base ...')
-    # 建立数据路连接
-    db = get_db(url, name)
-    Base = automap_base(declarative_base(db), name=name)
-    Base.prepare(db, reflect=True)
-    logger.info(f'{name} base got')
-    return Base
+def pool_stats(reset=False):
+    """:return: {name@db_name: stats}，见 TimedQueuePool.stats"""
+    return {f'{name}@{db_name(url)}': engine.pool.stats(reset)
+            for (url, name), engine in list(_engines.items())
+            if isinstance(engine.pool, TimedQueuePool)}
+
+
+def load_metadata(url, name, table, cache_path=None, version=''):
+    """
+    只反射 table 一张表，结果以 pickle 格式缓存在 cache_path 目录下，
+    文件名由 url 与 version 决定，表结构变更时修改 version 即可
+    """
+    cache_file = None
+    if cache_path:
+        digest = hashlib.sha1(f'{url}#{version}'.encode('utf-8')).hexdigest()[:16]
+        cache_file = os.path.join(cache_path, f'{name}.{table}.{digest}.pickle')
+
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.error(f'Load metadata cache {cache_file} failed: {e}')
+
+    logger.info(f'Reflecting {name}.{table} ...')
+    metadata = MetaData()
+    metadata.reflect(bind=get_db(url, name), only=[table])
+    logger.info(f'{name}.{table} reflected')
+
+    if cache_file:
+        os.makedirs(cache_path, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(metadata, f)
+        os.replace(tmp_file, cache_file)
+
+    return metadata
+
+
+@lru_cache(maxsize=256)
+def get_model(url, name, table, cache_path=None, version=''):
+    """获取单表的 ORM 模型，首次调用时才反射"""
+    with _reflect_lock:
+        metadata = load_metadata(url, name, table, cache_path, version)
+        Base = automap_base(metadata=metadata, name=name)
+        Base.prepare()
+    return getattr(Base.classes, table)
+
+
+@lru_cache(maxsize=128)
+def get_session_factory(url, name, autocommit=False):
+    return sessionmaker(bind=get_db(url, name), autocommit=autocommit)
 
 
 def get_session(url, name, autocommit=False):
-    # 建立数据路连接
-    bind = get_db(url, name)
-    session_factory = sessionmaker(bind=bind, autocommit=autocommit)
-    session = scoped_session(session_factory)
-    sess = session()
-    return sess
\ No newline at end of file
+    """每次返回新的 session，使用完需要 close"""
+    return get_session_factory(url, name, autocommit)()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: archive
+@date: 2018/9/4
+
+不受 retention policy 限制的长期归档：
+每个 event_key 每个粒度一个文件 {ARCHIVE_PATH}/{resolution}/{event_key}.bin，
+文件由定长的 (time int64, value float64) 记录组成，按时间递增排列，缺失的值为 nan，
+读取时用 np.memmap 映射整个文件，按时间二分查找后直接切片，不复制数据
+"""
+import os
+import fcntl
+import logging
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+from config.APP import ARCHIVE_PATH
+
+logger = logging.getLogger(__name__)
+
+RECORD = np.dtype([('time', '<i8'), ('value', '<f8')])
+
+
+class Archive:
+    """
+    write 追加比文件中最后一条记录更新的时间，已有时间的记录原地修正 value（迟到数据），
+    文件中不存在的更早的时间从插入位置起重写文件尾部，保持按时间递增；
+    多个进程同时写入同一个文件时通过 flock 互斥
+    """
+
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+
+    def file(self, resolution, event_key):
+        return os.path.join(self.path, str(resolution), quote(event_key, safe='') + '.bin')
+
+    def event_keys(self, resolution):
+        directory = os.path.join(self.path, str(resolution))
+        if not os.path.isdir(directory):
+            return []
+        return sorted(unquote(name[:-4]) for name in os.listdir(directory) if name.endswith('.bin'))
+
+    def write(self, resolution, event_key, points):
+        """:param points: [(time, value)]，time 单位 s，value 为 None 时记为 nan"""
+        records = np.array([(t, np.nan if v is None else v) for t, v in points], dtype=RECORD)
+        if not len(records):
+            return
+        records = records[np.argsort(records['time'], kind='mergesort')]
+
+        file = self.file(resolution, event_key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # 追加模式下 seek 对写入无效，原地修正需要 r+b
+        with os.fdopen(os.open(file, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._write(f, records)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def write_many(self, resolution, points):
+        """
+        :param points: [(event_key, time, value)]
+        写入失败只记录错误，不影响调用者
+        """
+        series = {}
+        for event_key, t, value in points:
+            series.setdefault(event_key, []).append((t, value))
+
+        for event_key, values in series.items():
+            try:
+                self.write(resolution, event_key, values)
+            except Exception as e:
+                logger.error(f'Archive event_key:[{event_key}] {resolution}s failed: {e}')
+
+    @staticmethod
+    def _write(f, records):
+        size = f.seek(0, os.SEEK_END) // RECORD.itemsize
+        file = np.memmap(f, dtype=RECORD, mode='r', shape=(size,)) if size else np.empty(0, dtype=RECORD)
+        index = np.searchsorted(file['time'], records['time'])
+        found = file['time'][np.minimum(index, max(size - 1, 0))] == records['time'] \
+            if size else np.zeros(len(records), dtype=bool)
+        missing = ~found & (index < size)
+
+        # 文件中间缺少的时间（延后、失败后重试或者回填的分钟），从插入位置起合并后重写文件尾部
+        start = index[missing].min() if missing.any() else size
+        patch = found & (index < start)
+        for i, value in zip(index[patch].tolist(), records['value'][patch].tolist()):
+            f.seek(i * RECORD.itemsize + 8)
+            f.write(np.float64(value).tobytes())
+
+        new = records[index >= start]
+        if not len(new):
+            return
+        if start < size:
+            # 相同时间新写入的记录排在后面，去重时保留
+            new = np.concatenate((np.array(file[start:]), new))
+            new = new[np.argsort(new['time'], kind='mergesort')]
+        del file
+        # 相同时间只保留最后一条
+        keep = np.append(new['time'][1:] != new['time'][:-1], True)
+        f.seek(start * RECORD.itemsize)
+        f.write(new[keep].tobytes())
+        f.truncate()
+
+    def read(self, resolution, event_key, start=None, end=None):
+        """
+        :param start: 单位 s，包含
+        :param end: 单位 s，不包含
+        :return: [start, end) 内的记录，RECORD 类型的 memmap 切片，文件不存在时返回空数组
+        """
+        file = self.file(resolution, event_key)
+        size = os.path.getsize(file) // RECORD.itemsize if os.path.exists(file) else 0
+        if not size:
+            return np.empty(0, dtype=RECORD)
+
+        records = np.memmap(file, dtype=RECORD, mode='r', shape=(size,))
+        i = 0 if start is None else np.searchsorted(records['time'], start)
+        j = size if end is None else np.searchsorted(records['time'], end)
+        return records[i:j]
+
+    def chunks(self, resolution, event_key, start=None, end=None, size=1 << 20):
+        """按 size 条记录分块读取，每块都是 memmap 切片，内存占用与总数据量无关"""
+        records = self.read(resolution, event_key, start, end)
+        for i in range(0, len(records), size):
+            yield records[i:i + size]
+
+
+# ARCHIVE_PATH 为空时不归档
+archive = Archive() if ARCHIVE_PATH else None
@@ -8,7 +8,9 @@
 """
 
 import logging
-from sqlalchemy import Column, String, Float
+from sqlalchemy import Column, String, Float, Text
+
+from config.APP import ACTIVE_EVENT_KEYS
 from models.base import Base
 
 logger = logging.getLogger(__name__)
@@ -23,3 +25,15 @@ class EventConfig(Base):
     threshold_low = Column(Float, comment='报警级别为 low 的阈值')
     threshold_mid = Column(Float, comment='报警级别为 medium 的阈值')
     threshold_high = Column(Float, comment='报警级别为 high 的阈值')
+
+    # 声明式事件，见 lib.declarative
+    table_name = Column(String(100), comment='TABLE_CONFIG 中的 schema.table，为空时使用 lib 中定义的事件类')
+    time_column = Column(String(50), comment='采样时间的列，为空时使用 TABLE_CONFIG 的 created_time')
+    predicates = Column(Text, comment='JSON 格式的过滤条件列表')
+
+
+def get_event_configs(session):
+    """有效的监控配置，ACTIVE_EVENT_KEYS 不为空时只返回其中的 event_key"""
+    cs = session.query(EventConfig).filter(EventConfig.active == True)
+    return [c.to_dict() for c in cs
+            if not ACTIVE_EVENT_KEYS or c.event_key in ACTIVE_EVENT_KEYS]
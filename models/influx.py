@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: influx
+@date: 2018/8/20
+"""
+import os
+import gzip
+import atexit
+import logging
+import calendar
+from numbers import Integral, Real
+from datetime import datetime
+from threading import Lock, Thread, Event
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.DB import INFLUXDB_CONFIG
+from config.APP import (
+    INFLUXDB_DATABASE_NAME,
+    INFLUXDB_FLUSH_SIZE,
+    INFLUXDB_FLUSH_INTERVAL,
+    INFLUXDB_POOL_SIZE,
+    SPOOL_PATH,
+    SPOOL_SEGMENT_SIZE,
+    SPOOL_REPLAY_INTERVAL,
+)
+from models.spool import Spool, Replayer, rejected
+
+logger = logging.getLogger(__name__)
+
+
+def _escape_tag(value):
+    return str(value).replace('\\', '\\\\').replace(' ', '\\ ').\
+        replace(',', '\\,').replace('=', '\\=')
+
+
+def _escape_value(value):
+    """与 influxdb-python 的 line_protocol 保持一致，避免字段类型冲突"""
+    if isinstance(value, str):
+        return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, Integral):
+        return f'{int(value)}i'
+    if isinstance(value, Real):
+        return repr(float(value))
+    return str(value)
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def _timestamp(time, precision='s'):
+    """datetime 或者整数转为 precision 精度的时间戳，没有时区的 datetime 视为 UTC"""
+    if isinstance(time, datetime):
+        seconds = (time.timestamp() if time.tzinfo
+                   else calendar.timegm(time.timetuple()) + time.microsecond / 1e6)
+        return int(seconds * {'s': 1, 'ms': 1e3, 'u': 1e6, 'n': 1e9}[precision])
+    return int(time)
+
+
+def make_line(point, precision='s'):
+    """单个 write_points 格式的数据点转为 line protocol，没有有效字段时返回 None"""
+    tags = ''.join(f',{_escape_tag(k)}={_escape_tag(v)}'
+                   for k, v in sorted(point.get('tags', {}).items()) if v not in (None, ''))
+    fields = ','.join(f'{_escape_tag(k)}={_escape_value(v)}'
+                      for k, v in sorted(point['fields'].items()) if not _is_missing(v))
+    if not fields:
+        return None
+
+    line = f"{_escape_tag(point['measurement'])}{tags} {fields}"
+    if point.get('time') is not None:
+        line += f" {_timestamp(point['time'], precision)}"
+    return line
+
+
+def make_lines(points, precision='s'):
+    return [line for line in (make_line(point, precision) for point in points) if line]
+
+
+class InfluxWriteError(RuntimeError):
+    """InfluxDB 写入返回的状态码不是 204"""
+
+    def __init__(self, status_code, text):
+        super().__init__(f'InfluxDB write error {status_code}: {text}')
+        self.status_code = status_code
+
+
+class InfluxWriter:
+    """
+    进程内共享的 InfluxDB 写入组件：
+    write 只把数据点序列化为 line protocol 放入缓冲区，
+    缓冲区达到 flush_size 或者每隔 flush_interval 秒 gzip 压缩后批量写入，
+    HTTP 连接由 requests.Session 连接池复用，可在多个线程中同时使用。
+    不负责汇总的 worker 进程同步写入采样数据，汇总进程读取之前 flush，见 task.rollup。
+    设置 spool 时，flush 失败的数据点写入本地 spool，由 Replayer 在 InfluxDB 恢复后写回
+    """
+
+    def __init__(self, host='127.0.0.1', port=8086, username='root', password='root',
+                 database=None, ssl=False, flush_size=5000, flush_interval=10,
+                 compress=True, pool_size=10, timeout=30, precision='s', spool=None):
+        scheme = 'https' if ssl else 'http'
+        self.url = f'{scheme}://{host}:{port}/write'
+        self.database = database
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.timeout = timeout
+        self.precision = precision
+        self.spool = spool
+
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(f'{scheme}://', adapter)
+
+        self._buffers = {}
+        self._size = 0
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        self.pid = os.getpid()
+
+    def start(self):
+        if self._thread is None and self.flush_interval:
+            self._thread = Thread(target=self._run, name='influx-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def write(self, points, retention_policy=None, sync=False):
+        """
+        :param points: 与 InfluxDBClient.write_points 相同格式的数据点
+        :param sync: 为 True 时立即按 flush_size 分批写入，失败时抛出异常
+        """
+        lines = make_lines(points, self.precision)
+        if not lines:
+            return
+
+        if sync:
+            for i in range(0, len(lines), self.flush_size):
+                self.post(lines[i:i + self.flush_size], retention_policy)
+            return
+
+        with self._lock:
+            self._buffers.setdefault(retention_policy, []).extend(lines)
+            self._size += len(lines)
+            full = self._size >= self.flush_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """写入缓冲区中的所有数据点，失败时写入 spool 或者记录错误"""
+        with self._flush_lock:
+            with self._lock:
+                buffers, self._buffers, self._size = self._buffers, {}, 0
+
+            for retention_policy, lines in buffers.items():
+                try:
+                    self.post(lines, retention_policy)
+                except Exception as e:
+                    logger.error(f'Write {len(lines)} points to {retention_policy} failed: {e}')
+                    # 4xx 重试也不会成功，不落盘
+                    if self.spool is not None and not rejected(e):
+                        self.spool.append(retention_policy, lines)
+
+    def post(self, lines, retention_policy=None):
+        params = {'db': self.database, 'precision': self.precision}
+        if retention_policy:
+            params['rp'] = retention_policy
+
+        data = '\n'.join(lines).encode('utf-8')
+        headers = {'Content-Type': 'application/octet-stream'}
+        if self.compress:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+
+        response = self.session.post(self.url, params=params, data=data,
+                                     headers=headers, timeout=self.timeout)
+        if response.status_code != 204:
+            raise InfluxWriteError(response.status_code, response.text)
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+        self.session.close()
+
+
+_writer = None
+_writer_lock = Lock()
+
+
+def get_writer():
+    """每个进程一个 InfluxWriter，fork 之后的子进程重新创建"""
+    global _writer
+    if _writer is None or _writer.pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid():
+                spool = Spool(SPOOL_PATH, segment_size=SPOOL_SEGMENT_SIZE) if SPOOL_PATH else None
+                _writer = InfluxWriter(**INFLUXDB_CONFIG, database=INFLUXDB_DATABASE_NAME,
+                                       flush_size=INFLUXDB_FLUSH_SIZE,
+                                       flush_interval=INFLUXDB_FLUSH_INTERVAL,
+                                       pool_size=INFLUXDB_POOL_SIZE, spool=spool).start()
+                atexit.register(_writer.close)
+                if spool is not None:
+                    Replayer(spool, _writer.post, SPOOL_REPLAY_INTERVAL,
+                             INFLUXDB_FLUSH_SIZE).start()
+    return _writer
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: replica
+@date: 2018/8/27
+"""
+import time
+import logging
+from itertools import count
+from threading import Lock
+from functools import lru_cache
+
+from config.APP import REPLICA_CHECK_INTERVAL, REPLICA_LAG_MARGIN
+from models import get_db, db_name
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaLagError(Exception):
+    """所有健康的从库都还没有同步到采样结束时间"""
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.name = db_name(url)
+        self.healthy = False
+        # 最近一次检查时从库已同步到的时间，单位 s
+        self.synced_until = 0.0
+        self.checked_at = 0.0
+        # 查询耗时的指数移动平均，单位 s
+        self.latency = None
+
+    def check(self):
+        """SHOW SLAVE STATUS，复制停止或者连接失败时标记为不健康"""
+        start = time.time()
+        try:
+            row = get_db(self.url, 'replica').execute('SHOW SLAVE STATUS').first()
+        except Exception as e:
+            logger.error(f'Check replica {self.name} failed: {e}')
+            self.healthy = False
+        else:
+            lag = row['Seconds_Behind_Master'] if row else None
+            self.healthy = lag is not None
+            if self.healthy:
+                self.synced_until = start - lag
+            else:
+                logger.error(f'Replica {self.name} is not replicating')
+            self.record(time.time() - start)
+        self.checked_at = start
+
+    def record(self, elapsed):
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+
+class ReplicaSet:
+    """
+    TABLE_CONFIG 中配置了 replicas 的数据库，采样查询优先发送到从库：
+    每 REPLICA_CHECK_INTERVAL 秒检查一次从库的复制状态，
+    只选择已同步到采样结束时间的从库，policy 为 round_robin 或者 least_latency；
+    没有健康的从库时使用主库，有从库但是延迟过大时抛出 ReplicaLagError，
+    由调用者推迟采样，fallback 为 True 时使用主库
+    """
+
+    def __init__(self, primary, replicas, policy='round_robin'):
+        self.primary = primary
+        self.replicas = [Replica(url) for url in replicas]
+        self.policy = policy
+        self._counter = count()
+        self._lock = Lock()
+
+    def refresh(self, until=0.0):
+        """检查超过 REPLICA_CHECK_INTERVAL 未检查的从库，以及检查时间早于 until 的从库"""
+        with self._lock:
+            t = time.time()
+            for replica in self.replicas:
+                if t - replica.checked_at >= REPLICA_CHECK_INTERVAL or replica.checked_at < until:
+                    replica.check()
+
+    def choose(self, end=None, fallback=False):
+        """
+        :param end: 采样结束时间戳，单位 s，从库需同步到 end + REPLICA_LAG_MARGIN
+        :return: url
+        """
+        until = end + REPLICA_LAG_MARGIN if end is not None else 0.0
+        self.refresh(until)
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        candidates = [replica for replica in healthy if replica.synced_until >= until]
+        if not candidates:
+            if healthy and not fallback:
+                raise ReplicaLagError(f'Replicas of {db_name(self.primary)} are behind {end}')
+            return self.primary
+
+        if self.policy == 'least_latency':
+            replica = min(candidates, key=lambda r: r.latency or 0.0)
+        else:
+            replica = candidates[next(self._counter) % len(candidates)]
+        return replica.url
+
+    def record(self, url, elapsed=None, error=None):
+        """记录一次查询，从库出错时标记为不健康，直到下一次检查"""
+        for replica in self.replicas:
+            if replica.url == url:
+                if error is not None:
+                    logger.error(f'Query replica {replica.name} failed: {error}')
+                    replica.healthy = False
+                elif elapsed is not None:
+                    replica.record(elapsed)
+
+
+@lru_cache(maxsize=64)
+def _get_replica_set(primary, replicas, policy):
+    return ReplicaSet(primary, replicas, policy)
+
+
+def get_replica_set(conf):
+    """:return: TABLE_CONFIG 配置了 replicas 时返回 ReplicaSet，否则返回 None"""
+    if not conf.get('replicas'):
+        return None
+    return _get_replica_set(conf['url'], tuple(conf['replicas']),
+                            conf.get('replica_policy', 'round_robin'))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: spool
+@date: 2018/8/22
+"""
+import os
+import glob
+import logging
+from threading import Lock, Thread, Event
+
+from util.tools import now
+
+logger = logging.getLogger(__name__)
+
+
+def series_key(line):
+    """line protocol 中 measurement,tags 与时间戳，InfluxDB 以此判断是否为同一个点"""
+    head, _, rest = line.partition(' ')
+    while head.endswith('\\'):
+        more, _, rest = rest.partition(' ')
+        head = f'{head} {more}'
+    return head, line.rpartition(' ')[2]
+
+
+def rejected(e):
+    """InfluxDB 返回 4xx，如字段类型冲突，重试也不会成功"""
+    return 400 <= (getattr(e, 'status_code', None) or 0) < 500
+
+
+class Spool:
+    """
+    InfluxDB 不可用时的本地落盘队列。
+    每个进程追加写入自己的分段文件（*.open），每行为 "retention_policy<TAB>line protocol"，
+    每次追加后立即 flush，进程崩溃时不丢失；每 fsync_every 行或者每 fsync_interval 秒、
+    以及分段关闭时 fsync 一次，
+    分段文件达到 segment_size 字节或者重放前关闭，重命名为 *.spool。
+    replay 在 InfluxDB 恢复后先把分段重命名为 *-{pid}.replaying 以免多个进程重复处理，
+    批量写回成功后删除；相同 (measurement, event_key, time) 的点在 InfluxDB 中
+    会被覆盖，重复写入是幂等的。
+    InfluxDB 返回 4xx 的批次写入 *.rejected 文件，格式与分段相同，不再重放，其余批次继续写回；
+    返回 5xx 或者连接失败时停止，等待下次重放
+    """
+    suffix = '.spool'
+    open_suffix = '.open'
+    replaying_suffix = '.replaying'
+    rejected_suffix = '.rejected'
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, fsync_every=1000, fsync_interval=1):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+
+        self._file = None
+        # 上一个分段的创建时间，同一毫秒内创建的分段不能同名
+        self._opened_at = 0
+        self._unsynced = 0
+        self._synced_at = now()
+        self._lock = Lock()
+
+    def _open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._opened_at = max(int(now() * 1000), self._opened_at + 1)
+        name = f'{self._opened_at:015d}-{os.getpid()}{self.open_suffix}'
+        self._file = open(os.path.join(self.path, name), 'a', encoding='utf-8')
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = now()
+
+    def append(self, retention_policy, lines):
+        with self._lock:
+            if self._file is None:
+                self._open()
+
+            self._file.write(''.join(f'{retention_policy or ""}\t{line}\n' for line in lines))
+            self._unsynced += len(lines)
+            if (self._unsynced >= self.fsync_every
+                    or now() - self._synced_at >= self.fsync_interval):
+                self._sync()
+            else:
+                self._file.flush()
+
+            if self._file.tell() >= self.segment_size:
+                self._rotate()
+
+        logger.warning(f'{len(lines)} points spooled to {self.path}')
+
+    def _rotate(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            name = self._file.name
+            os.replace(name, name[:-len(self.open_suffix)] + self.suffix)
+            self._file = None
+
+    def _close_orphans(self):
+        """
+        已退出的进程遗留的 *.open 分段，以及重放过程中退出的进程遗留的 *.replaying 分段，
+        文件名中的最后一个 pid 为写入或者重放的进程
+        """
+        for suffix in (self.open_suffix, self.replaying_suffix):
+            for name in glob.glob(os.path.join(self.path, f'*{suffix}')):
+                base, _, pid = name[:-len(suffix)].rpartition('-')
+                if int(pid) == os.getpid():
+                    continue
+                try:
+                    os.kill(int(pid), 0)
+                except ProcessLookupError:
+                    segment = (name[:-len(suffix)] if suffix == self.open_suffix else base) + \
+                        self.suffix
+                    os.replace(name, segment)
+                    if suffix == self.replaying_suffix:
+                        logger.warning(f'Recover spool {segment} from an exited replayer')
+                except PermissionError:
+                    pass
+
+    def segments(self):
+        """已关闭的分段文件，按创建时间排序"""
+        with self._lock:
+            self._rotate()
+        self._close_orphans()
+        return sorted(glob.glob(os.path.join(self.path, f'*{self.suffix}')))
+
+    def __bool__(self):
+        return bool(self._file is not None
+                    or glob.glob(os.path.join(self.path, f'*{self.suffix}'))
+                    or glob.glob(os.path.join(self.path, f'*{self.open_suffix}')))
+
+    @staticmethod
+    def read(segment):
+        """
+        读取分段文件，同一个点只保留最后一次写入
+        :return: {retention_policy: [line]}
+        """
+        points = {}
+        with open(segment, encoding='utf-8') as f:
+            for row in f:
+                retention_policy, _, line = row.rstrip('\n').partition('\t')
+                if line:
+                    points[(retention_policy, series_key(line))] = line
+
+        batches = {}
+        for (retention_policy, _), line in points.items():
+            batches.setdefault(retention_policy or None, []).append(line)
+        return batches
+
+    def replay(self, post, batch_size=5000):
+        """
+        把所有分段写回 InfluxDB，4xx 的批次写入 *.rejected，其它失败时停止，剩余分段等待下次重放
+        :param post: post(lines, retention_policy)，失败时抛出异常，
+                     4xx 的异常需有 status_code 属性
+        :return: 写回的点数
+        """
+        total = 0
+        for segment in self.segments():
+            base = segment[:-len(self.suffix)]
+            replaying = f'{base}-{os.getpid()}{self.replaying_suffix}'
+            try:
+                os.rename(segment, replaying)
+            except FileNotFoundError:
+                # 已被其它进程处理
+                continue
+
+            count = 0
+            try:
+                batches = self.read(replaying)
+                for retention_policy, lines in batches.items():
+                    for i in range(0, len(lines), batch_size):
+                        batch = lines[i:i + batch_size]
+                        try:
+                            post(batch, retention_policy)
+                        except Exception as e:
+                            if not rejected(e):
+                                raise
+                            self.reject(base, retention_policy, batch, e)
+                            continue
+                        count += len(batch)
+            except Exception as e:
+                os.rename(replaying, segment)
+                logger.error(f'Replay spool {segment} failed: {e}')
+                break
+
+            os.remove(replaying)
+            total += count
+            logger.info(f'Replay spool {segment}, {count} points')
+
+        return total
+
+    def reject(self, base, retention_policy, lines, error):
+        with open(base + self.rejected_suffix, 'a', encoding='utf-8') as f:
+            f.write(''.join(f'{retention_policy or ""}\t{line}\n' for line in lines))
+        logger.error(f'{len(lines)} spooled points rejected, kept in '
+                     f'{base + self.rejected_suffix}: {error}')
+
+
+class Replayer:
+    """后台线程，每隔 interval 秒尝试重放 spool"""
+
+    def __init__(self, spool, post, interval=30, batch_size=5000):
+        self.spool = spool
+        self.post = post
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='spool-replayer', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if self.spool:
+                self.spool.replay(self.post, self.batch_size)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: timeseries
+@date: 2018/9/3
+
+时序数据的存储接口，由 TIMESERIES_BACKEND 选择实现：
+    influxdb: InfluxDB，写入由缓冲的 InfluxWriter 完成，读取使用 InfluxQL
+    sqlite: 进程内的 SQLite 文件，不需要 InfluxDB 服务，适合小规模部署与 bench，
+            读取不经过 HTTP 与 JSON 解析
+数据点与 InfluxDBClient.write_points 的格式相同，读取按汇总层级 Tier 进行，时间单位 s
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+from threading import Lock
+from collections import namedtuple, defaultdict
+from abc import ABCMeta, abstractmethod
+from numbers import Real
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+
+from config.DB import INFLUXDB_CONFIG
+from config.APP import (
+    INFLUXDB_DATABASE_NAME,
+    TIMESERIES_BACKEND,
+    TIMESERIES_PATH,
+    RETENTION_POLICIES,
+    ROLLUP_TIERS,
+)
+from models.influx import get_writer, _timestamp
+from util.transfer import duration2s
+
+logger = logging.getLogger(__name__)
+
+# 历史数据的汇总层级，按粒度从细到粗排列，retention 为保留时间，单位 s，None 表示永久保留
+Tier = namedtuple('Tier', ['resolution', 'retention_policy', 'measurement', 'retention'])
+TIERS = sorted((Tier(resolution, retention_policy, measurement,
+                     duration2s(dict(RETENTION_POLICIES)[retention_policy]))
+                for resolution, retention_policy, measurement in ROLLUP_TIERS),
+               key=lambda tier: tier.resolution)
+
+
+class TimeSeriesBackend(metaclass=ABCMeta):
+    """
+    read 的 windows 为 [(start, end, tier)]：
+    end 为 None 时只读取 start 时刻（point read），否则读取 [start, end)（range read）；
+    tier 的粒度比 resolution 细时按 resolution 汇总（rollup），start 需按 resolution 对齐；
+    所有窗口与 event_keys（multi-key read）尽量在一次请求中完成
+    """
+    # 是否支持由存储自身汇总 ROLLUP_TIERS，见 ROLLUP_BY_CQ
+    continuous_queries = False
+
+    @abstractmethod
+    def write(self, points, retention_policy=None, sync=False):
+        """:param sync: 为 True 时写入完成后返回，失败时抛出异常"""
+
+    def flush(self):
+        """写入缓冲区中的数据点"""
+
+    @abstractmethod
+    def read(self, event_keys, windows, resolution):
+        """:return: 每个窗口对应一个 {event_key: [(time, value)]}，按时间排序，不包括没有 value 的点"""
+
+    def read_range(self, event_keys, start, end, tier, resolution=None):
+        return self.read(event_keys, [(start, end, tier)], resolution or tier.resolution)[0]
+
+    def read_point(self, event_keys, t, tier, resolution=None):
+        return self.read(event_keys, [(t, None, tier)], resolution or tier.resolution)[0]
+
+    def rollup(self, event_keys, start, end, tier, resolution):
+        """tier 中 [start, end) 的数据按 resolution 求和"""
+        return self.read(event_keys, [(start, end, tier)], resolution)[0]
+
+    @abstractmethod
+    def last(self, tier, field):
+        """:return: tier 中最新的数据点的 field，没有时返回 None"""
+
+    @abstractmethod
+    def init(self, by_cq=False):
+        """创建数据库、保留策略等，by_cq 为 True 时由存储自身汇总 ROLLUP_TIERS"""
+
+    def close(self):
+        pass
+
+
+def _pattern(event_keys):
+    return '|'.join(re.escape(event_key).replace('/', r'\/') for event_key in event_keys)
+
+
+class InfluxBackend(TimeSeriesBackend):
+    continuous_queries = True
+
+    def __init__(self):
+        self.writer = get_writer()
+        self.client = InfluxDBClient(**INFLUXDB_CONFIG, database=INFLUXDB_DATABASE_NAME)
+
+    def write(self, points, retention_policy=None, sync=False):
+        self.writer.write(points, retention_policy=retention_policy, sync=sync)
+
+    def flush(self):
+        self.writer.flush()
+
+    @staticmethod
+    def statement(event_keys, start, end, tier, resolution):
+        source = f'{tier.retention_policy}.{tier.measurement}'
+        where = f'event_key=~/^({_pattern(event_keys)})$/'
+
+        if tier.resolution >= resolution:
+            condition = f'time={start}s' if end is None else f'time>={start}s AND time<{end}s'
+            return f'SELECT value FROM {source} WHERE {where} AND {condition} GROUP BY event_key'
+
+        end = start + resolution if end is None else end
+        return (f'SELECT sum(value) AS value FROM {source} '
+                f'WHERE {where} AND time>={start}s AND time<{end}s '
+                f'GROUP BY event_key, time({resolution}s) fill(none)')
+
+    def read(self, event_keys, windows, resolution):
+        sqls = [self.statement(event_keys, start, end, tier, resolution)
+                for start, end, tier in windows]
+
+        rets = self.client.query(';'.join(sqls), method='POST', epoch='s')
+        rets = rets if isinstance(rets, list) else [rets]
+
+        results = [defaultdict(list) for _ in rets]
+        for ret, series in zip(rets, results):
+            for (_, tags), points in ret.items():
+                series[tags['event_key']].extend((point['time'], point.get('value'))
+                                                 for point in points)
+        return results
+
+    def last(self, tier, field):
+        ret = self.client.query(f'SELECT last({field}) AS {field} '
+                                f'FROM {tier.retention_policy}.{tier.measurement}', epoch='s')
+        points = list(ret.get_points())
+        return points[0].get(field) if points else None
+
+    @staticmethod
+    def cq_statements(database):
+        """
+        ROLLUP_TIERS 中每一级由前一级汇总的 Continuous Query: [(name, sql)]
+        time 字段使用的是最小的时间
+        比如：某一个分组 [2018-01-01T00:00:00Z, 2018-01-01T00:05:00Z)
+        自动生成的 time = 2018-01-01T00:00:00Z
+        """
+        cqs = []
+        for child, tier in zip(TIERS, TIERS[1:]):
+            name = f'cq_{tier.resolution // 60}_minutes'
+            cqs.append((name, f'CREATE CONTINUOUS QUERY {name} ON {database} BEGIN '
+                              'SELECT sum(value) AS value, last(end_time) AS end_time '
+                              f'INTO {tier.retention_policy}.{tier.measurement} '
+                              f'FROM {child.retention_policy}.{child.measurement} '
+                              f'GROUP BY event_key, time({tier.resolution}s) '
+                              'END'))
+        return cqs
+
+    def init(self, by_cq=False):
+        database = INFLUXDB_DATABASE_NAME
+        client = self.client
+
+        # 创建数据库 watchdog
+        client.create_database(database)
+        # 创建 Retention Policy，第一个为默认保留策略，已存在时按配置修改
+        for i, (name, duration) in enumerate(RETENTION_POLICIES):
+            try:
+                client.create_retention_policy(name, duration, '1',
+                                               database=database, default=i == 0)
+            except InfluxDBClientError:
+                client.alter_retention_policy(name, database=database, duration=duration,
+                                              default=i == 0)
+
+        # 按 ROLLUP_TIERS 重新创建 Continuous Query，汇总在 worker 进程中完成时只删除
+        for name, cq in self.cq_statements(database):
+            try:
+                client.query(f'DROP CONTINUOUS QUERY {name} ON {database}', method='POST')
+            except InfluxDBClientError as e:
+                logger.info(f'Drop {name}: {e}')
+            if by_cq:
+                client.query(cq, method='POST')
+
+    def close(self):
+        self.client.close()
+
+
+class SQLiteBackend(TimeSeriesBackend):
+    """
+    所有数据点保存在一张表中，主键为 (retention_policy, measurement, event_key, time, tags)，
+    相同主键的数据点整体覆盖（InfluxDB 会合并字段）；
+    value 单独存为一列用于读取与汇总，其它字段以 JSON 保存；
+    每隔 expire_interval 秒按 RETENTION_POLICIES 删除过期的数据。
+    多个进程可以同时读写同一个文件
+    """
+    expire_interval = 3600
+    # SQLite 单条语句的参数个数上限为 999
+    chunk_size = 500
+
+    def __init__(self, path=TIMESERIES_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.retentions = {name: duration2s(duration) for name, duration in RETENTION_POLICIES}
+        self.default_retention_policy = RETENTION_POLICIES[0][0]
+        self.expired_at = 0.0
+        self._lock = Lock()
+        self.init()
+
+    def init(self, by_cq=False):
+        if by_cq:
+            logger.warning('SQLite backend does not support continuous queries, '
+                           'rollup in the worker instead')
+        with self._lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS points ('
+                              'retention_policy TEXT NOT NULL, '
+                              'measurement TEXT NOT NULL, '
+                              'event_key TEXT NOT NULL, '
+                              'tags TEXT NOT NULL, '
+                              'time INTEGER NOT NULL, '
+                              'value NUMERIC, '
+                              'fields TEXT NOT NULL, '
+                              'PRIMARY KEY (retention_policy, measurement, event_key, time, tags)'
+                              ') WITHOUT ROWID')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS points_time '
+                              'ON points (retention_policy, measurement, time)')
+
+    @staticmethod
+    def row(point, retention_policy):
+        tags = {k: v for k, v in point.get('tags', {}).items() if v not in (None, '')}
+        fields = {k: v for k, v in point['fields'].items() if v is not None}
+        value = fields.get('value')
+        return (retention_policy, point['measurement'], tags.pop('event_key', ''),
+                json.dumps(tags, sort_keys=True), _timestamp(point['time']),
+                value if isinstance(value, Real) else None,
+                json.dumps(fields, sort_keys=True, default=str))
+
+    def write(self, points, retention_policy=None, sync=False):
+        retention_policy = retention_policy or self.default_retention_policy
+        rows = [self.row(point, retention_policy) for point in points if point.get('fields')]
+        with self._lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  rows)
+        self.expire()
+
+    def expire(self):
+        t = time.time()
+        if t - self.expired_at < self.expire_interval:
+            return
+        self.expired_at = t
+
+        with self._lock, self.conn:
+            for name, retention in self.retentions.items():
+                if retention:
+                    self.conn.execute('DELETE FROM points WHERE retention_policy=? AND time<?',
+                                      (name, int(t - retention)))
+
+    def read(self, event_keys, windows, resolution):
+        results = []
+        with self._lock:
+            for start, end, tier in windows:
+                series = defaultdict(list)
+                for i in range(0, len(event_keys), self.chunk_size):
+                    for event_key, t, value in self.query(event_keys[i:i + self.chunk_size],
+                                                          start, end, tier, resolution):
+                        series[event_key].append((t, value))
+                results.append(series)
+        return results
+
+    def query(self, event_keys, start, end, tier, resolution):
+        keys = ','.join('?' * len(event_keys))
+        where = (f'retention_policy=? AND measurement=? AND event_key IN ({keys}) '
+                 'AND value IS NOT NULL')
+        params = [tier.retention_policy, tier.measurement, *event_keys]
+
+        if tier.resolution >= resolution:
+            if end is None:
+                return self.conn.execute(f'SELECT event_key, time, value FROM points '
+                                         f'WHERE {where} AND time=?', params + [start])
+            return self.conn.execute(f'SELECT event_key, time, value FROM points '
+                                     f'WHERE {where} AND time>=? AND time<? ORDER BY time',
+                                     params + [start, end])
+
+        end = start + resolution if end is None else end
+        return self.conn.execute(f'SELECT event_key, time - time % ? AS t, SUM(value) FROM points '
+                                 f'WHERE {where} AND time>=? AND time<? '
+                                 'GROUP BY event_key, t ORDER BY t',
+                                 [resolution] + params + [start, end])
+
+    def last(self, tier, field):
+        with self._lock:
+            row = self.conn.execute('SELECT fields FROM points '
+                                    'WHERE retention_policy=? AND measurement=? '
+                                    'ORDER BY time DESC LIMIT 1',
+                                    (tier.retention_policy, tier.measurement)).fetchone()
+        return json.loads(row[0]).get(field) if row else None
+
+    def close(self):
+        self.conn.close()
+
+
+BACKENDS = {
+    'influxdb': InfluxBackend,
+    'sqlite': SQLiteBackend,
+}
+
+_backend = None
+_backend_lock = Lock()
+
+
+def get_backend():
+    """每个进程一个 TIMESERIES_BACKEND，fork 之后的子进程重新创建"""
+    global _backend
+    if _backend is None or _backend[1] != os.getpid():
+        with _backend_lock:
+            if _backend is None or _backend[1] != os.getpid():
+                _backend = (BACKENDS[TIMESERIES_BACKEND](), os.getpid())
+    return _backend[0]
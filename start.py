@@ -10,10 +10,15 @@
     python start.py init
     python start.py run --name sample
     python start.py run --name monitor
-    python start.py recall --start '2018-07-10 00:01:00' --end '2018-07-17 18:01:00'
+    python start.py run --name baseline
+    python start.py serve
+    python start.py explain --end '2018-08-29 10:00:00' --fixture sqlite:///fixture.db
+    python start.py export --resolution 300 --start '2018-01-01 00:00:00' --output event.parquet
+    python start.py recall --start '2018-07-10 00:00:00' --end '2018-07-17 18:00:00' --parallelism 4
+    python start.py recall --name monitor --start '2018-07-10 00:00:00' --end '2018-07-17 18:00:00'
 """
+import sys
 import logging
-from concurrent.futures import ThreadPoolExecutor
 
 import click
 from influxdb import InfluxDBClient
@@ -21,13 +26,23 @@ from influxdb import InfluxDBClient
 from config.DB import INFLUXDB_CONFIG
 from config.APP import (
     LOG_PATH,
-    INFLUXDB_DATABASE_NAME
+    INFLUXDB_DATABASE_NAME,
+    RECALL_PARALLELISM,
+    ROLLUP_BY_CQ,
 )
 from util.log import configure_logging;configure_logging(LOG_PATH)
 from util.tools import now_dt
 from util.transfer import t2s, s2t
-from util.misc import TimeSeries
+from models.timeseries import TIERS, get_backend
+from lib.history import RESOLUTION
 from task.workers import async_sampler, async_monitor
+from task.backfill import Backfill
+from task.replay import Replay
+from task import aio
+from task.explain import Explainer
+from task.export import Exporter
+from task.baseline import BaselineBuilder
+from task.rollup import monitor_on_rollup
 
 logger = logging.getLogger('start')
 
@@ -39,26 +54,55 @@ def run_sampler():
 
 
 def run_monitor():
+    if monitor_on_rollup:
+        logger.info('Monitor is triggered by the sampler after each 5 minutes rollup')
+        return
+
     end = get_monitor_time_str()
     if end:
         logger.info(f'Start monitor time: [{end}]')
         async_monitor(end)
 
 
-def recall(start: str, end: str=''):
-    """历史数据回溯"""
-    # --start = '2018-07-10 00:01:00'
-    # --end = '2018-07-17 18:01:00'
+def run_baseline():
+    """生成 Monitor 使用的 mean_value 基线表，见 task.baseline"""
+    BaselineBuilder().run()
+
+
+def recall(start: str, end: str='', parallelism=RECALL_PARALLELISM):
+    """历史数据回溯，每张表每个区间一次查询，见 task.backfill"""
+    # --start = '2018-07-10 00:00:00'
+    # --end = '2018-07-17 18:00:00'
+    start_time = s2t(start).replace(second=0)
+    end_time = s2t(end).replace(second=0) if end else now_dt().replace(second=0)
+    Backfill(start_time, end_time, parallelism=parallelism).run()
+
+
+def replay(start: str, end: str='', parallelism=RECALL_PARALLELISM):
+    """重新计算监控结果，见 task.replay"""
     start_time = s2t(start).replace(second=0)
     end_time = s2t(end).replace(second=0) if end else now_dt().replace(second=0)
-    ts = TimeSeries(start_time, end_time, minutes=1)
-    _map = ThreadPoolExecutor().map
+    Replay(start_time, end_time, parallelism=parallelism).run()
+
 
-    def f(e):
-        ct = e.astimezone()
-        async_sampler(t2s(e), ct)
+def serve():
+    """单进程 asyncio 采样，不经过 celery，需要安装 aiomysql，见 task.aio"""
+    aio.serve(get_monitor_time_str)
 
-    list(_map(f, ts))
+
+def explain(end: str='', event_keys=(), fixture=None):
+    """采样查询的执行计划与索引建议，有全表扫描时返回非 0，见 task.explain"""
+    end = end or t2s(now_dt().replace(second=0))
+    reports = Explainer(end, list(event_keys), fixture).run()
+    if any(report.get('full_scan') or report.get('error') for report in reports):
+        sys.exit(1)
+
+
+def export(output, resolution, event_keys=(), start: str='', end: str=''):
+    """导出长期归档，见 task.export"""
+    Exporter(output, resolution, list(event_keys),
+             int(s2t(start).timestamp()) if start else None,
+             int(s2t(end).timestamp()) if end else None).run()
 
 
 def init_db():
@@ -67,48 +111,14 @@ def init_db():
     from models.event_config import EventConfig
     Meta.metadata.create_all()
 
-    # influxdb 初始化
-    database = INFLUXDB_DATABASE_NAME
-    client = InfluxDBClient(**INFLUXDB_CONFIG, database=database)
-
-    # 创建数据库 watchdog
-    client.create_database(database)
-    # 创建 Retention Policy:
-    # 1. 采样数据保留策略，2w，默认保留策略
-    client.create_retention_policy('rp_2_weeks', '2w', '1',
-                                   database=database, default=True)
-    # 2. 统计数据保留策略，5w
-    client.create_retention_policy('rp_5_weeks', '5w', '1',
-                                   database=database)
-    # 3. 统计数据保留策略，26w
-    client.create_retention_policy('rp_26_weeks', '26w', '1',
-                                   database=database)
-    # 创建 Continuous Query:
-    # time 字段使用的是最小的时间
-    # 比如：某一个分组 [2018-01-01T00:00:00Z, 2018-01-01T00:05:00Z)
-    # 自动生成的 time = 2018-01-01T00:00:00Z
-    cq1 = (f'CREATE CONTINUOUS QUERY cq_5_minutes ON {database} BEGIN '
-           'SELECT sum(value) AS value, last(end_time) AS end_time '
-           'INTO rp_5_weeks.eventLog FROM rp_2_weeks.sampledLog '
-           'GROUP BY event_key, time(5m) '
-           'END')
-
-    client.query(cq1, method='POST')
-    client.close()
+    # 时序数据存储初始化，见 models.timeseries
+    get_backend().init(by_cq=ROLLUP_BY_CQ)
 
 
 def get_monitor_time_str():
     """计算监控时间"""
-    database = INFLUXDB_DATABASE_NAME
-    client = InfluxDBClient(**INFLUXDB_CONFIG, database=database)
-
-    # 获取时间戳
-    sql = 'SELECT time, last(end_time) AS end_time FROM rp_5_weeks.eventLog'
-    ret = client.query(sql, epoch='s')
-    points = list(ret.get_points())
-    client.close()
-
-    time_ts = points[0].get('end_time') if points else None
+    tier = next(tier for tier in TIERS if tier.resolution == RESOLUTION)
+    time_ts = get_backend().last(tier, 'end_time')
     time_str = t2s(s2t(time_ts)) if time_ts else ''
 
     return time_str
@@ -132,18 +142,30 @@ def influxdb_test():
 
 
 @click.command()
-@click.argument('action', default='run', type=click.Choice(['run', 'init', 'recall']))
-@click.option('--name', default='sample', type=click.Choice(['sample', 'monitor']))
+@click.argument('action', default='run', type=click.Choice(['run', 'init', 'recall', 'serve', 'explain', 'export']))
+@click.option('--name', default='sample', type=click.Choice(['sample', 'monitor', 'baseline']))
 @click.option('--start', '-start', default='')
 @click.option('--end', '-end', default='')
-def main(action, name, start, end):
+@click.option('--parallelism', default=RECALL_PARALLELISM, type=int)
+@click.option('--event-key', multiple=True)
+@click.option('--fixture', default=None)
+@click.option('--resolution', default=RESOLUTION, type=int)
+@click.option('--output', default='event.csv')
+def main(action, name, start, end, parallelism, event_key, fixture, resolution, output):
     if action == 'run':
-        fun = run_sampler if name == 'sample' else run_monitor
+        fun = {'sample': run_sampler, 'monitor': run_monitor, 'baseline': run_baseline}[name]
         fun()
     elif action == 'init':
         init_db()
+    elif action == 'serve':
+        serve()
+    elif action == 'explain':
+        explain(end, event_key, fixture)
+    elif action == 'export':
+        export(output, resolution, event_key, start, end)
     elif action == 'recall':
-        recall(start, end)
+        fun = recall if name == 'sample' else replay
+        fun(start, end, parallelism)
     else:
         logger.info('Not existed action !')
 
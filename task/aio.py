@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: aio
+@date: 2018/8/24
+@usage:
+    python start.py serve
+
+单进程的 asyncio 采样引擎，需要安装 aiomysql。
+每分钟的所有采样查询在同一个事件循环中并发执行，使用与 Sampler 相同的 lib 事件定义；
+采样结果的写入（InfluxWriter 缓冲区满时的 HTTP 请求、sqlite 存储、归档文件的 flock）
+以及 Monitor 都放在线程池中执行，不阻塞事件循环
+"""
+import asyncio
+import logging
+from functools import partial
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.dialects.mysql import pymysql
+
+from config.APP import (
+    SAMPLE_DEADLINE,
+    SAMPLE_RETRIES,
+    SAMPLE_ASYNC_CONCURRENCY,
+)
+from util.tools import now, now_dt
+from util.transfer import t2s
+from models import db_name
+from models.replica import get_replica_set
+from lib.base import compiled_statement, window_params, sample_url, incremental
+from task.scheduler import TokenBucket, db_limit
+from lib.declarative import event_classes
+from models.event_config import get_event_configs
+from task.workers import Sampler, Monitor, pop_retries
+from task.rollup import monitor_on_rollup
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncEngine:
+    """
+    每个数据库一个 aiomysql 连接池，连接数与 qps 使用 DB_LIMITS 的配置，
+    所有数据库同时执行的查询数不超过 SAMPLE_ASYNC_CONCURRENCY
+    """
+
+    def __init__(self, loop=None, concurrency=SAMPLE_ASYNC_CONCURRENCY):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is required by the asyncio engine')
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.dialect = pymysql.dialect(paramstyle='pyformat')
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pools = {}
+        self.buckets = {}
+
+    def pool(self, url):
+        """:return: 连接池的 future，同一个 url 只创建一次"""
+        pool = self.pools.get(url)
+        if pool is None:
+            limit = db_limit(url)
+            u = make_url(url)
+            pool = self.pools[url] = asyncio.ensure_future(aiomysql.create_pool(
+                host=u.host, port=u.port or 3306, user=u.username, password=u.password or '',
+                db=u.database, charset=u.query.get('charset', 'utf8'), autocommit=True,
+                minsize=1, maxsize=limit.get('concurrency') or 1, pool_recycle=3600,
+                loop=self.loop))
+            if limit.get('qps'):
+                self.buckets[url] = TokenBucket(limit['qps'])
+        return pool
+
+    async def execute(self, url, compiled, params):
+        """:return: 第一行结果"""
+        pool = await self.pool(url)
+
+        async with self.semaphore:
+            bucket = self.buckets.get(url)
+            wait = bucket.reserve() if bucket else 0
+            while wait:
+                await asyncio.sleep(wait)
+                wait = bucket.reserve()
+
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(compiled.string, compiled.construct_params(params))
+                    return await cursor.fetchone()
+
+    async def sample(self, objs, fallback=False):
+        """与 Sampler.sample 相同，自定义 sample_value 的事件在线程池中执行"""
+        obj = objs[0]
+        if len(objs) == 1 and obj.sample_filters() is None or incremental(obj):
+            # 主键高水位的增量统计需要多次查询，与自定义 sample_value 一样在线程池中执行
+            return await self.loop.run_in_executor(None, Sampler.sample, objs, fallback)
+
+        replicas = get_replica_set(obj.conf)
+        if replicas is None:
+            url = obj.conf['url']
+        else:
+            # 从库状态检查是阻塞的
+            url = await self.loop.run_in_executor(None, sample_url, obj, obj.end, fallback)
+
+        start = now()
+        try:
+            row = await self.execute(url, compiled_statement(objs, self.dialect),
+                                     window_params(obj))
+        except Exception as e:
+            if replicas:
+                replicas.record(url, error=e)
+            raise
+        if replicas:
+            replicas.record(url, now() - start)
+        return {o.event_key: int(value) for o, value in zip(objs, row)}
+
+    async def close(self):
+        for url, pool in self.pools.items():
+            try:
+                pool = await pool
+            except Exception as e:
+                logger.error(f'Connect {db_name(url)} failed: {e}')
+                continue
+            pool.close()
+            await pool.wait_closed()
+
+
+class AsyncSampler(Sampler):
+    """与 Sampler 相同的超时标记、补写与重试规则，查询由 AsyncEngine 执行"""
+
+    def __init__(self, end: str, engine: AsyncEngine, **kwargs):
+        super().__init__(end, **kwargs)
+        self.engine = engine
+        self.tasks = []
+
+    async def start(self):
+        logging.info(f'Start end time at [{self.end}]')
+        loop = self.engine.loop
+
+        configs = await loop.run_in_executor(None, get_event_configs, self.session)
+        self.classes = event_classes(configs, self.classes)
+        event_keys = [config['event_key'] for config in configs]
+        groups = await loop.run_in_executor(None, self.group, event_keys)
+        groups = [(objs, 0) for objs in groups] + pop_retries()
+
+        timed_out = set()
+        writes = []
+
+        def write(fun, *args, **kwargs):
+            writes.append(asyncio.ensure_future(_tick(
+                loop.run_in_executor(None, partial(fun, *args, **kwargs)),
+                f'Write sample [{self.end}]')))
+
+        def done(objs, attempt, task):
+            write(self.collect, objs, attempt, task, late=task in timed_out)
+
+        for objs, attempt in groups:
+            task = asyncio.ensure_future(self.engine.sample(objs, attempt >= SAMPLE_RETRIES))
+            task.add_done_callback(partial(done, objs, attempt))
+            self.tasks.append(task)
+
+        if self.tasks:
+            _, pending = await asyncio.wait(self.tasks, timeout=SAMPLE_DEADLINE)
+            for task, (objs, attempt) in zip(self.tasks, groups):
+                if task in pending:
+                    logger.warning(f'Sample [{objs[0].end}] {[obj.event_key for obj in objs]} '
+                                   f'exceeded {SAMPLE_DEADLINE}s')
+                    timed_out.add(task)
+                    write(self.write_logs, objs[0].end, {
+                        obj.event_key: {"value": self.default, "timed_out": True} for obj in objs})
+
+        # 已完成的分组写入后再汇总，超时的分组之后写入的实际值作为迟到数据修正
+        await asyncio.gather(*writes)
+
+        for monitor_end in await loop.run_in_executor(None, self.close_rollup):
+            asyncio.ensure_future(_tick(loop.run_in_executor(None, _monitor, monitor_end),
+                                        f'Monitor [{monitor_end}]'))
+        self.close()
+        return True
+
+
+async def _tick(coro, name):
+    try:
+        await coro
+    except Exception as e:
+        logger.exception(f'{name} failed: {e}')
+
+
+def _monitor(end):
+    return Monitor(end).start()
+
+
+async def _serve(engine, get_monitor_end):
+    loop = engine.loop
+    last_monitor = None
+    while True:
+        await asyncio.sleep(60 - now() % 60)
+
+        end = t2s(now_dt().replace(second=0))
+        asyncio.ensure_future(_tick(AsyncSampler(end, engine).start(), f'Sampler [{end}]'))
+        if monitor_on_rollup:
+            # Monitor 由 AsyncSampler 写入 5 分钟统计值后触发
+            continue
+
+        monitor_end = await loop.run_in_executor(None, get_monitor_end)
+        if monitor_end and monitor_end != last_monitor:
+            last_monitor = monitor_end
+            asyncio.ensure_future(_tick(
+                loop.run_in_executor(None, _monitor, monitor_end),
+                f'Monitor [{monitor_end}]'))
+
+
+def serve(get_monitor_end):
+    """
+    每分钟采样一次，MONITOR_ON_ROLLUP 为 True 时写入 5 分钟统计值后执行监控，
+    否则 eventLog 有新的 5 分钟统计值时执行监控
+    :param get_monitor_end: 返回监控时间的函数，见 start.get_monitor_time_str
+    """
+    loop = asyncio.get_event_loop()
+    engine = AsyncEngine(loop)
+    try:
+        loop.run_until_complete(_serve(engine, get_monitor_end))
+    finally:
+        loop.run_until_complete(engine.close())
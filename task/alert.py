@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: alert
+@date: 2018/8/17
+"""
+import logging
+
+import numpy as np
+
+from config.APP import MIN_ALERT_VALUE
+from util.error_track import track_error, track_warn
+
+logger = logging.getLogger(__name__)
+
+LEVEL_NONE, LEVEL_LOW, LEVEL_MID, LEVEL_HIGH = range(4)
+
+
+def to_array(values):
+    """None 转为 nan 的 float 数组"""
+    return np.array(values, dtype=float)
+
+
+def evaluate(real, expected, mean, threshold_high, threshold_mid, threshold_low):
+    """
+    一次计算所有 event_key 的报警级别，参数都是长度相同的数组，缺失值为 nan
+    实际值、期望值、平均值缺失时按 0 处理，阈值缺失时不报警
+    :return: 报警级别数组，LEVEL_NONE/LEVEL_LOW/LEVEL_MID/LEVEL_HIGH
+    """
+    real, expected, mean = (np.nan_to_num(to_array(v)) for v in (real, expected, mean))
+    threshold_high, threshold_mid, threshold_low = (
+        to_array(v) for v in (threshold_high, threshold_mid, threshold_low))
+
+    re_delta = expected - real
+    rm_delta = mean - real
+
+    # 有期望值并且 delta 大于一定数值比如 4，才开启报警
+    candidate = (expected != 0) & (re_delta > MIN_ALERT_VALUE) & (rm_delta > MIN_ALERT_VALUE)
+
+    with np.errstate(invalid='ignore'):
+        def exceed(threshold):
+            return (candidate
+                    & (re_delta > np.round(expected * threshold, 2))
+                    & (rm_delta > np.round(mean * threshold, 2)))
+
+        return np.select([exceed(threshold_high), exceed(threshold_mid), exceed(threshold_low)],
+                         [LEVEL_HIGH, LEVEL_MID, LEVEL_LOW], LEVEL_NONE)
+
+
+def format_message(event_key, values, threshold_high, threshold_mid, threshold_low):
+    """只为触发报警的 event_key 生成报警信息"""
+    real_value = values.get('real_value') or 0.0
+    expected_value = values.get('expected_value') or 0.0
+    mean_value = values.get('mean_value') or 0.0
+
+    re_delta = expected_value - real_value
+    rm_delta = mean_value - real_value
+
+    return (f'Event key={event_key} \n'
+            f'Real value={real_value} \n'
+            f'Expected value={expected_value} \n'
+            f'Mean value={mean_value} \n'
+            f'Real-Expected={re_delta} \n'
+            f'Real-Mean={rm_delta} \n'
+            f'Threshold expected high={round(expected_value * threshold_high, 2)} \n'
+            f'Threshold expected mid={round(expected_value * threshold_mid, 2)} \n'
+            f'Threshold expected low={round(expected_value * threshold_low, 2)} \n'
+            f'Threshold mean high={round(mean_value * threshold_high, 2)} \n'
+            f'Threshold mean mid={round(mean_value * threshold_mid, 2)} \n'
+            f'Threshold mean low={round(mean_value * threshold_low, 2)}.')
+
+
+def notify(level, msg):
+    if level == LEVEL_HIGH:
+        track_error(msg)
+    elif level == LEVEL_MID:
+        track_warn(msg)
+    elif level == LEVEL_LOW:
+        logger.info(msg)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: backfill
+@date: 2018/8/13
+"""
+import os
+import json
+import hashlib
+import logging
+from threading import Lock
+from datetime import datetime, timedelta
+
+from config.APP import (
+    DB_URL, DB_NAME,
+    RECALL_CHUNK,
+    RECALL_PARALLELISM,
+    RECALL_CHECKPOINT_PATH,
+    ROLLUP_TIERS,
+)
+from util.transfer import t2s
+from util.misc import TimeSeries
+from models import get_session
+from models.timeseries import get_backend
+from models.event_config import get_event_configs
+from lib.base import sample_table_range, group_by_table
+from lib.registry import get_registry
+from lib.declarative import event_classes
+from task.scheduler import Scheduler
+from task.rollup import Rollup
+
+logger = logging.getLogger(__name__)
+
+# 回溯的对齐粒度，与 rp_5_weeks.eventLog 一致，单位 minute
+EVENT_MINUTES = 5
+
+
+def floor_time(dt: datetime, minutes=EVENT_MINUTES):
+    """按 InfluxDB GROUP BY time(5m) 的方式对齐"""
+    ts = int(dt.timestamp())
+    return datetime.fromtimestamp(ts - ts % (minutes * 60))
+
+
+class Checkpoint:
+    """已完成的回溯单元，保存在本地文件，中断后重新执行相同的命令即可继续"""
+
+    def __init__(self, path, run_id):
+        self.file = os.path.join(path, f'{run_id}.json') if path else None
+        self.done = set()
+        self._lock = Lock()
+
+        if self.file and os.path.exists(self.file):
+            with open(self.file) as f:
+                self.done = set(json.load(f))
+            logger.info(f'Resume from checkpoint {self.file}, {len(self.done)} units done')
+
+    def __contains__(self, unit):
+        return unit in self.done
+
+    def add(self, unit):
+        with self._lock:
+            self.done.add(unit)
+            if not self.file:
+                return
+
+            os.makedirs(os.path.dirname(self.file), exist_ok=True)
+            tmp_file = f'{self.file}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(sorted(self.done), f)
+            os.replace(tmp_file, self.file)
+
+
+class Backfill:
+    """
+    按时间范围回溯采样数据：
+    同一张表的事件在每个 RECALL_CHUNK 分钟的区间内只执行一次按分钟分组的查询，
+    结果批量写入 rp_2_weeks.sampledLog，并由 task.rollup 汇总写入 5m、1h、1d 的统计值，
+    与实时采样的结果一致，跨区间的 1h、1d 统计值在后一个区间完成时从 InfluxDB 补全。
+    开始、结束时间按 5 分钟对齐，每个 (表, 区间) 完成后记录 checkpoint。
+    每个数据库同时执行的查询数不超过 DB_LIMITS 与 parallelism 中较小的一个
+    """
+    # ROLLUP_TIERS 的第一级为 Sampler 写入的分钟数据
+    _, retention_policy, measurement = ROLLUP_TIERS[0]
+
+    def __init__(self, start: datetime, end: datetime,
+                 chunk=RECALL_CHUNK, parallelism=RECALL_PARALLELISM):
+        self.start = floor_time(start)
+        self.end = floor_time(end)
+        self.chunk = max(chunk - chunk % EVENT_MINUTES, EVENT_MINUTES)
+        self.parallelism = parallelism
+        session = get_session(DB_URL, DB_NAME, autocommit=True)
+        try:
+            configs = get_event_configs(session)
+        finally:
+            session.close()
+
+        self.classes = event_classes(configs, get_registry())
+        self.event_keys = sorted(config['event_key'] for config in configs
+                                 if config['event_key'] in self.classes)
+
+        run_id = hashlib.sha1(f'{self.start}|{self.end}|{self.chunk}|'
+                              f'{",".join(self.event_keys)}'.encode('utf-8')).hexdigest()[:16]
+        self.checkpoint = Checkpoint(RECALL_CHECKPOINT_PATH, run_id)
+        self.writer = get_backend()
+        self.rollup = Rollup()
+
+    def units(self):
+        if self.start >= self.end:
+            return
+
+        objs = [self.classes[event_key](t2s(self.end)) for event_key in self.event_keys]
+        for name, group in group_by_table(objs).items():
+            for start in TimeSeries(self.start, self.end, minutes=self.chunk):
+                end = min(start + timedelta(minutes=self.chunk), self.end)
+                yield f'{name}@{t2s(start)}', group, start, end
+
+    def sample(self, objs, start: datetime, end: datetime):
+        """:return: {minute: {event_key: value}}"""
+        if len(objs) > 1 or objs[0].sample_filters() is not None:
+            return sample_table_range(objs, t2s(start), t2s(end))
+
+        # 自定义 sample_value 的事件只能逐分钟采样
+        cls = type(objs[0])
+        values = {}
+        for minute in TimeSeries(start, end, minutes=1):
+            obj = cls(t2s(minute + timedelta(minutes=1)))
+            values[t2s(minute)] = {obj.event_key: obj.sample_value()}
+        return values
+
+    def write(self, objs, values, start: datetime, end: datetime):
+        sampled, points = [], []
+        for minute in TimeSeries(start, end, minutes=1):
+            minute_values = values.get(t2s(minute), {})
+            end_time = t2s(minute + timedelta(minutes=1))
+            t = int(minute.timestamp())
+            for obj in objs:
+                value = minute_values.get(obj.event_key, 0)
+                points.append((obj.event_key, t, value))
+                sampled.append({
+                    "measurement": self.measurement,
+                    "tags": {"event_key": obj.event_key},
+                    "time": minute.astimezone(),
+                    "fields": {"value": value, "end_time": end_time},
+                })
+
+        self.writer.write(sampled, retention_policy=self.retention_policy, sync=True)
+        self.rollup.extend(points)
+        self.rollup.close(int(end.timestamp()))
+
+    def run_unit(self, unit, objs, start: datetime, end: datetime):
+        if unit in self.checkpoint:
+            return
+
+        try:
+            values = self.sample(objs, start, end)
+            self.write(objs, values, start, end)
+        except Exception as e:
+            logger.error(f'Recall [{unit}] failed: {e}')
+            return
+
+        self.checkpoint.add(unit)
+        logger.info(f'Recall [{unit}] ~ [{t2s(end)}] done')
+
+    def run(self):
+        logger.info(f'Recall [{t2s(self.start)}] ~ [{t2s(self.end)}], '
+                    f'{len(self.event_keys)} event keys, parallelism {self.parallelism}')
+
+        scheduler = Scheduler(max_concurrency=self.parallelism)
+        futures = [scheduler.submit(objs[0].conf['url'], self.run_unit, unit, objs, start, end)
+                   for unit, objs, start, end in self.units()]
+        for future in futures:
+            future.result()
+        scheduler.shutdown()
+
+        for name, stats in scheduler.stats().items():
+            logger.info(f'Recall queue [{name}] {stats}')
+        return len(self.checkpoint.done)
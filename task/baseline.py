@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: baseline
+@date: 2018/9/5
+@usage:
+    python start.py run --name baseline
+
+生成 lib.baseline 的基线表，建议每天定时执行一次，例如 crontab:
+    15 0 * * * python start.py run --name baseline
+"""
+import time
+import logging
+
+import numpy as np
+
+from config.APP import (
+    DB_URL, DB_NAME,
+    MEAN_PERIOD,
+    ROLLUP_LATENESS,
+)
+from util.transfer import t2s, ts2t
+from models import get_session
+from models.timeseries import get_backend
+from models.event_config import EventConfig as Config
+from lib.base import mean_values, choose_tier
+from lib.baseline import BaselineTable, baseline, SLOTS
+from lib.history import RESOLUTION, DAY, LEAST_MEAN_PERIOD
+
+logger = logging.getLogger(__name__)
+
+
+class BaselineBuilder:
+    """
+    基线表覆盖 [start, start + 1d)，其中每个时刻需要之前 1 ~ MEAN_PERIOD + 3 天的数据，
+    即一次读取 [start - (MEAN_PERIOD + 3)d, start) 的 5 分钟统计值，
+    重排为 (event_key x 时段) x 天的矩阵后用 mean_values 一次算出。
+    start 默认为迟到数据已不再修正的最近时刻，基线表因此覆盖从现在起约一天
+    """
+    period = MEAN_PERIOD + LEAST_MEAN_PERIOD
+    # 每次读取的 event_key 数量，限制内存占用
+    chunk_size = 500
+
+    def __init__(self, start=None, event_keys=None, table: BaselineTable=baseline):
+        if table is None:
+            raise RuntimeError('BASELINE_PATH is not configured')
+
+        if start is None:
+            start = int(time.time()) - ROLLUP_LATENESS - RESOLUTION
+        self.start = start - start % RESOLUTION
+        self.event_keys = event_keys or self.active_event_keys()
+        self.table = table
+        self.backend = get_backend()
+
+    @staticmethod
+    def active_event_keys():
+        session = get_session(DB_URL, DB_NAME, autocommit=True)
+        try:
+            cs = session.query(Config.event_key).filter(Config.active == True)
+            return [c.event_key for c in cs]
+        finally:
+            session.close()
+
+    def compute(self, event_keys):
+        """:return: len(event_keys) x SLOTS 矩阵，按 t % 1d 排列"""
+        t0 = self.start - self.period * DAY
+        tier = choose_tier(time.time() - t0)
+        if tier is None:
+            raise RuntimeError(f'No {RESOLUTION}s tier keeps data since [{t2s(ts2t(t0))}]')
+        series = self.backend.read_range(event_keys, t0, self.start, tier, RESOLUTION)
+
+        grid = np.full((len(event_keys), self.period * SLOTS), np.nan)
+        for i, event_key in enumerate(event_keys):
+            for t, value in series.get(event_key, []):
+                if value is not None and t % RESOLUTION == 0 and t0 <= t < self.start:
+                    grid[i, (t - t0) // RESOLUTION] = value
+
+        # daily[k, j, d]: 第 k 个 event_key 在 start + j * 5m 之前 period - d 天的数据
+        daily = grid.reshape(len(event_keys), self.period, SLOTS).transpose(0, 2, 1)
+        means = mean_values(daily.reshape(-1, self.period)).reshape(len(event_keys), SLOTS)
+
+        # 第 j 个时段 start + j * 5m 对应的列
+        slots = (self.start + np.arange(SLOTS) * RESOLUTION) % DAY // RESOLUTION
+        table = np.empty_like(means)
+        table[:, slots] = means
+        return table
+
+    def run(self):
+        logger.info(f'Build baseline [{t2s(ts2t(self.start))}] ~ '
+                    f'[{t2s(ts2t(self.start + DAY))}], {len(self.event_keys)} event keys')
+
+        means = [self.compute(self.event_keys[i:i + self.chunk_size])
+                 for i in range(0, len(self.event_keys), self.chunk_size)]
+        self.table.save(self.start, self.event_keys,
+                        np.concatenate(means) if means else np.empty((0, SLOTS)))
+
+        logger.info(f'Baseline of {len(self.event_keys)} event keys saved to {self.table.path}')
+        return len(self.event_keys)
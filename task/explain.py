@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: explain
+@date: 2018/8/29
+@usage:
+    python start.py explain
+    python start.py explain --end '2018-08-29 10:00:00' --fixture sqlite:///fixture.db
+"""
+import time
+import logging
+import operator
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.operators import in_op
+from sqlalchemy.sql.elements import BinaryExpression
+
+from config.APP import DB_URL, DB_NAME
+from util.transfer import s2t
+from models import get_db, get_session, db_name
+from models.event_config import get_event_configs
+from lib.base import (
+    group_by_table,
+    group_name,
+    incremental,
+    sample_url,
+    window_params,
+    sample_statement,
+    incremental_statement,
+)
+from lib.registry import get_registry
+from lib.declarative import event_classes
+from lib.watermark import watermarks
+
+logger = logging.getLogger(__name__)
+
+
+def plan_rows(engine, statement, params):
+    """:return: EXPLAIN 的结果，[{column: value}]，SQLite 使用 EXPLAIN QUERY PLAN"""
+    compiled = statement.compile(dialect=engine.dialect)
+    params = compiled.construct_params(params)
+    if compiled.positional:
+        params = [params[name] for name in compiled.positiontup]
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(prefix + compiled.string, params)
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def analyze(rows):
+    """
+    :return: {'full_scan': bool, 'index': str, 'rows': int}
+    MySQL 的 type 为 ALL（全表扫描）或者 index（全索引扫描）时为 full_scan，
+    SQLite 的 detail 以 SCAN 开头时为 full_scan
+    """
+    if rows and 'detail' in rows[0]:
+        details = [row['detail'] for row in rows]
+        index = [d.split(' INDEX ', 1)[1] for d in details if ' INDEX ' in d]
+        return {'full_scan': any(d.startswith('SCAN') for d in details),
+                'index': ','.join(index) or None,
+                'rows': None}
+
+    return {'full_scan': any(row.get('type') in ('ALL', 'index') for row in rows),
+            'index': ','.join(str(row['key']) for row in rows if row.get('key')) or None,
+            'rows': sum(int(row.get('rows') or 0) for row in rows)}
+
+
+def filter_columns(objs):
+    """:return: (等值条件的列, 其它条件的列)，按出现顺序"""
+    equal, other = [], []
+    for obj in objs:
+        for condition in obj.sample_filters() or []:
+            for element in visitors.iterate(condition, {}):
+                if not isinstance(element, BinaryExpression):
+                    continue
+                name = getattr(element.left, 'name', None)
+                if name is None:
+                    continue
+                columns = equal if element.operator in (operator.eq, in_op) else other
+                if name not in equal and name not in other:
+                    columns.append(name)
+    return equal, [name for name in other if name not in equal]
+
+
+def suggest_index(objs):
+    """
+    单个事件的 COUNT(*) 建议等值条件的列在前、created_time 在后的索引；
+    合并后的采样查询 WHERE 中只有 created_time 范围，其它过滤条件都在 SUM(CASE ...) 中，
+    因此建议以 created_time 开头、包含所有过滤列的覆盖索引，避免回表
+    """
+    obj = objs[0]
+    created_time = obj.conf.get('created_time')
+    equal, other = filter_columns(objs)
+    equal = [c for c in equal if c != created_time]
+    other = [c for c in other if c != created_time]
+    if len(objs) == 1:
+        columns = equal + [created_time] + other
+    else:
+        columns = [created_time] + equal + other
+    name = f"idx_{obj.table}_{'_'.join(columns)}"[:64]
+    return f"CREATE INDEX {name} ON {obj.table} ({', '.join(columns)})"
+
+
+def time_query(engine, statement, params, repeat=3):
+    """:return: 执行 repeat 次的最短耗时，单位 s"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        engine.execute(statement, params).fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class Explainer:
+    """
+    对每个注册的事件按表生成 end 时刻的采样查询，执行 EXPLAIN 并计时，
+    全表扫描的表给出索引建议。指定 fixture 时在 fixture 数据库（SQLite 或者 MySQL）上执行，
+    fixture 中需要有同名的表，可以在发布前发现查询计划的退化
+    """
+
+    def __init__(self, end: str, event_keys=None, fixture=None, repeat=3):
+        self.end = end
+        session = get_session(DB_URL, DB_NAME, autocommit=True)
+        try:
+            configs = get_event_configs(session)
+        finally:
+            session.close()
+
+        self.classes = event_classes(configs, get_registry())
+        self.event_keys = event_keys or sorted(self.classes)
+        self.fixture = create_engine(fixture) if fixture else None
+        self.repeat = repeat
+
+    def statements(self, objs):
+        """:return: [(mode, statement, params)]"""
+        obj = objs[0]
+        statements = [('range', sample_statement(objs), window_params(obj))]
+        if incremental(obj):
+            state = watermarks.get(group_name(obj))
+            statements.append(('incremental', incremental_statement(objs), window_params(
+                obj, watermark=state[0] if state else 0, safe=s2t(obj.start_sample))))
+        return statements
+
+    def engine(self, objs):
+        if self.fixture is not None:
+            return self.fixture
+        obj = objs[0]
+        return get_db(sample_url(obj, obj.end, fallback=True), obj.schema)
+
+    def explain(self, name, objs):
+        reports = []
+        if objs[0].sample_filters() is None:
+            logger.warning(f'[{name}] overrides sample_value, can not explain')
+            return reports
+
+        engine = self.engine(objs)
+        for mode, statement, params in self.statements(objs):
+            report = {'table': name, 'mode': mode, 'db': db_name(str(engine.url)),
+                      'events': [obj.event_key for obj in objs]}
+            try:
+                report['plan'] = plan_rows(engine, statement, params)
+                report.update(analyze(report['plan']))
+                report['time'] = time_query(engine, statement, params, self.repeat)
+            except Exception as e:
+                report['error'] = str(e)
+            if report.get('full_scan') and mode == 'range':
+                report['suggestion'] = suggest_index(objs)
+            reports.append(report)
+        return reports
+
+    def run(self):
+        objs = [self.classes[event_key](self.end)
+                for event_key in self.event_keys if event_key in self.classes]
+
+        reports = []
+        for name, group in sorted(group_by_table(objs).items()):
+            for report in self.explain(name, group):
+                reports.append(report)
+                if 'error' in report:
+                    logger.error(f"[{name}] {report['mode']} on {report['db']} "
+                                 f"failed: {report['error']}")
+                    continue
+
+                logger.info(f"[{name}] {report['mode']} on {report['db']}: "
+                            f"events={len(report['events'])} index={report['index']} "
+                            f"rows={report['rows']} time={report['time'] * 1000:.1f}ms"
+                            f"{' FULL SCAN' if report['full_scan'] else ''}")
+                for row in report['plan']:
+                    logger.info(f'    {row}')
+                if report.get('suggestion'):
+                    logger.warning(f"[{name}] suggested index: {report['suggestion']}")
+
+        return reports
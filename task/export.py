@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: export
+@date: 2018/9/4
+@usage:
+    python start.py export --resolution 300 --output event.csv
+    python start.py export --resolution 3600 --start '2018-01-01 00:00:00' --output event.parquet
+
+把 models.archive 的长期归档导出为 CSV 或者 Parquet（需要安装 pyarrow），
+列为 event_key, time, value，time 为 UTC 时间戳，单位 s
+"""
+import io
+import logging
+
+import numpy as np
+
+from config.APP import EXPORT_CHUNK_SIZE
+from models.archive import archive
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+
+class Exporter:
+    """
+    逐个 event_key 按 EXPORT_CHUNK_SIZE 条记录分块读取 memmap 切片并写入，
+    内存占用只与分块大小有关
+    """
+
+    def __init__(self, output, resolution, event_keys=None, start=None, end=None,
+                 chunk_size=EXPORT_CHUNK_SIZE):
+        if archive is None:
+            raise RuntimeError('ARCHIVE_PATH is not configured')
+
+        self.output = output
+        self.format = 'parquet' if output.endswith('.parquet') else 'csv'
+        if self.format == 'parquet' and pyarrow is None:
+            raise RuntimeError('pyarrow is required to export parquet')
+
+        self.resolution = resolution
+        self.event_keys = event_keys or archive.event_keys(resolution)
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+
+    def chunks(self):
+        """:return: (event_key, records)"""
+        for event_key in self.event_keys:
+            for records in archive.chunks(self.resolution, event_key, self.start, self.end,
+                                          self.chunk_size):
+                yield event_key, records
+
+    def write_csv(self):
+        count = 0
+        with open(self.output, 'w') as f:
+            f.write('event_key,time,value\n')
+            for event_key, records in self.chunks():
+                # savetxt 不能正确处理 fmt 中转义的 %，event_key 在外部拼接
+                key = '"' + event_key.replace('"', '""') + '",'
+                buffer = io.StringIO()
+                np.savetxt(buffer, np.column_stack((records['time'], records['value'])),
+                           fmt='%d,%.17g')
+                f.writelines(key + line for line in buffer.getvalue().splitlines(True))
+                count += len(records)
+        return count
+
+    def write_parquet(self):
+        timestamp = pyarrow.timestamp('s', tz='UTC')
+        schema = pyarrow.schema([('event_key', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+                                 ('time', timestamp),
+                                 ('value', pyarrow.float64())])
+        count = 0
+        writer = pyarrow.parquet.ParquetWriter(self.output, schema)
+        try:
+            for event_key, records in self.chunks():
+                keys = pyarrow.DictionaryArray.from_arrays(
+                    np.zeros(len(records), dtype=np.int32), pyarrow.array([event_key]))
+                times = pyarrow.array(np.ascontiguousarray(records['time']), type=timestamp)
+                values = pyarrow.array(np.ascontiguousarray(records['value']),
+                                       from_pandas=True)
+                writer.write_table(pyarrow.Table.from_arrays([keys, times, values], schema=schema))
+                count += len(records)
+        finally:
+            writer.close()
+        return count
+
+    def run(self):
+        logger.info(f'Export {len(self.event_keys)} event keys of {self.resolution}s '
+                    f'to {self.output}')
+        count = self.write_parquet() if self.format == 'parquet' else self.write_csv()
+        logger.info(f'Export {count} records to {self.output} done')
+        return count
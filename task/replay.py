@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: replay
+@date: 2018/8/15
+"""
+import time
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from config.APP import (
+    DB_URL, DB_NAME,
+    MEAN_PERIOD,
+    EXPECT_PERIOD,
+    RECALL_PARALLELISM,
+)
+from util.transfer import t2s, ts2t
+from models import get_session
+from models.timeseries import TIERS, get_backend
+from models.event_config import EventConfig as Config
+from lib.base import linear_values, mean_values
+from lib.history import RESOLUTION, DAY, LEAST_MEAN_PERIOD
+from task.workers import Monitor
+
+logger = logging.getLogger(__name__)
+
+
+class Replay:
+    """
+    重新计算 [start, end) 范围内每 5 分钟的 rp_26_weeks.monitoringLog：
+    每个 event_key 只读取一次 5 分钟的统计值，
+    real_value, expected_value, mean_value 用 NumPy 一次算出所有时刻，批量写入。
+    与线上 Monitor 一致，对于开始时间为 b 的 5 分钟分组，
+    end = b + 4m，Base.timestamp = end - 5m，统计值取 b 时刻的数据。
+    只读取 5 分钟粒度的层级，超出其保留时间的部分（需要的历史数据已被删除）不重新计算
+    """
+    measurement = Monitor.measurement
+    retention_policy = Monitor.default_retention_policy
+    span = (MEAN_PERIOD + LEAST_MEAN_PERIOD) * DAY + EXPECT_PERIOD * 60 + RESOLUTION
+
+    def __init__(self, start: datetime, end: datetime, parallelism=RECALL_PARALLELISM):
+        self.start = self.align(start)
+        self.end = self.align(end)
+        self.parallelism = parallelism
+
+        # 更粗的层级的值是多个 5 分钟的和，不能代替 5 分钟的统计值
+        self.tier = next(tier for tier in TIERS if tier.resolution == RESOLUTION)
+        if self.tier.retention is not None:
+            earliest = int(time.time()) - self.tier.retention + self.span
+            earliest += -earliest % RESOLUTION
+            if self.start < earliest:
+                logger.error(f'{self.tier.retention_policy}.{self.tier.measurement} only serves '
+                             f'replay from [{t2s(ts2t(earliest))}], '
+                             f'[{t2s(ts2t(self.start))}] ~ [{t2s(ts2t(earliest))}] skipped')
+                self.start = min(earliest, self.end)
+
+        session = get_session(DB_URL, DB_NAME, autocommit=True)
+        try:
+            cs = session.query(Config.event_key).filter(Config.active == True)
+            self.event_keys = [c.event_key for c in cs]
+        finally:
+            session.close()
+
+        self.backend = get_backend()
+
+    @staticmethod
+    def align(dt: datetime):
+        ts = int(dt.timestamp())
+        return ts - ts % RESOLUTION
+
+    def load(self, event_key):
+        """
+        读取 event_key 在 [start - span, end) 的数据
+        :return: (t0, grid)，grid[i] 为 t0 + i * 5m 时刻的值，缺失为 nan
+        """
+        t0 = self.start - self.span
+        t0 -= t0 % RESOLUTION
+        series = self.backend.read_range([event_key], t0, self.end, self.tier, RESOLUTION)
+
+        grid = np.full((self.end - t0) // RESOLUTION, np.nan)
+        for t, value in series.get(event_key, []):
+            if value is not None and t % RESOLUTION == 0:
+                grid[(t - t0) // RESOLUTION] = value
+        return t0, grid
+
+    def compute(self, event_key):
+        """:return: (buckets, real, expected, mean)"""
+        t0, grid = self.load(event_key)
+        buckets = np.arange(self.start, self.end, RESOLUTION)
+        index = (buckets - t0) // RESOLUTION
+
+        # recent: [b - 1m - EXPECT_PERIOD, b - 1m)，即 b 之前的若干个 5 分钟分组
+        offsets = np.arange(-((60 + EXPECT_PERIOD * 60) // RESOLUTION), 0)
+        recent = grid[index[:, None] + offsets[None, :]]
+
+        days = np.arange(1, MEAN_PERIOD + LEAST_MEAN_PERIOD + 1)
+        daily = grid[index[:, None] - days[None, :] * (DAY // RESOLUTION)]
+
+        return buckets, grid[index], linear_values(recent), mean_values(daily)
+
+    def write(self, event_key, buckets, real, expected, mean):
+        points = []
+        for bucket, r, e, m in zip(buckets.tolist(), real.tolist(),
+                                   expected.tolist(), mean.tolist()):
+            end = ts2t(bucket) + timedelta(minutes=4)
+            fields = {
+                'start_time': t2s(end + timedelta(minutes=-5)),
+                'end_time': t2s(end),
+            }
+            # 与 Monitor 写入的字段类型保持一致
+            if not np.isnan(r):
+                fields['real_value'] = int(r) if r.is_integer() else r
+            if not np.isnan(e):
+                fields['expected_value'] = int(e) if e > 0 else 0.0
+            if not np.isnan(m):
+                fields['mean_value'] = int(m)
+
+            points.append({
+                "measurement": self.measurement,
+                "tags": {"event_key": event_key},
+                "time": end.astimezone(),
+                "fields": fields,
+            })
+
+        self.backend.write(points, retention_policy=self.retention_policy, sync=True)
+        return len(points)
+
+    def replay(self, event_key):
+        try:
+            count = self.write(event_key, *self.compute(event_key))
+        except Exception as e:
+            logger.error(f'Replay event_key:[{event_key}] failed: {e}')
+            return 0
+
+        logger.info(f'Replay event_key:[{event_key}] {count} points')
+        return count
+
+    def run(self):
+        logger.info(f'Replay monitor [{t2s(ts2t(self.start))}] ~ [{t2s(ts2t(self.end))}], '
+                    f'{len(self.event_keys)} event keys')
+        if self.start >= self.end:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            total = sum(executor.map(self.replay, self.event_keys))
+
+        return total
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: rollup
+@date: 2018/8/31
+
+进程内的多粒度汇总，代替 InfluxDB 的 cq_5_minutes：
+Sampler 写入的分钟数据同时累加到 ROLLUP_TIERS 中的每一级（5m、1h、1d），
+每次采样结束后写入已结束的时间段，5 分钟的统计值写入后即可执行 Monitor。
+汇总状态只在一个进程内：多个 worker 进程时只有持有 ROLLUP_LOCK_PATH 文件锁的进程汇总，
+其它进程同步写入分钟数据，由汇总进程从存储中补全。
+"""
+import os
+import fcntl
+import logging
+from threading import Lock
+from collections import defaultdict
+
+from config.APP import (
+    ROLLUP_TIERS,
+    ROLLUP_LATENESS,
+    ROLLUP_LOCK_PATH,
+    ROLLUP_BY_CQ,
+    MONITOR_ON_ROLLUP,
+    TIMESERIES_BACKEND,
+)
+from util.transfer import t2s, ts2t
+from models.timeseries import BACKENDS, Tier, get_backend
+from models.archive import archive
+from lib.base import _query_series
+from lib.history import RESOLUTION
+
+logger = logging.getLogger(__name__)
+
+
+def monitor_end(t, resolution=RESOLUTION):
+    """
+    开始时间为 t 的统计值对应的 Monitor 时间，与原 cq_5_minutes 的 end_time 一致，
+    为最后一分钟的开始时间 t + 4m，Monitor(t + 4m) 的 timestamp + 1m 即为 t
+    """
+    return t2s(ts2t(t + resolution - 60))
+
+
+class Bucket:
+    """
+    一个 event_key 在一个时间段内的汇总值，children 为下一级的值: {time: value}，
+    超时、失败或者延后重试的分钟数据为 None；partial 表示写入时数据不完整
+    """
+    __slots__ = ('children', 'written', 'dirty', 'partial')
+
+    def __init__(self):
+        self.children = {}
+        self.written = False
+        self.dirty = False
+        self.partial = False
+
+    @property
+    def value(self):
+        values = [value for value in self.children.values() if value is not None]
+        return sum(values) if values else None
+
+    def complete(self, size):
+        """:param size: 时间段内下一级数据的个数"""
+        return len(self.children) >= size and None not in self.children.values()
+
+
+class Rollup:
+    """
+    ROLLUP_TIERS 的第一级为输入的分钟数据，其后每一级由前一级汇总，时间段按 epoch 对齐，
+    与 InfluxDB GROUP BY time() 一致，time 为开始时间，end_time 为对应的 Monitor 时间：
+    1. add 把分钟数据加入所在的时间段，已写入的时间段收到迟到数据时标记为 dirty；
+    2. close(end) 写入 end 之前结束、尚未写入或者 dirty 的时间段，再把结果加入上一级；
+       缺少下一级数据的时间段（进程重启、其它 worker 进程采样）从 InfluxDB 读取缺少的部分。
+    数据不完整（缺少或者为 None）的时间段等待迟到数据，超过 lateness 秒仍不完整时
+    以 partial 标记写入，value 为空，已有数据的和写入 partial_value，不作为 Monitor 的实际值，
+    上一级也按缺少数据处理。
+    正常情况下每个时间段只写入一次，迟到数据以相同的 time 覆盖之前的值。
+    写入超过 lateness 秒的时间段从内存中移除，之后的迟到数据按缺少数据的方式重新汇总。
+    lock_path 不为空时只有持有该文件锁的进程汇总，见 acquire
+    """
+
+    def __init__(self, tiers=ROLLUP_TIERS, lateness=ROLLUP_LATENESS, lock_path=None):
+        self.tiers = list(tiers)
+        self.lateness = lateness
+        # {resolution: {(event_key, time): Bucket}}，不包括第一级
+        self.buckets = {resolution: {} for resolution, *_ in self.tiers[1:]}
+        self._lock = Lock()
+        self.lock_path = lock_path
+        # (文件, pid)，fork 之后的子进程需要重新获取
+        self._owner = None
+
+    def acquire(self):
+        """
+        :return: 本进程是否负责汇总，lock_path 为空时总是 True；
+        其它进程持有文件锁时返回 False，直到该进程退出后由下一次调用获取
+        """
+        if not self.lock_path:
+            return True
+        if self._owner is not None and self._owner[1] == os.getpid():
+            return True
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_path)), exist_ok=True)
+        f = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._owner = (f, os.getpid())
+        logger.info(f'Rollup is owned by process {os.getpid()}')
+        return True
+
+    def add(self, event_key, t, value):
+        """:param t: 分钟数据的开始时间，单位 s"""
+        self.extend([(event_key, t, value)])
+
+    def extend(self, points):
+        """:param points: [(event_key, t, value)]，在同一次 close 之前全部加入"""
+        with self._lock:
+            for event_key, t, value in points:
+                self._add(1, event_key, t, value)
+
+    def _add(self, level, event_key, t, value):
+        resolution = self.tiers[level][0]
+        key = (event_key, t - t % resolution)
+        bucket = self.buckets[resolution].get(key)
+        if bucket is None:
+            bucket = self.buckets[resolution][key] = Bucket()
+        elif bucket.written and bucket.children.get(t) != value:
+            bucket.dirty = True
+        bucket.children[t] = value
+
+    def close(self, end):
+        """
+        :param end: 采样结束时间，单位 s
+        :return: {resolution: [time]}，所有 event_key 都已写入、且本次有首次写入的时间段，
+                 每个时间段只返回一次
+        """
+        closed = {}
+        with self._lock:
+            for level in range(1, len(self.tiers)):
+                closed[self.tiers[level][0]] = self._close(level, end)
+            self._expire(end)
+        return closed
+
+    def _close(self, level, end):
+        resolution, retention_policy, measurement = self.tiers[level]
+        child = self.tiers[level - 1][0]
+        buckets = {key: bucket for key, bucket in self.buckets[resolution].items()
+                   if key[1] + resolution <= end and (not bucket.written or bucket.dirty)}
+        if not buckets:
+            return []
+
+        size = resolution // child
+        self._fill(level, [key for key, bucket in buckets.items()
+                           if not bucket.complete(size)])
+
+        points, closed, ordered = [], [], []
+        for event_key, t in sorted(buckets, key=lambda key: key[1]):
+            bucket = buckets[(event_key, t)]
+            complete = bucket.complete(size)
+            if not complete and t + resolution + self.lateness > end:
+                # 等待超时分组的实际值、重试或者其它进程写入的数据
+                continue
+
+            if not bucket.written:
+                closed.append(t)
+            value = bucket.value
+            fields = {"value": value, "end_time": monitor_end(t, resolution)}
+            if not complete:
+                fields.update(value=None, partial_value=value, partial=True)
+                logger.warning(f'Rollup {measurement} event_key:[{event_key}] [{t2s(ts2t(t))}] '
+                               f'is partial after {self.lateness}s')
+            elif bucket.partial:
+                fields["partial"] = False
+            bucket.written, bucket.dirty, bucket.partial = True, False, not complete
+            ordered.append((event_key, t))
+            points.append({
+                "measurement": measurement,
+                "tags": {"event_key": event_key},
+                "time": ts2t(t).astimezone(),
+                "fields": fields,
+            })
+            if level + 1 < len(self.tiers):
+                self._add(level + 1, event_key, t, fields["value"])
+
+        if not points:
+            return []
+
+        try:
+            get_backend().write(points, retention_policy=retention_policy, sync=True)
+        except Exception as e:
+            logger.error(f'Write {len(points)} {measurement} points failed: {e}')
+            get_backend().write(points, retention_policy=retention_policy)
+
+        if archive is not None:
+            archive.write_many(resolution, [(point["tags"]["event_key"], t, point["fields"]["value"])
+                                            for (_, t), point in zip(ordered, points)])
+
+        logger.info(f'Rollup {measurement}: {len(closed)} closed, '
+                    f'{len(points) - len(closed)} rewritten')
+        pending = {t for (_, t), bucket in self.buckets[resolution].items() if not bucket.written}
+        return sorted(set(closed) - pending)
+
+    def _fill(self, level, keys):
+        """从 InfluxDB 读取下一级的数据，补全 keys 对应的时间段，内存中已有的值优先"""
+        if not keys:
+            return
+
+        resolution = self.tiers[level][0]
+        child, retention_policy, measurement = self.tiers[level - 1]
+        groups = defaultdict(list)
+        for event_key, t in keys:
+            groups[t].append(event_key)
+
+        # 本进程的分钟数据由缓冲的 writer 写入，读取之前先写入 InfluxDB，其它进程的同步写入
+        get_backend().flush()
+        event_keys = sorted({event_key for event_key, _ in keys})
+        try:
+            results = _query_series(event_keys, [(t, t + resolution) for t in groups], child,
+                                    Tier(child, retention_policy, measurement, None))
+        except Exception as e:
+            logger.error(f'Read {measurement} for rollup failed: {e}')
+            return
+
+        for t, series in zip(groups, results):
+            for event_key in groups[t]:
+                children = self.buckets[resolution][(event_key, t)].children
+                for time, value in series.get(event_key, []):
+                    children.setdefault(time, value)
+
+    def _expire(self, end):
+        for resolution, buckets in self.buckets.items():
+            expired = [key for key, bucket in buckets.items()
+                       if bucket.written and not bucket.dirty
+                       and key[1] + resolution + self.lateness <= end]
+            for key in expired:
+                del buckets[key]
+
+
+# ROLLUP_BY_CQ 为 True 并且存储支持时由存储自身汇总，如 InfluxDB continuous query
+rollup = None if ROLLUP_BY_CQ and BACKENDS[TIMESERIES_BACKEND].continuous_queries \
+    else Rollup(lock_path=ROLLUP_LOCK_PATH)
+# 写入 5 分钟统计值后由 Sampler 触发 Monitor
+monitor_on_rollup = MONITOR_ON_ROLLUP and rollup is not None
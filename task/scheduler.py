@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: scheduler
+@date: 2018/8/23
+"""
+import time
+import logging
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from config.APP import DB_LIMITS, DEFAULT_DB_LIMIT
+from models import db_name
+
+logger = logging.getLogger(__name__)
+
+
+def db_limit(url, limits=None, default=None):
+    """:return: {'concurrency': int, 'qps': int}"""
+    limits = DB_LIMITS if limits is None else limits
+    default = DEFAULT_DB_LIMIT if default is None else default
+    return {**default, **limits.get(url, {})}
+
+
+class TokenBucket:
+    """每秒最多 rate 次，最多累积 burst 次"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self):
+        """取一个令牌，成功时返回 0，否则返回需要等待的秒数"""
+        with self._lock:
+            t = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (t - self.updated) * self.rate)
+            self.updated = t
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        while wait:
+            time.sleep(wait)
+            wait = self.reserve()
+
+
+class DBQueue:
+    """一个数据库的查询队列：固定大小的线程池限制并发，TokenBucket 限制 qps"""
+
+    def __init__(self, name, concurrency, qps=0):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.bucket = TokenBucket(qps) if qps else None
+
+        self.queued = 0
+        self.running = 0
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """返回的 future 在开始执行之前可以 cancel，不再占用队列"""
+        submitted = time.monotonic()
+        with self._lock:
+            self.queued += 1
+        future = self.executor.submit(self._run, submitted, fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    def _run(self, submitted, fn, *args, **kwargs):
+        if self.bucket:
+            self.bucket.acquire()
+
+        wait = time.monotonic() - submitted
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.count += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def stats(self, reset=False):
+        with self._lock:
+            stats = {
+                'queued': self.queued,
+                'running': self.running,
+                'count': self.count,
+                'avg_wait': round(self.total_wait / self.count, 3) if self.count else 0.0,
+                'max_wait': round(self.max_wait, 3),
+            }
+            if reset:
+                self.count, self.total_wait, self.max_wait = 0, 0.0, 0.0
+        return stats
+
+
+class Scheduler:
+    """
+    按 TABLE_CONFIG 中的 url 分组执行查询，每个数据库的并发数与 qps
+    由 DB_LIMITS 配置，未配置的数据库使用 DEFAULT_DB_LIMIT。
+    限制只在本进程内有效，多个 worker 进程时按进程数估算总量
+    """
+
+    def __init__(self, limits=None, default=None, max_concurrency=None):
+        self.limits = DB_LIMITS if limits is None else limits
+        self.default = DEFAULT_DB_LIMIT if default is None else default
+        self.max_concurrency = max_concurrency
+        self.queues = {}
+        self._lock = Lock()
+
+    def queue(self, url):
+        q = self.queues.get(url)
+        if q is None:
+            with self._lock:
+                q = self.queues.get(url)
+                if q is None:
+                    limit = db_limit(url, self.limits, self.default)
+                    concurrency = limit.get('concurrency') or 1
+                    if self.max_concurrency:
+                        concurrency = min(concurrency, self.max_concurrency)
+                    q = self.queues[url] = DBQueue(db_name(url), concurrency, limit.get('qps'))
+        return q
+
+    def submit(self, url, fn, *args, **kwargs):
+        return self.queue(url).submit(fn, *args, **kwargs)
+
+    def stats(self, reset=False):
+        """:return: {db_name: stats}"""
+        return {q.name: q.stats(reset) for q in list(self.queues.values())}
+
+    def shutdown(self, wait=True):
+        for q in list(self.queues.values()):
+            q.executor.shutdown(wait)
+
+
+scheduler = Scheduler()
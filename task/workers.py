@@ -8,25 +8,32 @@
 """
 import logging
 from datetime import timedelta
-from queue import Queue
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError, as_completed
 
-from influxdb import InfluxDBClient
+import numpy as np
 
-from config.DB import INFLUXDB_CONFIG
 from config.APP import (
     LOG_PATH, DB_URL, DB_NAME,
-    ACTIVE_EVENT_KEYS,
-    INFLUXDB_DATABASE_NAME,
-    MIN_ALERT_VALUE
+    SAMPLE_DEADLINE,
+    SAMPLE_RETRIES,
 )
 from util.log import configure_logging;configure_logging(LOG_PATH)
-from util.error_track import track_error, track_warn, track_info
 from util.transfer import s2t
-from util.misc import get_lib_cls
 
-from models import get_session
-from models.event_config import EventConfig as Config
+from models import get_session, pool_stats
+from models.timeseries import get_backend
+from models.event_config import EventConfig as Config, get_event_configs
+from models.replica import ReplicaLagError
+from models.archive import archive
+from lib.base import sample_table, group_by_table, fetch_history
+from lib.registry import get_registry
+from lib.declarative import event_classes
+from lib.history import RESOLUTION
+from task.alert import evaluate, format_message, notify
+from task.scheduler import scheduler
+from task.rollup import rollup, monitor_on_rollup, monitor_end
 from task.app import app, Task
 
 logger = logging.getLogger('workers')
@@ -34,8 +41,30 @@ logger = logging.getLogger('workers')
 executor = ThreadPoolExecutor()
 map_ = executor.map
 
+# 采样失败的分组，在本进程下一次采样时重试: [(objs, attempt)]
+_retries = []
+_retries_lock = Lock()
+
+
+def pop_retries():
+    with _retries_lock:
+        retries = _retries[:]
+        _retries.clear()
+    return retries
+
 
 class Sampler:
+    """
+    每个表分组的采样查询作为一个 future 提交到所在数据库的队列，完成的分组立即写入，
+    超过 SAMPLE_DEADLINE 秒仍未完成的分组先写入 timed_out 标记，查询完成后再补写实际值，
+    此时还在队列中没有开始执行的分组取消，不再占用数据库队列，与查询失败一样重试，
+    执行中的查询由 SAMPLE_STATEMENT_TIMEOUT 在服务端限制；
+    查询失败以及从库延迟过大的分组在本进程下一次采样时重试，最多 SAMPLE_RETRIES 次，
+    最后一次重试时从库仍然延迟则使用主库，仍然失败则写入 failed 标记。
+    采样值同时加入 task.rollup，每次采样结束后写入已结束的 5m、1h、1d 汇总值，
+    分钟数据与汇总值同时写入 models.archive；
+    只有持有 ROLLUP_LOCK_PATH 文件锁的进程汇总，其它进程同步写入分钟数据
+    """
     measurement = 'sampledLog'
     default_retention_policy = 'rp_2_weeks'
 
@@ -46,60 +75,191 @@ class Sampler:
         :param created_time: 数据落库时间
         :param default: 默认值
         """
-        self.classes = get_lib_cls()
+        self.classes = get_registry()
         self.end = end
         self.created_time = created_time
         self.default = default
 
         self.closed = False
-        self.client = InfluxDBClient(**INFLUXDB_CONFIG, database=INFLUXDB_DATABASE_NAME)
+        self.writer = get_backend()
         self.session = get_session(DB_URL, DB_NAME, autocommit=True)
-        self.q = Queue()
-        self.qsize = 0
 
     def __del__(self):
         self.close()
 
-    def sample(self, event_key):
-        cls = self.classes.get(event_key)
-        val = cls(self.end).sample_value() if cls else self.default
-        self.q.put((event_key, {"value": val, "end_time": self.end}))
-
-    def write_logs(self):
-        json_body = []
-
-        for _ in range(self.qsize):
-            event_key, values = self.q.get(timeout=60)
-            body = {
-                "measurement": self.measurement,
-                "tags": {
-                    "event_key": event_key
-                },
-                "fields": values,
-            }
-
-            time_dt = self.created_time or s2t(self.end).astimezone()+timedelta(minutes=-1)
-            time_dt.replace(second=0)
-            body.update(time=time_dt)
-            json_body.append(body)
-
-        self.client.write_points(json_body, time_precision='s',
-                                 retention_policy=self.default_retention_policy)
-        self.client.close()
+    @staticmethod
+    def sample(objs, fallback=False):
+        """
+        同一张表的事件合并为一次查询，未声明 sample_filters 的事件单独采样
+        :param fallback: 从库延迟过大时是否使用主库，最后一次重试时为 True
+        """
+        if len(objs) == 1 and objs[0].sample_filters() is None:
+            return {objs[0].event_key: objs[0].sample_value()}
+        return sample_table(objs, fallback)
+
+    def group(self, event_keys):
+        """按 schema.table 分组，没有对应事件类的 event_key 直接写入默认值"""
+        objs = []
+        missing = {}
+        for event_key in event_keys:
+            cls = self.classes.get(event_key)
+            if not cls:
+                missing[event_key] = {"value": self.default}
+                continue
+            objs.append(cls(self.end))
+
+        if missing:
+            self.write_logs(self.end, missing)
+        return list(group_by_table(objs).values())
+
+    def write_logs(self, end, fields):
+        """
+        :param end: 采样结束时间，重试的分组与本次采样不同
+        :param fields: {event_key: fields}
+        """
+        if end == self.end and self.created_time:
+            time_dt = self.created_time
+        else:
+            time_dt = s2t(end).astimezone()+timedelta(minutes=-1)
+
+        json_body = [{
+            "measurement": self.measurement,
+            "tags": {
+                "event_key": event_key
+            },
+            "time": time_dt,
+            "fields": {**values, "end_time": end},
+        } for event_key, values in fields.items()]
+
+        owner = rollup is not None and rollup.acquire()
+        if rollup is not None and not owner:
+            # 汇总进程从存储中读取本进程采样的分钟数据，不能停留在缓冲区
+            try:
+                self.writer.write(json_body, retention_policy=self.default_retention_policy, sync=True)
+            except Exception as e:
+                logger.error(f'Write sample [{end}] failed: {e}')
+                self.writer.write(json_body, retention_policy=self.default_retention_policy)
+        else:
+            self.writer.write(json_body, retention_policy=self.default_retention_policy)
+
+        # 超时与失败的默认值不是实际值，汇总时按缺少数据处理
+        t = int(s2t(end).timestamp()) - 60
+        points = [(event_key, t, None if values.get("timed_out") or values.get("failed")
+                   else values.get("value"))
+                  for event_key, values in fields.items()]
+        if archive is not None:
+            archive.write_many(60, points)
+        if owner:
+            rollup.extend(points)
+
+    def collect(self, objs, attempt, future, late=False):
+        """
+        写入一个分组的采样结果，失败时加入重试队列，
+        最后一次重试仍然失败时与超时一样写入默认值以及 failed 标记
+        """
+        end = objs[0].end
+        try:
+            values = future.result()
+        except Exception as e:
+            if isinstance(e, ReplicaLagError):
+                logger.info(f'Sample [{end}] {[obj.event_key for obj in objs]} deferred: {e}')
+            elif isinstance(e, CancelledError):
+                logger.warning(f'Sample [{end}] {[obj.event_key for obj in objs]} cancelled '
+                               f'after waiting {SAMPLE_DEADLINE}s in the queue')
+            else:
+                logger.error(f'Sample [{end}] {[obj.event_key for obj in objs]} failed: {e}')
+
+            if attempt < SAMPLE_RETRIES:
+                with _retries_lock:
+                    _retries.append((objs, attempt + 1))
+                if rollup is not None and rollup.acquire():
+                    # 重试之前所在的时间段不完整
+                    t = int(s2t(end).timestamp()) - 60
+                    rollup.extend([(obj.event_key, t, None) for obj in objs])
+            else:
+                logger.warning(f'Sample [{end}] {[obj.event_key for obj in objs]} '
+                               f'gave up after {attempt} retries')
+                self.write_logs(end, {
+                    obj.event_key: {"value": self.default, "failed": True} for obj in objs})
+            return
+
+        fields = {}
+        for event_key, val in values.items():
+            fields[event_key] = {"value": val}
+            if late:
+                # 覆盖之前写入的 timed_out 标记
+                fields[event_key]["timed_out"] = False
+        self.write_logs(end, fields)
 
     def start(self):
         logging.info(f'Start end time at [{self.end}]')
 
-        cs = self.session.query(Config.event_key).filter(Config.active == True)
-        event_keys = [c.event_key for c in cs
-                      if not ACTIVE_EVENT_KEYS or c.event_key in ACTIVE_EVENT_KEYS]
-        self.qsize = len(event_keys)
-
-        list(map_(lambda event_key: self.sample(event_key), event_keys))
-        self.write_logs()
-
+        configs = get_event_configs(self.session)
+        self.classes = event_classes(configs, self.classes)
+        event_keys = [config['event_key'] for config in configs]
+        groups = [(objs, 0) for objs in self.group(event_keys)] + pop_retries()
+
+        futures = {scheduler.submit(objs[0].conf['url'], self.sample,
+                                    objs, attempt >= SAMPLE_RETRIES): (objs, attempt)
+                   for objs, attempt in groups}
+        collected = set()
+        try:
+            for future in as_completed(futures, timeout=SAMPLE_DEADLINE):
+                self.collect(*futures[future], future)
+                collected.add(future)
+        except TimeoutError:
+            pass
+
+        for future, (objs, attempt) in futures.items():
+            if future in collected:
+                continue
+            if future.cancel():
+                # 还没有开始执行，释放数据库队列
+                self.collect(objs, attempt, future)
+                continue
+            if not future.done():
+                logger.warning(f'Sample [{objs[0].end}] {[obj.event_key for obj in objs]} '
+                               f'exceeded {SAMPLE_DEADLINE}s')
+                self.write_logs(objs[0].end, {
+                    obj.event_key: {"value": self.default, "timed_out": True} for obj in objs})
+            future.add_done_callback(partial(self.collect, objs, attempt, late=True))
+
+        self.write_stats()
+        for end in self.close_rollup():
+            async_monitor(end)
         return True
 
+    def close_rollup(self):
+        """
+        写入已结束的汇总时间段，其它进程负责汇总时不写入
+        :return: 本次所有 event_key 都已写入的 5 分钟统计值 b 对应的 Monitor 时间 b + 4m，
+                 通常为 end 结束的时间段，有数据不完整时等待迟到数据
+        """
+        if rollup is None or not rollup.acquire():
+            return []
+        closed = rollup.close(int(s2t(self.end).timestamp()))
+        if not monitor_on_rollup:
+            return []
+        return [monitor_end(t) for t in closed.get(RESOLUTION, ())]
+
+    def write_stats(self):
+        """每个数据库的采样查询排队时间以及连接池状态"""
+        json_body = []
+        for measurement, all_stats in (('schedulerStats', scheduler.stats(reset=True)),
+                                       ('poolStats', pool_stats(reset=True))):
+            for name, stats in all_stats.items():
+                logger.info(f'{measurement} [{name}] {stats}')
+                json_body.append({
+                    "measurement": measurement,
+                    "tags": {
+                        "db": name
+                    },
+                    "time": s2t(self.end).astimezone()+timedelta(minutes=-1),
+                    "fields": stats,
+                })
+
+        self.writer.write(json_body, retention_policy=self.default_retention_policy)
+
     def close(self):
         if not self.closed:
             if self.session:
@@ -111,22 +271,29 @@ class Monitor:
     default_retention_policy = 'rp_26_weeks'
 
     def __init__(self, end: str):
-        self.classes = get_lib_cls()
+        self.classes = get_registry()
         self.end = end
+        self.objs = {}
 
         self.closed = False
-        self.client = InfluxDBClient(**INFLUXDB_CONFIG, database=INFLUXDB_DATABASE_NAME)
+        self.writer = get_backend()
         self.session = get_session(DB_URL, DB_NAME, autocommit=True)
-        self.q = Queue()
-        self.qsize = 0
 
     def __del__(self):
         self.close()
 
+    def load(self, event_keys):
+        """创建事件实例，并批量获取所有事件的历史数据"""
+        for event_key in event_keys:
+            cls = self.classes.get(event_key)
+            if cls:
+                self.objs[event_key] = cls(self.end)
+
+        fetch_history(self.objs.values())
+
     def compute(self, event_key):
-        cls = self.classes.get(event_key)
-        if cls:
-            obj = cls(self.end)
+        obj = self.objs.get(event_key)
+        if obj:
             real_value = obj.real_value()
             expected_values = obj.expect_values()
             start = obj.start
@@ -142,59 +309,25 @@ class Monitor:
             **expected_values,
         }
 
-    def run(self, event_key, threshold_high, threshold_mid, threshold_low,
-            **kwargs):
-        # 根据配置计算结果
-        values = self.compute(event_key)
-
-        # 根据计算结果分析
-        real_value = values.get('real_value') or 0.0
-        expected_value = values.get('expected_value') or 0.0
-        mean_value = values.get('mean_value') or 0.0
-
-        re_delta = expected_value - real_value
-        rm_delta = mean_value - real_value
-
-        # 有期望值并且 delta_abs 大于一定数值比如 4，才开启报警
-        if (expected_value
-                and re_delta > MIN_ALERT_VALUE
-                and rm_delta > MIN_ALERT_VALUE):
-            high_exp = round(expected_value * threshold_high, 2)
-            mid_exp = round(expected_value * threshold_mid, 2)
-            low_exp = round(expected_value * threshold_low, 2)
-
-            high_m = round(mean_value * threshold_high, 2)
-            mid_m = round(mean_value * threshold_mid, 2)
-            low_m = round(mean_value * threshold_low, 2)
-
-            msg = (f'Event key={event_key} \n'
-                   f'Real value={real_value} \n'
-                   f'Expected value={expected_value} \n'
-                   f'Mean value={mean_value} \n'
-                   f'Real-Expected={re_delta} \n'
-                   f'Real-Mean={rm_delta} \n'
-                   f'Threshold expected high={high_exp} \n'
-                   f'Threshold expected mid={mid_exp} \n'
-                   f'Threshold expected low={low_exp} \n'
-                   f'Threshold mean high={high_m} \n'
-                   f'Threshold mean mid={mid_m} \n'
-                   f'Threshold mean low={low_m}.')
-
-            if re_delta > high_exp and rm_delta > high_m:
-                track_error(msg)
-            elif re_delta > mid_exp and rm_delta > mid_m:
-                track_warn(msg)
-            elif re_delta > low_exp and rm_delta > low_m:
-                logger.info(msg)
-
-        # 计算结果写入日志
-        self.q.put((event_key, values))
-
-    def write_logs(self):
+    def alert(self, configs, results):
+        """所有 event_key 的报警级别一次算出，只为触发报警的 event_key 生成信息"""
+        levels = evaluate([values.get('real_value') for values in results],
+                          [values.get('expected_value') for values in results],
+                          [values.get('mean_value') for values in results],
+                          [config['threshold_high'] for config in configs],
+                          [config['threshold_mid'] for config in configs],
+                          [config['threshold_low'] for config in configs])
+
+        for i in np.flatnonzero(levels):
+            config = configs[i]
+            msg = format_message(config['event_key'], results[i], config['threshold_high'],
+                                 config['threshold_mid'], config['threshold_low'])
+            executor.submit(notify, levels[i], msg)
+
+    def write_logs(self, event_keys, results):
         json_body = []
 
-        for _ in range(self.qsize):
-            event_key, values = self.q.get()
+        for event_key, values in zip(event_keys, results):
             body = {
                 "measurement": self.measurement,
                 "tags": {
@@ -205,19 +338,23 @@ class Monitor:
             }
             json_body.append(body)
 
-        self.client.write_points(json_body, time_precision='s',
-                                 retention_policy=self.default_retention_policy)
-        self.client.close()
+        self.writer.write(json_body, retention_policy=self.default_retention_policy)
 
     def start(self):
         logging.info(f'Start end time at [{self.end}]')
 
         cs = self.session.query(Config).filter(Config.active == True)
         configs = [c.to_dict() for c in cs]
-        self.qsize = len(configs)
+        event_keys = [config['event_key'] for config in configs]
+        self.classes = event_classes(configs, self.classes)
+        self.load(event_keys)
 
-        list(map_(lambda config: self.run(**config), configs))
-        self.write_logs()
+        # 根据配置计算结果并分析
+        results = list(map_(self.compute, event_keys))
+        self.alert(configs, results)
+
+        # 计算结果写入日志
+        self.write_logs(event_keys, results)
 
         return True
 
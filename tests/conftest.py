@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: conftest
+@date: 2018/9/6
+
+测试使用 config 目录下的 *.py.default 配置，不读取本地的 config/APP.py 与 config/DB.py：
+数据库为临时目录中的 sqlite，时序数据使用 sqlite 存储，不需要 MySQL 与 InfluxDB
+"""
+import os
+import sys
+import types
+import shutil
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.mkdtemp(prefix='watchdog-test-')
+
+# 采样查询在线程池中执行，sqlite 连接需要允许跨线程使用
+DB_OVERRIDES = f'''
+STATISTICS_URL = 'sqlite:///{TMP}/statistics.db'
+V2_URL = 'sqlite:///{TMP}/v2.db?check_same_thread=false'
+RISK_URL = 'sqlite:///{TMP}/risk.db'
+'''
+
+APP_OVERRIDES = f'''
+LOG_PATH = {TMP!r}
+TIMESERIES_BACKEND = 'sqlite'
+TIMESERIES_PATH = {os.path.join(TMP, 'timeseries.db')!r}
+SPOOL_PATH = ''
+ARCHIVE_PATH = ''
+BASELINE_PATH = ''
+METADATA_CACHE_PATH = ''
+RECALL_CHECKPOINT_PATH = {os.path.join(TMP, 'recall')!r}
+WATERMARK_PATH = ''
+ACTIVE_EVENT_KEYS = set()
+'''
+
+
+def load_config(name, overrides):
+    """执行 config/{name}.py.default 以及 overrides，作为 config.{name} 模块"""
+    import config
+
+    file = os.path.join(ROOT, 'config', f'{name}.py.default')
+    module = types.ModuleType(f'config.{name}')
+    module.__file__ = file
+    with open(file, encoding='utf-8') as f:
+        code = f.read() + overrides
+    sys.modules[module.__name__] = module
+    exec(compile(code, file, 'exec'), module.__dict__)
+    setattr(config, name, module)
+
+
+sys.path.insert(0, ROOT)
+load_config('DB', DB_OVERRIDES)
+load_config('APP', APP_OVERRIDES)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TMP, ignore_errors=True)
+
+
+@pytest.fixture
+def v2():
+    """v2 库的 sqlite 引擎，测试结束后删除所有表"""
+    from config.DB import V2_URL
+    from models import get_db
+
+    engine = get_db(V2_URL, 'v2')
+    yield engine
+    with engine.connect() as conn:
+        for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+            conn.execute(f'DROP TABLE "{table}"')
+
+
+@pytest.fixture
+def backend():
+    """每个测试使用空的 sqlite 时序数据存储"""
+    from models.timeseries import get_backend
+
+    backend = get_backend()
+    with backend.conn:
+        backend.conn.execute('DELETE FROM points')
+    yield backend
+
+
+def make_event_class(event_key, status, **conf):
+    """
+    v2.Order 上 status == status 的声明式事件类，不注册到 lib.registry，
+    conf 中未指定的配置使用 TABLE_CONFIG
+    """
+    from lib.declarative import DeclarativeEvent
+
+    return type(DeclarativeEvent)(f'Test[{event_key}]', (DeclarativeEvent,), {
+        '__module__': __name__,
+        '__register__': False,
+        '_event_key': event_key,
+        'schema': 'v2',
+        'table': 'Order',
+        'predicates': (('status', '==', status),),
+        'conf': conf,
+    })
+
+
+@pytest.fixture
+def event_class():
+    """:return: make_event_class"""
+    return make_event_class
+
+
+@pytest.fixture
+def orders(v2):
+    """v2 库中空的 "Order" 表，:return: sqlalchemy Table"""
+    from sqlalchemy import MetaData, Table
+
+    v2.execute('CREATE TABLE "Order" (id INTEGER PRIMARY KEY, created_time DATETIME, '
+               'updated_time DATETIME, status VARCHAR(20))')
+    return Table('Order', MetaData(bind=v2), autoload=True)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_archive
+@date: 2018/9/6
+"""
+import math
+
+import pytest
+
+from models.archive import Archive
+
+KEY = 'archive_event'
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return Archive(str(tmp_path))
+
+
+def values(archive, start=None, end=None):
+    return [(t, None if math.isnan(v) else v)
+            for t, v in archive.read(60, KEY, start, end).tolist()]
+
+
+def test_insert_before_last(archive):
+    """t1 延后写入时 t2 已经在文件末尾"""
+    archive.write(60, KEY, [(0, 1), (120, 3)])
+    archive.write(60, KEY, [(60, 2)])
+    assert values(archive) == [(0, 1), (60, 2), (120, 3)]
+
+
+def test_insert_patch_and_append(archive):
+    archive.write(60, KEY, [(60, 1), (180, None), (300, 5)])
+    archive.write(60, KEY, [(300, 6), (0, 0), (240, 4), (180, 3), (360, 7), (240, 8)])
+    assert values(archive) == [(0, 0), (60, 1), (180, 3), (240, 8), (300, 6), (360, 7)]
+    assert values(archive, 60, 300) == [(60, 1), (180, 3), (240, 8)]
+
+
+def test_patch_in_place(archive):
+    archive.write(60, KEY, [(0, 1), (60, None), (120, 3)])
+    archive.write(60, KEY, [(60, 2), (180, 4)])
+    assert values(archive) == [(0, 1), (60, 2), (120, 3), (180, 4)]
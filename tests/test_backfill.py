@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_backfill
+@date: 2018/9/6
+"""
+import json
+import shutil
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.dialects import mysql
+
+from config.APP import RECALL_CHECKPOINT_PATH
+from util.tools import now_dt
+from util.transfer import t2s
+from models import get_session
+from models.base import Meta
+from models.event_config import EventConfig
+from models.timeseries import TIERS
+from lib.base import sample_table_range, epoch_minute
+from task.backfill import Backfill, floor_time
+
+EVENTS = {
+    'order_success': [{"column": "status", "op": "==", "value": "SUCCESS"}],
+    'order_failed': [{"column": "status", "op": "==", "value": "FAILED"}],
+}
+
+
+@pytest.fixture
+def configs(orders, monkeypatch):
+    # 只使用声明式事件，lib 中的事件类使用部署环境的 TABLE_CONFIG
+    monkeypatch.setattr('task.backfill.get_registry', dict)
+    Meta.metadata.create_all()
+    session = get_session(Meta.metadata.bind.url, 'statistics')
+    session.add_all([EventConfig(event_key=event_key, table_name='v2.Order',
+                                 predicates=json.dumps(predicates), active=True)
+                     for event_key, predicates in EVENTS.items()])
+    session.commit()
+    shutil.rmtree(RECALL_CHECKPOINT_PATH, ignore_errors=True)
+    yield
+    session.query(EventConfig).delete()
+    session.commit()
+    session.close()
+
+
+def test_resume_from_checkpoint(configs, backend, monkeypatch):
+    end = floor_time(now_dt()) - timedelta(minutes=30)
+    start = end - timedelta(minutes=15)
+    failing = {start + timedelta(minutes=5)}
+    sampled = []
+
+    def sample(self, objs, start, end):
+        sampled.append(start)
+        if start in failing:
+            raise RuntimeError('lost connection')
+        minute = start.strftime('%Y-%m-%d %H:%M:00')
+        return {minute: {obj.event_key: 1 for obj in objs}}
+
+    monkeypatch.setattr(Backfill, 'sample', sample)
+
+    # 同一张表的两个事件一组，每 5 分钟一个单元，中间的单元失败
+    assert Backfill(start, end, chunk=5).run() == 2
+    assert sorted(sampled) == [start, start + timedelta(minutes=5), start + timedelta(minutes=10)]
+
+    # 相同的参数重新执行，只执行失败的单元
+    sampled.clear()
+    failing.clear()
+    assert Backfill(start, end, chunk=5).run() == 3
+    assert sampled == [start + timedelta(minutes=5)]
+
+    # 完成的单元不再执行
+    sampled.clear()
+    assert Backfill(start, end, chunk=5).run() == 3
+    assert sampled == []
+
+    minutes = TIERS[0]
+    points = backend.read_range(list(EVENTS), int(start.timestamp()), int(end.timestamp()),
+                                minutes)
+    for event_key in EVENTS:
+        values = dict(points[event_key])
+        assert len(values) == 15
+        assert sum(values.values()) == 3
+
+
+def test_different_arguments_do_not_share_checkpoint(configs, backend, monkeypatch):
+    end = floor_time(now_dt()) - timedelta(minutes=30)
+    start = end - timedelta(minutes=10)
+    sampled = []
+    monkeypatch.setattr(Backfill, 'sample',
+                        lambda self, objs, start, end: sampled.append(start) or {})
+
+    Backfill(start, end, chunk=5).run()
+    Backfill(start, end, chunk=10).run()
+    assert sampled == [start, start + timedelta(minutes=5), start]
+
+
+def insert(orders, start, statuses):
+    """从 start 开始每 20 秒一行，包括每分钟的开始时刻"""
+    times = [start + timedelta(seconds=20 * i) for i in range(len(statuses))]
+    orders.bind.execute(orders.insert(), [{'created_time': t, 'updated_time': t, 'status': status}
+                                          for t, status in zip(times, statuses)])
+    return list(zip(times, statuses))
+
+
+def test_sample_table_range(orders, event_class):
+    start = datetime(2018, 9, 1, 12, 0)
+    rows = insert(orders, start - timedelta(minutes=1),
+                  ['SUCCESS', 'FAILED', 'INIT'] * 7 + ['SUCCESS'])
+    objs = [event_class('order_success', 'SUCCESS')(t2s(start)),
+            event_class('order_failed', 'FAILED')(t2s(start))]
+
+    end = start + timedelta(minutes=5)
+    expected = {}
+    for t, status in rows:
+        if start <= t < end and status != 'INIT':
+            minute = expected.setdefault(t2s(t.replace(second=0)),
+                                         {'order_success': 0, 'order_failed': 0})
+            minute[f'order_{status.lower()}'] += 1
+
+    values = sample_table_range(objs, t2s(start), t2s(end))
+    assert values == expected
+    assert sorted(values) == [t2s(start + timedelta(minutes=m)) for m in range(5)]
+
+
+def test_epoch_minute_dialects(orders):
+    column = orders.c.created_time
+    assert 'TIMESTAMPDIFF(MINUTE' in str(epoch_minute(column).compile(dialect=mysql.dialect()))
+    assert 'strftime' in str(epoch_minute(column).compile(dialect=orders.bind.dialect))
+
+
+def test_run_samples_table(configs, orders, backend):
+    end = floor_time(now_dt()) - timedelta(minutes=30)
+    start = end - timedelta(minutes=10)
+    # 每分钟 2 行 SUCCESS、1 行 FAILED，最后 1 分钟没有数据
+    insert(orders, start, ['SUCCESS', 'FAILED', 'SUCCESS'] * 9)
+
+    assert Backfill(start, end, chunk=5).run() == 2
+
+    points = backend.read_range(list(EVENTS), int(start.timestamp()), int(end.timestamp()),
+                                TIERS[0])
+    assert [value for _, value in points['order_success']] == [2] * 9 + [0]
+    assert [value for _, value in points['order_failed']] == [1] * 9 + [0]
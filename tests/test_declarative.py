@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_declarative
+@date: 2018/9/6
+"""
+import json
+import logging
+from datetime import datetime, timedelta
+
+import pytest
+
+from util.transfer import t2s
+from lib.base import sample_table, group_by_table
+from lib.declarative import make_event_class, event_classes
+
+END = datetime(2018, 9, 1, 12, 0)
+SUCCESS = json.dumps([{"column": "status", "op": "==", "value": "SUCCESS"}])
+
+
+@pytest.fixture
+def rows(orders):
+    """上一分钟内创建了 5 行，更新了 350 行"""
+    minute = END - timedelta(seconds=30)
+    earlier = END - timedelta(days=1)
+    orders.bind.execute(orders.insert(), [{'created_time': minute, 'updated_time': minute,
+                                           'status': 'SUCCESS'}] * 5 +
+                        [{'created_time': earlier, 'updated_time': minute,
+                          'status': 'SUCCESS'}] * 345)
+
+
+def test_groups_split_by_time_column(rows, event_class):
+    # 代码中定义的事件，使用 TABLE_CONFIG 中的 created_time
+    created = event_class('created_success', 'SUCCESS')
+    updated = make_event_class('updated_success', 'v2.Order', 'updated_time', SUCCESS)
+    assert updated.conf['created_time'] == 'updated_time'
+
+    for order in ([created, updated], [updated, created]):
+        groups = group_by_table([cls(t2s(END)) for cls in order])
+        assert sorted(groups) == ['v2.Order', 'v2.Order[updated_time]']
+
+        values = {}
+        for objs in groups.values():
+            values.update(sample_table(objs))
+        assert values == {'created_success': 5, 'updated_success': 350}
+
+
+def test_invalid_columns_are_skipped(rows, caplog):
+    configs = [
+        {'event_key': 'valid', 'table_name': 'v2.Order', 'predicates': SUCCESS},
+        {'event_key': 'missing_predicate', 'table_name': 'v2.Order',
+         'predicates': json.dumps([{"column": "state", "op": "==", "value": "SUCCESS"}])},
+        {'event_key': 'missing_time_column', 'table_name': 'v2.Order',
+         'time_column': 'paid_time', 'predicates': SUCCESS},
+        {'event_key': 'missing_table', 'table_name': 'v2.Refund', 'predicates': SUCCESS},
+    ]
+
+    with caplog.at_level(logging.ERROR, logger='lib.declarative'):
+        classes = event_classes(configs)
+        event_classes(configs)
+
+    assert list(classes) == ['valid']
+    # 相同的错误只提示一次
+    assert len(caplog.records) == 3
+    assert "['state']" in caplog.text and "['paid_time']" in caplog.text
+
+    obj = classes['valid'](t2s(END))
+    assert sample_table([obj]) == {'valid': 5}
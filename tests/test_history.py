@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_history
+@date: 2018/9/6
+"""
+import time
+
+import pytest
+
+from models.timeseries import TIERS
+from lib.base import _load_history, _query_series, choose_tier, fetch_history
+from lib.history import RESOLUTION, store
+
+KEY = 'history_event'
+EVENT_LOG = TIERS[1]
+
+
+def write(backend, t, value):
+    backend.write([{
+        "measurement": EVENT_LOG.measurement,
+        "tags": {"event_key": KEY},
+        "time": t,
+        "fields": {"value": value},
+    }], retention_policy=EVENT_LOG.retention_policy)
+
+
+@pytest.fixture
+def bucket(backend):
+    """最近一个已结束的 5 分钟时间段，在 ROLLUP_LATENESS 之内"""
+    now = int(time.time())
+    store._series.pop(KEY, None)
+    yield now - now % RESOLUTION - RESOLUTION
+    store._series.pop(KEY, None)
+
+
+def load(t):
+    """:param t: 统计值的时间，即 timestamp + 1m"""
+    return _load_history((t - 60) * 10 ** 9, [KEY])[KEY]
+
+
+def test_recent_bucket_is_reread(backend, bucket):
+    write(backend, bucket - RESOLUTION, 3)
+    write(backend, bucket, 10)
+    assert load(bucket).real == 10
+    assert KEY in store
+
+    # 迟到数据修正了已缓存的统计值
+    write(backend, bucket - RESOLUTION, 4)
+    write(backend, bucket, 12)
+    history = load(bucket)
+    assert history.real == 12
+    assert store.series(KEY).get(bucket - RESOLUTION) == 4
+    assert list(history.recent) == [4]
+
+
+def test_rewritten_to_partial(backend, bucket):
+    write(backend, bucket, 10)
+    assert load(bucket).real == 10
+
+    write(backend, bucket, None)
+    assert load(bucket).real is None
+
+
+def test_fetch_history_evicts_idle_keys(backend, bucket):
+    write(backend, bucket, 10)
+    load(bucket)
+    store.series(KEY).touched -= store.idle_time + 1
+
+    fetch_history([])
+    assert KEY not in store
+
+
+def test_choose_tier_keeps_resolution():
+    week = 7 * 86400
+    assert choose_tier(week).resolution == RESOLUTION
+    assert choose_tier(week, 3600).resolution == 3600
+    assert choose_tier(10 * week, 3600).resolution == 3600
+    # 5 分钟的层级已过期时不使用 1h、1d 的层级代替
+    assert choose_tier(10 * week) is None
+
+
+def test_expired_window_is_empty(backend, bucket):
+    write(backend, bucket, 10)
+    old = bucket - 10 * 7 * 86400
+    recent, expired = _query_series([KEY], [(bucket, None), (old - old % RESOLUTION, None)])
+    assert recent[KEY] == [(bucket, 10)]
+    assert expired == {}
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_regression
+@date: 2018/9/6
+"""
+import random
+
+import numpy as np
+import pytest
+
+from config.APP import EXPECT_PERIOD
+from lib.base import Base, SlidingRegression, linear_values, _slide_regression
+from lib.history import RESOLUTION, Series
+
+
+def polyfit_predict(values):
+    slope, intercept = np.polyfit(np.arange(len(values)), values, 1)
+    return intercept + slope * len(values)
+
+
+def test_sliding_matches_full_fit():
+    """每次移入、移出一个点的结果与对整个窗口重新拟合一致"""
+    random.seed(6)
+    values = [random.randint(0, 1000) for _ in range(200)]
+    window = 9
+
+    regression = SlidingRegression()
+    for t, value in enumerate(values):
+        regression.expire(t - window + 1)
+        regression.push(t, value)
+        if len(regression) >= 2:
+            expected = polyfit_predict(values[max(0, t - window + 1):t + 1])
+            assert np.isclose(regression.predict(), expected)
+
+
+def test_matches_linregress():
+    """与原实现使用的 scipy.stats.linregress 的斜率、截距一致"""
+    stats = pytest.importorskip('scipy.stats')
+    random.seed(7)
+    values = [random.randint(0, 10 ** 6) for _ in range(300)]
+    window = 9
+
+    regression = SlidingRegression()
+    for t, value in enumerate(values):
+        regression.expire(t - window + 1)
+        regression.push(t, value)
+        y = values[max(0, t - window + 1):t + 1]
+        if len(y) >= 2:
+            expected = stats.linregress(np.arange(len(y)), y)
+            assert np.allclose(regression.fit(), (expected.slope, expected.intercept))
+
+
+def test_slide_over_nan_and_missing_slots():
+    """
+    Monitor 每 5 分钟滑动一次回归窗口，窗口内既有 nan（超时、不完整的时间段），
+    也有没有数据的槽位，结果与对窗口内的有效数据重新拟合一致
+    """
+    stats = pytest.importorskip('scipy.stats')
+    random.seed(8)
+    t0 = 1535774400
+    series = Series()
+    for i in range(200):
+        if i % 7 == 3:
+            continue
+        series.put(t0 + i * RESOLUTION, None if i % 5 == 1 else random.randint(0, 1000))
+
+    for i in range(20, 200):
+        ts = t0 + i * RESOLUTION - 60
+        _slide_regression(series, ts)
+        times, values = series.points(ts - EXPECT_PERIOD * 60, ts)
+        assert [t for t, _ in series.regression.points] == times.tolist()
+        expected = stats.linregress(np.arange(len(values)), values)
+        assert np.allclose(series.regression.fit(), (expected.slope, expected.intercept))
+        assert np.isclose(series.regression.predict(), polyfit_predict(values))
+
+
+def test_expire_with_gaps():
+    """缺失的时间点不占用 x 的序号"""
+    regression = SlidingRegression()
+    for t, value in [(0, 5), (1, 7), (4, 9), (5, 10), (7, 15)]:
+        regression.push(t, value)
+    regression.expire(1)
+
+    assert len(regression) == 4
+    assert np.isclose(regression.predict(), polyfit_predict([7, 9, 10, 15]))
+
+
+def test_linear_accepts_regression_and_values():
+    values = [10, 12, 13, 15, 18, 19, 21]
+    assert Base.linear(values) == Base.linear(SlidingRegression.from_values(values))
+    assert Base.linear(values[:5]) is None
+    # 预测值为负时为 0
+    assert Base.linear([60, 50, 40, 30, 20, 10]) == 0.0
+
+
+def test_linear_values_matches_linear():
+    windows = np.array([[10, 12, np.nan, 15, 18, 19, 21],
+                        [5, np.nan, np.nan, np.nan, 1, 2, 3],
+                        [60, 50, 40, 30, 20, 10, 5]])
+    expected = [Base.linear([v for v in row if not np.isnan(v)]) for row in windows]
+
+    assert [None if np.isnan(v) else v for v in linear_values(windows)] == expected
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_rollup
+@date: 2018/9/6
+"""
+import time
+
+import pytest
+
+from util.transfer import s2t
+from models.timeseries import TIERS
+from lib.base import fetch_history
+from lib.declarative import DeclarativeEvent
+from lib.history import RESOLUTION, store
+from task.rollup import Rollup, monitor_end
+
+HOUR = 3600
+EVENT_LOG, EVENT_LOG_1H = TIERS[1], TIERS[2]
+
+
+class Event(DeclarativeEvent):
+    __register__ = False
+    _event_key = 'rollup_event'
+    schema = 'v2'
+    table = 'Order'
+
+
+@pytest.fixture
+def hour():
+    """一小时前的整点，数据不会因为 retention 被删除"""
+    now = int(time.time())
+    return now - now % HOUR - HOUR
+
+
+def minutes(start, count, value=5):
+    return [(Event._event_key, start + 60 * i, value) for i in range(count)]
+
+
+def test_close_writes_bucket_after_last_minute(backend, hour):
+    rollup = Rollup()
+    rollup.extend(minutes(hour, 4))
+    assert rollup.close(hour + 4 * 60)[RESOLUTION] == []
+
+    rollup.extend(minutes(hour + 4 * 60, 1))
+    assert rollup.close(hour + RESOLUTION)[RESOLUTION] == [hour]
+
+    points = backend.read_range([Event._event_key], hour, hour + RESOLUTION, EVENT_LOG)
+    assert points[Event._event_key] == [(hour, 25)]
+    assert backend.last(EVENT_LOG, 'end_time') == monitor_end(hour)
+
+
+def test_monitor_reads_closed_bucket(backend, hour):
+    """Sampler(b + 5m) 写入 b 的统计值后触发的 Monitor 读取的就是 b 的统计值"""
+    rollup = Rollup()
+    rollup.extend(minutes(hour, 5))
+    rollup.close(hour + RESOLUTION)
+
+    end = monitor_end(hour)
+    assert s2t(end).timestamp() == hour + 4 * 60
+
+    obj = Event(end)
+    assert obj.timestamp // 10 ** 9 + 60 == hour
+    assert obj.real_value() == 25
+
+    # 批量读取与进程内缓存的结果一致
+    store.warm(Event._event_key, [], hour - RESOLUTION)
+    obj = Event(end)
+    fetch_history([obj])
+    assert obj.real_value() == 25
+
+
+def test_late_minute_rewrites_bucket(backend, hour):
+    rollup = Rollup()
+    rollup.extend(minutes(hour, 5))
+    assert rollup.close(hour + RESOLUTION)[RESOLUTION] == [hour]
+
+    # 已写入的时间段收到迟到数据，重新写入但不再触发 Monitor
+    rollup.extend(minutes(hour + 4 * 60, 1, value=7))
+    assert rollup.close(hour + RESOLUTION + 60)[RESOLUTION] == []
+
+    points = backend.read_range([Event._event_key], hour, hour + RESOLUTION, EVENT_LOG)
+    assert points[Event._event_key] == [(hour, 27)]
+
+
+def test_timed_out_minute_holds_bucket(backend, hour):
+    """超时的分钟为 None，等待实际值写入后再写入时间段并触发 Monitor"""
+    rollup = Rollup()
+    rollup.extend(minutes(hour, 4))
+    rollup.extend([(Event._event_key, hour + 4 * 60, None)])
+    assert rollup.close(hour + RESOLUTION)[RESOLUTION] == []
+    assert backend.read_range([Event._event_key], hour, hour + RESOLUTION, EVENT_LOG) == {}
+
+    rollup.extend(minutes(hour + 4 * 60, 1, value=7))
+    assert rollup.close(hour + RESOLUTION + 60)[RESOLUTION] == [hour]
+
+    points = backend.read_range([Event._event_key], hour, hour + RESOLUTION, EVENT_LOG)
+    assert points[Event._event_key] == [(hour, 27)]
+
+
+def test_pending_event_key_holds_monitor(backend, hour):
+    """同一时间段内有 event_key 未写入时不返回该时间段"""
+    rollup = Rollup()
+    rollup.extend(minutes(hour, 5))
+    rollup.extend([('other', hour + 60 * i, 1) for i in range(4)])
+    assert rollup.close(hour + RESOLUTION)[RESOLUTION] == []
+
+    points = backend.read_range([Event._event_key], hour, hour + RESOLUTION, EVENT_LOG)
+    assert points[Event._event_key] == [(hour, 25)]
+
+    rollup.extend([('other', hour + 4 * 60, 1)])
+    assert rollup.close(hour + RESOLUTION + 60)[RESOLUTION] == [hour]
+
+
+def test_partial_bucket_after_lateness(backend, hour):
+    """超过 lateness 仍不完整的时间段以 partial 标记写入，不作为实际值"""
+    rollup = Rollup(lateness=600)
+    rollup.extend(minutes(hour, 4))
+    assert rollup.close(hour + RESOLUTION + 540)[RESOLUTION] == []
+    assert rollup.close(hour + RESOLUTION + 600)[RESOLUTION] == [hour]
+
+    assert backend.read_range([Event._event_key], hour, hour + RESOLUTION, EVENT_LOG) == {}
+    assert backend.last(EVENT_LOG, 'partial') is True
+    assert backend.last(EVENT_LOG, 'partial_value') == 20
+
+    obj = Event(monitor_end(hour))
+    assert obj.real_value() is None
+
+
+def test_rollup_lock(tmp_path):
+    """只有一个 Rollup 持有文件锁"""
+    path = str(tmp_path / 'rollup.lock')
+    owner, other = Rollup(lock_path=path), Rollup(lock_path=path)
+    assert owner.acquire() and owner.acquire()
+    assert not other.acquire()
+    assert Rollup().acquire()
+
+    owner._owner[0].close()
+    assert other.acquire()
+
+
+def test_hour_bucket_sums_five_minute_buckets(backend, hour):
+    rollup = Rollup()
+    for i in range(12):
+        rollup.extend(minutes(hour + i * RESOLUTION, 5))
+        closed = rollup.close(hour + (i + 1) * RESOLUTION)
+    assert closed[HOUR] == [hour]
+
+    points = backend.read_range([Event._event_key], hour, hour + HOUR, EVENT_LOG_1H)
+    assert points[Event._event_key] == [(hour, 300)]
+    assert backend.last(EVENT_LOG_1H, 'end_time') == monitor_end(hour, HOUR)
+
+
+def test_missing_minutes_are_read_back(backend, hour):
+    """其它 worker 进程采样的分钟数据从存储中补全"""
+    backend.write([{
+        "measurement": TIERS[0].measurement,
+        "tags": {"event_key": event_key},
+        "time": t,
+        "fields": {"value": value},
+    } for event_key, t, value in minutes(hour, 2)], retention_policy=TIERS[0].retention_policy)
+
+    rollup = Rollup()
+    rollup.extend(minutes(hour + 2 * 60, 3))
+    assert rollup.close(hour + RESOLUTION)[RESOLUTION] == [hour]
+
+    points = backend.read_range([Event._event_key], hour, hour + RESOLUTION, EVENT_LOG)
+    assert points[Event._event_key] == [(hour, 25)]
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_scheduler
+@date: 2018/9/6
+"""
+from threading import Event
+from concurrent.futures import CancelledError
+
+import pytest
+from sqlalchemy.dialects import mysql
+
+from config.APP import SAMPLE_STATEMENT_TIMEOUT
+from lib.base import sample_statement, incremental_statement
+from task.scheduler import DBQueue
+
+
+def test_cancel_queued_query():
+    """超时后取消还在队列中的查询，不再占用并发数"""
+    queue = DBQueue('test', concurrency=1)
+    blocked = Event()
+    running = queue.submit(blocked.wait, 10)
+    queued = queue.submit(lambda: 1)
+    assert queue.stats()['queued'] == 1
+
+    assert queued.cancel()
+    with pytest.raises(CancelledError):
+        queued.result()
+    assert queue.stats()['queued'] == 0
+
+    blocked.set()
+    assert running.result(timeout=10)
+    assert queue.submit(lambda: 2).result(timeout=10) == 2
+    queue.executor.shutdown()
+
+
+def test_statement_timeout(orders, event_class):
+    objs = [event_class('order_success', 'SUCCESS', primary_key='id')('2018-09-01 12:00:00'),
+            event_class('order_failed', 'FAILED', primary_key='id')('2018-09-01 12:00:00')]
+    for statement in (sample_statement(objs), sample_statement(objs[:1]),
+                      incremental_statement(objs)):
+        sql = str(statement.compile(dialect=mysql.dialect()))
+        assert sql.startswith(f'SELECT /*+ MAX_EXECUTION_TIME({SAMPLE_STATEMENT_TIMEOUT * 1000}) */')
+        assert 'MAX_EXECUTION_TIME' not in str(statement.compile(dialect=orders.bind.dialect))
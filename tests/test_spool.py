@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_spool
+@date: 2018/9/6
+"""
+import glob
+import os
+
+from models.spool import Spool
+
+LINE = 'sampledLog,event_key=spool_event value={}i 1535774400000000000'
+
+
+def test_append_is_flushed(tmp_path, monkeypatch):
+    """追加后不需要关闭分段，其它进程（或者崩溃后重启的进程）即可读到"""
+    spool = Spool(str(tmp_path), fsync_every=1000, fsync_interval=3600)
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+
+    spool.append('rp_2_weeks', [LINE.format(1)])
+    spool.append('rp_2_weeks', [LINE.format(2)])
+    assert synced == []
+
+    segment, = glob.glob(os.path.join(str(tmp_path), f'*{Spool.open_suffix}'))
+    assert Spool.read(segment) == {'rp_2_weeks': [LINE.format(2)]}
+
+    # 分段关闭时 fsync
+    assert len(spool.segments()) == 1
+    assert len(synced) == 1
+
+
+def test_replay_after_crash(tmp_path):
+    """写入进程退出后遗留的 *.open 分段在重放时关闭并写回"""
+    spool = Spool(str(tmp_path))
+    spool.append(None, [LINE.format(1)])
+    segment, = glob.glob(os.path.join(str(tmp_path), f'*{Spool.open_suffix}'))
+    os.replace(segment, segment.replace(f'-{os.getpid()}.', '-999999999.'))
+    spool._file = None
+
+    posted = []
+    assert Spool(str(tmp_path)).replay(lambda lines, rp: posted.append((rp, lines))) == 1
+    assert posted == [(None, [LINE.format(1)])]
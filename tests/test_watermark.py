@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zheng.long@sfy.com
+@module: test_watermark
+@date: 2018/9/6
+"""
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from config.APP import WATERMARK_SAFETY
+from util.transfer import t2s
+from lib.base import sample_table, incremental
+from lib.watermark import watermarks
+
+T0 = datetime(2018, 9, 1, 12, 0)
+
+
+@pytest.fixture
+def classes(event_class):
+    return {
+        'range': [event_class('range_success', 'SUCCESS'),
+                  event_class('range_failed', 'FAILED')],
+        'incremental': [event_class('incremental_success', 'SUCCESS', primary_key='id'),
+                        event_class('incremental_failed', 'FAILED', primary_key='id')],
+    }
+
+
+@pytest.fixture
+def rows(orders):
+    """
+    主键按 created_time 加上不超过 WATERMARK_SAFETY 的随机偏差排序，
+    每分钟的开始、结束时刻都有数据
+    """
+    random.seed(17)
+    times = [T0 + timedelta(seconds=random.randrange(40 * 60)) for _ in range(2000)]
+    times += [T0 + timedelta(minutes=m) for m in range(40)]
+    times.sort(key=lambda t: t + timedelta(seconds=random.randrange(WATERMARK_SAFETY)))
+
+    rows = [(t, random.choice(['SUCCESS', 'FAILED', 'INIT'])) for t in times]
+    orders.bind.execute(orders.insert(), [{'created_time': t, 'updated_time': t, 'status': status}
+                                          for t, status in rows])
+    watermarks.watermarks = {}
+    yield rows
+    watermarks.watermarks = {}
+
+
+def sample(classes, end: datetime):
+    objs = [cls(t2s(end)) for cls in classes]
+    return [sample_table(objs)[obj.event_key] for obj in objs]
+
+
+def test_incremental_matches_range(rows, classes):
+    assert incremental(classes['incremental'][0](t2s(T0)))
+    assert not incremental(classes['range'][0](t2s(T0)))
+
+    for minute in range(10, 35):
+        end = T0 + timedelta(minutes=minute)
+        # 每分钟的开始时刻包含在内，结束时刻不包含
+        expected = [sum(1 for t, s in rows if s == status and end - timedelta(minutes=1) <= t < end)
+                    for status in ('SUCCESS', 'FAILED')]
+        assert sample(classes['range'], end) == expected
+        assert sample(classes['incremental'], end) == expected
+
+    watermark, safe = watermarks.get('v2.Order')
+    assert safe == (T0 + timedelta(minutes=34, seconds=-WATERMARK_SAFETY)).timestamp()
+    assert watermark > 0
+
+
+def test_earlier_minute_falls_back_to_range(rows, classes):
+    for minute in range(20, 25):
+        sample(classes['incremental'], T0 + timedelta(minutes=minute))
+    state = watermarks.get('v2.Order')
+
+    # 重试较早的分钟时水位不适用，使用 created_time 范围查询，水位不变
+    end = T0 + timedelta(minutes=12)
+    assert sample(classes['incremental'], end) == sample(classes['range'], end)
+    assert watermarks.get('v2.Order') == state
+
+
+def test_custom_time_column_is_not_incremental(event_class):
+    cls = event_class('updated_success', 'SUCCESS', primary_key='id',
+                      created_time='updated_time')
+    assert not incremental(cls(t2s(T0)))
@@ -13,10 +13,9 @@ import logging
 from array import array
 from functools import partial
 from datetime import datetime, timedelta, date
-from collections import Iterable, Mapping
+from collections.abc import Iterable, Mapping
 
 import numpy as np
-from werkzeug.utils import find_modules, import_string
 
 int_array = partial(array, 'i')
 uint_array = partial(array, 'I')
@@ -28,6 +27,7 @@ logger = logging.getLogger(__name__)
 def get_lib_cls():
     """
     从 lib 包下，加载包含 event_key 属性的类
+    注册表在进程内只构建一次，见 lib.registry
     :return:
     """
     _current_path = os.path.abspath(os.path.dirname(__file__))
@@ -35,10 +35,8 @@ def get_lib_cls():
     if _father_path not in sys.path:
         sys.path.append(_father_path)
 
-    return {field_type._event_key: field_type
-            for name in find_modules('lib')
-            for field, field_type in import_string(name).__dict__.items()
-            if hasattr(field_type, '_event_key')}
+    from lib.registry import get_registry
+    return get_registry()
 
 
 class TimeSeries(object):
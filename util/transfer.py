@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
+import re
 import logging
 from datetime import datetime
 from util.tools import str_fmt
@@ -93,6 +94,21 @@ def s2num(val, default=None):
     return ret
 
 
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def duration2s(val):
+    """InfluxDB 的时间长度转秒数，如 '26w', '1h30m'，'INF' 返回 None"""
+    val = ensure_unicode(val).strip().lower()
+    if val in ('inf', '0', '0s'):
+        return None
+
+    parts = re.findall(r'(\d+)([smhdw])', val)
+    if not parts or ''.join(n + u for n, u in parts) != val:
+        raise ValueError(f'Invalid duration: {val}')
+    return sum(int(n) * DURATION_UNITS[u] for n, u in parts)
+
+
 def b2s(val):
     """byte -> str"""
     if isinstance(val, bytes):